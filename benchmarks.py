@@ -0,0 +1,328 @@
+"""
+Benchmark suite for the model evaluation, the solvers, networks and the GUI
+update paths. Runs headless (Agg backend) and records the wall time, the
+number of right-hand side evaluations and the peak memory of every case.
+
+Usage:
+    python benchmarks.py [-k PATTERN] [--output FILE] [--compare FILE]
+
+@author: Luka
+"""
+
+import argparse
+import fnmatch
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+import scipy
+
+from neuron_model import Neuron
+from network_model import CurrentSynapse, ResistorInterconnection, Network
+
+# Registered benchmarks: (name, setup function, parameters)
+BENCHMARKS = []
+
+def benchmark(name, params = [{}]):
+    """
+    Decorator registering a benchmark setup(**p) for every parameter
+    dictionary p. The setup returns a function performing one run of the
+    benchmark, which returns the number of RHS evaluations (None if not
+    applicable) or a dictionary of solver counts.
+    """
+    def register(setup):
+        for p in params:
+            label = ",".join("%s=%s" % item for item in p.items())
+            BENCHMARKS.append((name + ("[%s]" % label if label else ""),
+                               setup, p))
+        return setup
+    return register
+
+# Models: the single neuron and network examples and a conductance-based
+# neuron as in gui_conductance.py
+
+def current_neuron():
+    neuron = Neuron()
+    neuron.add_conductance(1)
+    neuron.add_current(-2, 0, 0) # fast negative conductance
+    neuron.add_current(2, 0, 50) # slow positive conductance
+    neuron.add_current(-1.5, -1.5, 50) # slow negative conductance
+    neuron.add_current(1.5, -1.5, 2500) # ultraslow positive conductance
+    return neuron
+
+def conductance_neuron():
+    neuron = Neuron()
+    neuron.add_conductance(1)
+    for g_max, E_rev, k, voff, timescale in ((4, 30, 0.1, -20, 0),
+                                             (4, -75, 0.1, -20, 30),
+                                             (2, 140, 0.15, -50, 30),
+                                             (2, -75, 0.15, -50, 400)):
+        neuron.add_conductance(g_max, E_rev).add_gate(k, voff, timescale)
+    return neuron
+
+def example_network():
+    neurons = [current_neuron() for _ in range(2)]
+    g_inh = [[0, .2], [0, 0]]
+    g_exc = [[0, 0], [0, 0]]
+    g_res = [[0, 0], [0, 0]]
+    return Network(neurons, (CurrentSynapse(-1, -1, 50), g_inh),
+                   (CurrentSynapse(+1, -1, 50), g_exc),
+                   (ResistorInterconnection(), g_res))
+
+def random_network(N, density, seed = 0):
+    rng = np.random.default_rng(seed)
+    def matrix():
+        g = (rng.random((N, N)) < density) * rng.random((N, N)) * 0.2
+        np.fill_diagonal(g, 0)
+        return g
+    g_res = matrix()
+    return Network([current_neuron() for _ in range(N)],
+                   (CurrentSynapse(-1, -1, 50), matrix()),
+                   (CurrentSynapse(+1, -1, 50), matrix()),
+                   (ResistorInterconnection(), (g_res + g_res.T) / 2))
+
+# Right-hand sides
+
+@benchmark("neuron_sys", [{'model': 'current'}, {'model': 'conductance'}])
+def neuron_sys(model):
+    neuron = current_neuron() if (model == 'current') else conductance_neuron()
+    y = np.asarray(neuron.get_init_conditions(), dtype = float) + 0.1
+    def run():
+        neuron.sys(-2, y)
+        return 1
+    return run
+
+@benchmark("network_sys", [{'N': N, 'density': d} for N in (2, 8, 50, 500)
+                           for d in (0.1, 0.5)])
+def network_sys(N, density):
+    network = random_network(N, density)
+    y = np.asarray(network.get_init_conditions(), dtype = float) + 0.1
+    i_app = np.full(N, -2.0)
+    def run():
+        network.sys(i_app, y)
+        return 1
+    return run
+
+@benchmark("example_network_sys")
+def example_network_sys():
+    # Small network of network_example.py, evaluated neuron by neuron
+    network = example_network()
+    y = np.asarray(network.get_init_conditions(), dtype = float) + 0.1
+    i_app = np.array([-2.1, -2])
+    def run():
+        network.sys(i_app, y)
+        return 1
+    return run
+
+# Solvers
+
+@benchmark("simulate", [{'model': m, 'method': s}
+                        for m in ('neuron', 'network')
+                        for s in ('Default', 'BDF')])
+def simulate(model, method):
+    if (model == 'neuron'):
+        system = current_neuron()
+        trange = (0, 10000)
+        i_app = lambda t: -2
+    else:
+        system = example_network()
+        trange = (0, 20000)
+        i_app = lambda t: [-2.1, -2]
+    def run():
+        sol = system.simulate(trange, i_app, method = method)
+        return {'nfev': sol.nfev, 'njev': sol.njev, 'nlu': sol.nlu}
+    return run
+
+# IV curves and GUI update paths
+
+V_GUI = np.arange(-3, 3.1, 0.1)
+
+@benchmark("neuron_IV")
+def neuron_IV():
+    neuron = current_neuron()
+    def run():
+        for timescale in (0, 50, 2500):
+            neuron.IV(V_GUI, timescale, -1)
+    return run
+
+@benchmark("IV_curve_update")
+def IV_curve_update():
+    from gui_utilities import IV_curve
+    neuron = current_neuron()
+    curves = [IV_curve(neuron, name, timescale, V_GUI, ['C0', color])
+              for name, timescale, color in (("Fast", 0, 'C3'),
+                                             ("Slow", 50, 'C1'),
+                                             ("Ultraslow", 2500, 'C6'))]
+    def run():
+        prev_labels = None
+        for curve in curves:
+            curve.update(-1, prev_labels)
+            curve.get_segments()
+            prev_labels = curve.labels
+    return run
+
+def _gui():
+    import matplotlib.pyplot as plt
+    from gui_utilities import GUI
+    neuron = current_neuron()
+    gui = GUI(neuron, i0 = -2, plot_fixed_point = True)
+    gui.add_sim_plot([0.1, 0.45, 0.8, 0.2])
+    for k, (name, timescale) in enumerate((("Fast", 0), ("Slow", 50),
+                                           ("Ultraslow", 2500))):
+        gui.add_IV_curve(neuron, name, timescale,
+                         [0.1 + 0.3 * k, 0.75, 0.2, 0.2])
+    return gui, neuron, plt
+
+@benchmark("gui_update_fixed_point")
+def gui_update_fixed_point():
+    gui, _, _ = _gui()
+    currents = [-2, -1.5]
+    def run():
+        # Alternate the applied current so that the equilibrium moves
+        currents.reverse()
+        gui.i_app_const = currents[0]
+        gui.update_fixed_point()
+    return run
+
+@benchmark("gui_update_IV_curves")
+def gui_update_IV_curves():
+    gui, neuron, _ = _gui()
+    element = neuron.elements[2]
+    values = [2, 1.5]
+    def run():
+        # Slider update of a slow element
+        values.reverse()
+        gui.update_val(values[0], element.update_a)
+    return run
+
+# Runner
+
+def _counts(value):
+    if (value is None):
+        return {}
+    if isinstance(value, dict):
+        return {key: int(v) for key, v in value.items()}
+    return {'nfev': int(value)}
+
+def measure(run, repeat = 5, min_time = 0.1):
+    """
+    Times run in repeat samples of number calls, with number chosen so that
+    every sample takes at least min_time, then records the peak memory
+    allocated during a single call with tracemalloc
+    
+    Returns a dictionary of the time per call (best and median), the solver
+    counts of a call and the peak memory in bytes
+    """
+    counts = _counts(run()) # Warm-up, caches and counts
+    
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            run()
+        elapsed = time.perf_counter() - start
+        if (elapsed >= min_time):
+            break
+        number *= 2 if (elapsed == 0) else max(2, int(min_time / elapsed))
+    
+    samples = [elapsed / number]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            run()
+        samples.append((time.perf_counter() - start) / number)
+    
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    
+    return {'time': float(np.median(samples)), 'time_min': min(samples),
+            'number': number, 'repeat': repeat, 'counts': counts,
+            'peak_memory': peak}
+
+def metadata():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"],
+                                capture_output = True, text = True,
+                                check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(),
+            'numpy': np.__version__, 'scipy': scipy.__version__,
+            'matplotlib': matplotlib.__version__,
+            'machine': platform.platform(),
+            'date': time.strftime("%Y-%m-%d %H:%M:%S")}
+
+def run_benchmarks(pattern = "*", repeat = 5, min_time = 0.1, report = print):
+    """
+    Runs the benchmarks whose name matches the glob pattern
+    Returns {'metadata': ..., 'results': {name: measurement}}
+    """
+    results = {}
+    for name, setup, params in BENCHMARKS:
+        if not fnmatch.fnmatch(name, pattern):
+            continue
+        result = measure(setup(**params), repeat, min_time)
+        results[name] = result
+        report(_format(name, result))
+    return {'metadata': metadata(), 'results': results}
+
+def _format(name, result, reference = None):
+    counts = " ".join("%s=%d" % item for item in result['counts'].items())
+    line = "%-48s %12.3e s %10.1f kB  %s" % (name, result['time'],
+                                            result['peak_memory'] / 1024,
+                                            counts)
+    if (reference is not None):
+        line += "  (x%.2f)" % (result['time'] / reference['time'])
+    return line
+
+def compare(new, old, threshold = 1.2):
+    """
+    Returns the names of the benchmarks whose median time grew by more than
+    threshold relative to the old results
+    """
+    slower = []
+    for name, result in new['results'].items():
+        reference = old['results'].get(name)
+        if (reference is None):
+            continue
+        print(_format(name, result, reference))
+        if (result['time'] > threshold * reference['time']):
+            slower.append(name)
+    return slower
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Run the benchmarks")
+    parser.add_argument("-k", dest = "pattern", default = "*",
+                        help = "glob pattern of the benchmark names")
+    parser.add_argument("--repeat", type = int, default = 5)
+    parser.add_argument("--min-time", type = float, default = 0.1,
+                        help = "minimum duration of a timing sample (s)")
+    parser.add_argument("--output", help = "json file for the results")
+    parser.add_argument("--compare", help = "json file of earlier results")
+    parser.add_argument("--threshold", type = float, default = 1.2,
+                        help = "slowdown factor reported as a regression")
+    args = parser.parse_args()
+    
+    report = print if (args.compare is None) else (lambda line: None)
+    results = run_benchmarks(args.pattern, args.repeat, args.min_time,
+                             report)
+    if (args.output is not None):
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent = 1)
+    if (args.compare is not None):
+        with open(args.compare) as f:
+            old = json.load(f)
+        print("\nComparison with %s (commit %s)"
+              % (args.compare, old['metadata'].get('commit')))
+        slower = compare(results, old, args.threshold)
+        if (len(slower) > 0):
+            print("\nSlower than x%.2f: %s" % (args.threshold,
+                                              ", ".join(slower)))
+            raise SystemExit(1)
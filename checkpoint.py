@@ -0,0 +1,242 @@
+"""
+Checkpoints of long simulations: the model spec, the solver state and the
+output cursor are written to disk at regular intervals, so that a simulation
+killed by a preemption can be continued from its last checkpoint with resume.
+
+@author: Luka
+"""
+
+import json
+import os
+import time
+
+import numpy as np
+from scipy.sparse import csr_matrix, issparse
+
+from neuron_model import Neuron, _plain
+from network_model import Network
+from population import Population
+
+# Solver attributes saved in addition to t and y, the LU decompositions are
+# recomputed from the saved Jacobian after a restore
+SOLVER_STATE = {'RK45': ('f', 'h_abs'),
+                'BDF': ('D', 'order', 'h_abs', 'n_equal_steps', 'J'),
+                'Radau': ('f', 'h_abs', 'h_abs_old', 'error_norm_old', 'J',
+                          'current_jac', 'Z', 't_old', 'y_old'),
+                'LSODA': ('step_size',)}
+
+def system_from_spec(spec):
+    """
+    Builds a Neuron, Network or Population from its spec
+    """
+    types = {'Neuron': Neuron, 'Network': Network, 'Population': Population}
+    if (spec is None) or (spec.get('type') not in types):
+        raise ValueError("The spec does not describe a known system")
+    return types[spec['type']].from_spec(spec)
+
+def solver_state(solver):
+    """
+    Returns the attributes of a scipy solver needed to continue its steps
+    """
+    names = SOLVER_STATE.get(type(solver).__name__, ())
+    return {name: getattr(solver, name) for name in names}
+
+def solver_options(state):
+    """
+    Returns the keyword arguments of the restored solver constructor
+    """
+    step_size = state.get('step_size')
+    if (step_size is not None) and (step_size > 0):
+        return {'first_step': step_size}
+    return {}
+
+def restore_solver(solver, state):
+    """
+    Sets the saved attributes of a scipy solver created at the checkpoint
+    """
+    for name, value in state.items():
+        if (name != 'step_size'):
+            setattr(solver, name, value)
+    if hasattr(solver, 'LU'):
+        solver.LU = None
+    if hasattr(solver, 'LU_real'):
+        solver.LU_real = None
+        solver.LU_complex = None
+    if ('Z' in state) and (state.get('t_old') is not None):
+        solver.sol = solver._compute_dense_output()
+
+class Checkpoint():
+    """
+    Saved state of a simulation
+    
+    attributes:
+        spec: model spec, None if the system has no spec
+        backend: backend of the system
+        method, trange, dt, record, dt_out, chunk_size: simulation arguments
+        t, y: time and state of the solver
+        step: number of steps taken by a fixed-step method
+        solver: solver attributes (step size, BDF differences and order,
+        Jacobian, ...), see SOLVER_STATE
+        samples: number of output samples produced up to the checkpoint,
+        including the initial sample. The output of the resumed simulation
+        continues with sample number samples.
+        n_out: index of the next point of the dt_out output grid
+        counts: nfev, njev and nlu up to the checkpoint
+        interval, wall_interval: checkpoint intervals, see Checkpointer
+    
+    methods:
+        save: write the checkpoint to a file
+        load: read a checkpoint file (classmethod)
+        system: build the system from the spec
+    """
+    
+    _meta = ('spec', 'backend', 'method', 'trange', 'dt', 'dt_out',
+             'chunk_size', 't', 'step', 'samples', 'n_out', 'counts',
+             'interval', 'wall_interval')
+    
+    def __init__(self, **kwargs):
+        self.solver = {}
+        self.__dict__.update(kwargs)
+    
+    def system(self):
+        system = system_from_spec(self.spec)
+        system.backend = self.backend
+        return system
+    
+    def save(self, path):
+        """
+        Writes the checkpoint to path (.npz format). The file is replaced
+        atomically, so that an interruption leaves the previous checkpoint.
+        """
+        meta = {name: getattr(self, name) for name in self._meta}
+        arrays = {'y': np.asarray(self.y), 'record': np.asarray(self.record)}
+        meta['solver'] = {}
+        for name, value in self.solver.items():
+            if issparse(value):
+                value = csr_matrix(value)
+                meta['solver'][name] = {'sparse': value.shape}
+                for part in ('data', 'indices', 'indptr'):
+                    arrays['solver.%s.%s' % (name, part)] = getattr(value,
+                                                                    part)
+            elif isinstance(value, np.ndarray):
+                meta['solver'][name] = {'array': True}
+                arrays['solver.' + name] = value
+            else:
+                meta['solver'][name] = {'value': value}
+        
+        temp = path + '.tmp'
+        with open(temp, 'wb') as f:
+            np.savez(f, meta = np.array(json.dumps(_plain(meta))), **arrays)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, path)
+    
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            meta = json.loads(str(data['meta']))
+            solver = {}
+            for name, kind in meta.pop('solver').items():
+                if ('sparse' in kind):
+                    solver[name] = csr_matrix(
+                        tuple(data['solver.%s.%s' % (name, part)]
+                              for part in ('data', 'indices', 'indptr')),
+                        shape = tuple(kind['sparse']))
+                elif ('array' in kind):
+                    solver[name] = data['solver.' + name]
+                else:
+                    solver[name] = kind['value']
+            y = data['y']
+            record = data['record']
+        return cls(y = y, record = record, solver = solver, **meta)
+
+class Checkpointer():
+    """
+    Writes the checkpoints of a running simulation, see System.simulate
+    
+    args:
+        path: checkpoint file, replaced by every new checkpoint
+    
+    kwargs:
+        interval: simulated time between two checkpoints
+        wall_interval: wall-clock time between two checkpoints, in seconds
+    
+    A checkpoint is written when either interval has elapsed. Writing a
+    checkpoint first passes the buffered output samples to the caller as a
+    chunk, so that the checkpoint never refers to output that was not
+    delivered.
+    """
+    
+    def __init__(self, path, interval = None, wall_interval = None):
+        if (interval is None) and (wall_interval is None):
+            raise ValueError("Either interval or wall_interval is needed")
+        self.path = path
+        self.interval = interval
+        self.wall_interval = wall_interval
+    
+    def start(self, system, t, **run):
+        """
+        Starts the checkpoints of a run at time t with the simulation
+        arguments run (method, trange, dt, record, dt_out, chunk_size)
+        """
+        self.run = run
+        self.run.update(spec = system.to_spec(), backend = system.backend,
+                        interval = self.interval,
+                        wall_interval = self.wall_interval)
+        self._schedule(t)
+    
+    def _schedule(self, t):
+        self.next_t = np.inf
+        if (self.interval is not None):
+            self.next_t = t + self.interval
+        self.next_wall = np.inf
+        if (self.wall_interval is not None):
+            self.next_wall = time.monotonic() + self.wall_interval
+    
+    def due(self, t):
+        return (t >= self.next_t) or (time.monotonic() >= self.next_wall)
+    
+    def save(self, t, y, step = 0, solver = {}, samples = 1, n_out = 1,
+             counts = {}):
+        checkpoint = Checkpoint(t = t, y = np.array(y), step = step,
+                                solver = solver, samples = samples,
+                                n_out = n_out, counts = counts, **self.run)
+        checkpoint.save(self.path)
+        self._schedule(t)
+        return checkpoint
+
+def resume(path, i_app, callback = None, system = None, checkpoints = True):
+    """
+    Continues the simulation saved in the checkpoint file path
+    
+    args:
+        path: checkpoint file
+        i_app: applied current function of the original simulation
+    
+    kwargs:
+        callback: f(t, y) called with each output chunk, as for simulate
+        system: the simulated system, built from the saved spec by default
+        checkpoints: if True, checkpoints continue to be written to path
+    
+    Returns (system, sol), where the solution contains the output after the
+    checkpoint (from output sample checkpoint.samples on). Fixed-step methods
+    continue bit-identically, the adaptive methods continue from the saved
+    state and step size (BDF and Radau with their saved history, the LU
+    decompositions being recomputed; LSODA and Multirate restart at the
+    checkpoint).
+    """
+    checkpoint = Checkpoint.load(path)
+    if (system is None):
+        system = checkpoint.system()
+    
+    checkpointer = None
+    if (checkpoints):
+        checkpointer = Checkpointer(path, checkpoint.interval,
+                                    checkpoint.wall_interval)
+    
+    sol = system.simulate(checkpoint.trange, i_app, checkpoint.method,
+                          checkpoint.dt, record = checkpoint.record,
+                          dt_out = checkpoint.dt_out, callback = callback,
+                          chunk_size = checkpoint.chunk_size,
+                          checkpoint = checkpointer, resume = checkpoint)
+    return system, sol
@@ -0,0 +1,229 @@
+"""
+Numerical continuation of equilibrium branches of neurons and networks with
+respect to the applied current or an element parameter, with detection of
+fold (saddle-node) and Hopf bifurcations
+
+@author: Luka
+"""
+
+import numpy as np
+from scipy.sparse import issparse
+
+from neuron_model import Neuron
+
+class Branch():
+    """
+    Equilibrium branch traced by continuation
+    
+    attributes:
+        p: parameter values along the branch
+        y: equilibrium states, shape (len(p), n_states)
+        v: membrane voltages, shape (len(p), n_neurons)
+        eigenvalues: eigenvalues of the linearization at every point
+        stable: True where all eigenvalues have negative real parts
+        fold_p, fold_y: parameter values and states of the fold points
+        hopf_p, hopf_y: parameter values and states of the Hopf points
+        hopf_omega: angular frequency of the oscillations at the Hopf points
+    """
+    
+    def __init__(self, system, p, y, eigenvalues, folds, hopfs):
+        index = system.membrane_index()
+        n = len(system.y0)
+        
+        self.p = np.array(p)
+        self.y = np.array(y)
+        self.v = self.y[:, index]
+        self.eigenvalues = np.array(eigenvalues)
+        self.stable = np.all(self.eigenvalues.real < 0, axis = 1)
+        
+        folds = np.array(folds).reshape(-1, n + 1)
+        self.fold_p = folds[:, -1]
+        self.fold_y = folds[:, :-1]
+        
+        hopfs = np.array(hopfs).reshape(-1, n + 2)
+        self.hopf_p = hopfs[:, -2]
+        self.hopf_y = hopfs[:, :-2]
+        self.hopf_omega = hopfs[:, -1]
+
+def _hopf_test(eigenvalues):
+    """
+    Largest real part of the complex eigenvalues and the corresponding
+    imaginary part, (nan, nan) if all eigenvalues are real
+    """
+    pair = eigenvalues[np.abs(eigenvalues.imag) > 1e-12]
+    if (pair.size == 0):
+        return np.nan, np.nan
+    i = pair.real.argmax()
+    return pair.real[i], abs(pair.imag[i])
+
+def continuation(system, p_range, setter = None, i_app = 0, direction = None,
+                 y_guess = None, ds = 0.05, ds_max = 0.5, max_steps = 2000,
+                 tol = 1e-9, v_bound = 200):
+    """
+    Trace the equilibrium branch of a neuron or network by pseudo-arclength
+    continuation, starting from the equilibrium at p_range[0] and stopping
+    when the parameter leaves p_range. Fold and Hopf points are located by
+    secant iterations on the test functions (parameter component of the
+    tangent, and real part of the leading complex eigenvalue pair).
+    
+    args:
+        system: Neuron or Network
+        p_range: (p_start, p_end) range of the continuation parameter
+    
+    kwargs:
+        setter: update method of an element (e.g. i1.update_a) setting the
+        continuation parameter. If None, the parameter is the applied current
+        i_app + p * direction. The element parameter is restored at the end.
+        i_app: constant applied current (scalar or one value per neuron)
+        direction: direction of the applied current change for networks,
+        e.g. ones for a uniform current (default) or a single neuron's unit
+        vector
+        y_guess: initial state guess of the starting equilibrium
+        ds, ds_max: initial and maximum arclength step
+        max_steps: maximum number of continuation steps
+        tol: Newton corrector tolerance
+        v_bound: the continuation stops when a membrane voltage exceeds
+        v_bound in magnitude
+    
+    Returns a Branch
+    """
+    index = system.membrane_index()
+    if (direction is None):
+        direction = 1 if isinstance(system, Neuron) else np.ones(index.size)
+    direction = np.asarray(direction, dtype = float)
+    i_app = np.asarray(i_app, dtype = float)
+    
+    restore = None
+    if (setter is not None):
+        element = setter.__self__
+        attribute = setter.__name__[len('update_'):]
+        restore = getattr(element, attribute)
+    
+    def current(p):
+        return i_app + p * direction if (setter is None) else i_app
+    
+    def F(z):
+        if (setter is not None):
+            setter(z[-1])
+        return system.sys(current(z[-1]), z[:-1])
+    
+    def Fx(z):
+        if (setter is not None):
+            setter(z[-1])
+        J = system.jac(current(z[-1]), z[:-1])
+        return J.toarray() if issparse(J) else J
+    
+    def Fp(z):
+        h = 1e-6 * max(1, abs(z[-1]))
+        zp, zm = z.copy(), z.copy()
+        zp[-1] += h
+        zm[-1] -= h
+        return (F(zp) - F(zm)) / (2 * h)
+    
+    def tangent(z, t_prev):
+        A = np.column_stack((Fx(z), Fp(z)))
+        # Null vector of [Fx Fp] from the last right singular vector
+        t = np.linalg.svd(A)[2][-1]
+        if (t_prev is None):
+            return t if t[-1] * (p_range[1] - p_range[0]) >= 0 else -t
+        return t if t @ t_prev >= 0 else -t
+    
+    def correct(z, t, s):
+        """
+        Newton corrector on the hyperplane orthogonal to t at z + s * t
+        Returns the corrected point and the number of iterations
+        """
+        z_pred = z + s * t
+        z_new = z_pred.copy()
+        for iteration in range(10):
+            A = np.vstack((np.column_stack((Fx(z_new), Fp(z_new))), t))
+            r = np.append(F(z_new), t @ (z_new - z_pred))
+            dz = np.linalg.solve(A, -r)
+            z_new = z_new + dz
+            if (np.abs(dz).max() < tol * max(1, np.abs(z_new).max())):
+                return z_new, iteration
+        return None, iteration
+    
+    def locate(z, t, s, g0, g1, test):
+        """
+        Secant iterations for the zero of test along the step of size s
+        """
+        s0, s1 = 0, s
+        z_zero = None
+        for _ in range(6):
+            if (g1 == g0):
+                break
+            s_new = s1 - g1 * (s1 - s0) / (g1 - g0)
+            z_zero, _ = correct(z, t, s_new)
+            if (z_zero is None):
+                break
+            s0, g0 = s1, g1
+            s1, g1 = s_new, test(z_zero)
+            if (abs(g1) < 1e-10):
+                break
+        return z_zero
+    
+    def fold_test(z):
+        return tangent(z, t)[-1]
+    
+    def hopf_test(z):
+        return _hopf_test(np.linalg.eigvals(Fx(z)))[0]
+    
+    try:
+        # Starting equilibrium
+        p0 = p_range[0]
+        if (setter is not None):
+            setter(p0)
+        eq = system.equilibrium(current(p0), y_guess)
+        if (eq is None):
+            raise ValueError("No equilibrium found at p = %s" % p0)
+        
+        z = np.append(eq.y, p0)
+        t = tangent(z, None)
+        ev = np.linalg.eigvals(Fx(z))
+        p_list, y_list, ev_list = [z[-1]], [z[:-1]], [ev]
+        folds, hopfs = [], []
+        p_min, p_max = min(p_range), max(p_range)
+        
+        for _ in range(max_steps):
+            if not (p_min <= z[-1] <= p_max):
+                break
+            if (np.abs(z[index]).max() > v_bound):
+                break
+            
+            # Predictor-corrector step, reducing ds until Newton converges
+            z_new, iterations = correct(z, t, ds)
+            while (z_new is None):
+                ds = ds / 2
+                if (ds < 1e-8):
+                    raise ValueError("Continuation failed at p = %s" % z[-1])
+                z_new, iterations = correct(z, t, ds)
+            t_new = tangent(z_new, t)
+            ev_new = np.linalg.eigvals(Fx(z_new))
+            
+            # Fold: the parameter component of the tangent changes sign
+            if (t[-1] * t_new[-1] < 0):
+                z_fold = locate(z, t, ds, t[-1], t_new[-1], fold_test)
+                if (z_fold is not None):
+                    folds.append(z_fold)
+            
+            # Hopf: a complex pair crosses the imaginary axis
+            re0, _ = _hopf_test(ev)
+            re1, _ = _hopf_test(ev_new)
+            if (re0 * re1 < 0):
+                z_hopf = locate(z, t, ds, re0, re1, hopf_test)
+                if (z_hopf is not None):
+                    omega = _hopf_test(np.linalg.eigvals(Fx(z_hopf)))[1]
+                    hopfs.append(np.append(z_hopf, omega))
+            
+            z, t, ev = z_new, t_new, ev_new
+            p_list.append(z[-1])
+            y_list.append(z[:-1])
+            ev_list.append(ev)
+            if (iterations < 3):
+                ds = min(ds * 1.3, ds_max)
+    finally:
+        if (restore is not None):
+            setter(restore)
+    
+    return Branch(system, p_list, y_list, ev_list, folds, hopfs)
@@ -0,0 +1,226 @@
+"""
+Ensembles of neurons or networks with identical structure, differing only in
+their parameters and/or initial conditions. All members are integrated
+simultaneously as a single (ensemble, state) array.
+
+@author: Luka
+"""
+
+import copy
+import numpy as np
+from scipy.optimize import OptimizeResult
+
+from neuron_model import Neuron, NeuronArrays
+
+class Ensemble():
+    """
+    Batch of copies of a template neuron or network
+    
+    args:
+        system: template Neuron or Network (left unmodified)
+        params: dictionary {update_method: values}, where update_method is an
+        update method of an element of the template (e.g. i1.update_a) and
+        values contains one parameter value per ensemble member
+        y0: initial conditions, either a single state vector shared by all
+        members or an (ensemble, state) array
+        size: ensemble size, only needed if neither params nor y0 define it
+    
+    methods:
+        sys: f(i_app, Y) -> dY/dt for all members
+        simulate: integrate all members over trange
+    
+    i_app values are broadcast against (ensemble,) for neurons and against
+    (ensemble, neurons) for networks.
+    """
+    
+    def __init__(self, system, params = {}, y0 = None, size = None):
+        self.system = system
+        
+        # Work on a copy so that the template is left untouched
+        memo = {}
+        working = copy.deepcopy(system, memo)
+        
+        updates = []
+        for method, values in params.items():
+            element = getattr(method, '__self__', None)
+            if (id(element) not in memo):
+                raise ValueError("%s is not an update method of an element of "
+                                 "the template" % method)
+            updates.append((getattr(memo[id(element)], method.__name__),
+                            np.asarray(values, dtype = float)))
+        
+        sizes = {values.size for _, values in updates}
+        if (y0 is not None) and (np.ndim(y0) == 2):
+            sizes.add(len(y0))
+        if (size is not None):
+            sizes.add(size)
+        if (len(sizes) != 1):
+            raise ValueError("Ensemble size is undefined or inconsistent")
+        self.size = sizes.pop()
+        
+        if isinstance(working, Neuron):
+            neurons = [working]
+        else:
+            neurons = working.neurons
+        
+        # Compile the arrays of every member and stack them
+        member_arrays = []
+        for m in range(self.size):
+            for method, values in updates:
+                method(values[m])
+            member_arrays.append([neuron.get_arrays() for neuron in neurons])
+        self.arrays = [NeuronArrays.stack(list(arrays))
+                       for arrays in zip(*member_arrays)]
+        
+        if (y0 is None):
+            y0 = system.get_init_conditions()
+        self.y0 = np.array(np.broadcast_to(np.asarray(y0, dtype = float),
+                                           (self.size, len(system.y0))))
+    
+    def sys(self, i_app, Y):
+        """
+        Returns the update of the (ensemble, state) array Y
+        """
+        if isinstance(self.system, Neuron):
+            return self.arrays[0].sys(i_app, Y)
+        
+        network = self.system
+        dY = np.empty(Y.shape)
+        i_external = np.asarray(i_app) + network.i_syn(Y)
+        for i, (arrays, sl) in enumerate(zip(self.arrays, network.slices)):
+            arrays.sys(i_external[..., i], Y[..., sl], out = dY[..., sl])
+        
+        return dY
+    
+    def simulate(self, trange, i_app, method = "RK4", dt = 1, t_eval = None,
+                 rtol = 1e-3, atol = 1e-6):
+        """
+        Integrate all members over trange
+        
+        method:
+            Euler, RK4, ExpEuler: fixed step dt, shared by all members
+            RK23: adaptive Bogacki-Shampine steps with an individual step size
+            and error control for every member. i_app is called with the array
+            of member times
+        
+        t_eval: output times, by default every step for the fixed-step
+        methods and 1001 equidistant points for RK23
+        
+        Returns the solution with t of shape (time,) and y of shape
+        (ensemble, state, time)
+        """
+        def odesys(t, Y):
+            return self.sys(i_app(t), Y)
+        
+        step, n_calls = self.system._fixed_step_method(method)
+        
+        if (step is not None):
+            return self._fixed_step(step, n_calls, odesys, trange, dt, t_eval)
+        elif (method == "RK23"):
+            if (t_eval is None):
+                t_eval = np.linspace(trange[0], trange[1], 1001)
+            return self._adaptive(odesys, trange, t_eval, rtol, atol)
+        else:
+            raise ValueError("Undefined solver")
+    
+    def _fixed_step(self, step, n_calls, odesys, trange, dt, t_eval):
+        t0, t1 = trange
+        n_steps = int(np.ceil((t1 - t0) / dt - 1e-9))
+        t = np.minimum(t0 + dt * np.arange(n_steps + 1, dtype = float), t1)
+        
+        Y = self.y0.copy()
+        if (t_eval is None):
+            out = np.empty((n_steps + 1,) + Y.shape)
+            out[0] = Y
+            for k in range(n_steps):
+                Y = step(odesys, t[k], Y, t[k+1] - t[k])
+                out[k+1] = Y
+            t_out = t
+        else:
+            # Linear interpolation between steps onto t_eval
+            t_out = np.asarray(t_eval, dtype = float)
+            out = np.empty((t_out.size,) + Y.shape)
+            j = 0
+            for k in range(n_steps):
+                Y_next = step(odesys, t[k], Y, t[k+1] - t[k])
+                while (j < t_out.size) and (t_out[j] <= t[k+1]):
+                    s = (t_out[j] - t[k]) / (t[k+1] - t[k])
+                    out[j] = (1 - s) * Y + s * Y_next
+                    j += 1
+                Y = Y_next
+            out = out[:j]
+            t_out = t_out[:j]
+        
+        return OptimizeResult(t = t_out, y = out.transpose(1, 2, 0),
+                              nfev = n_steps * n_calls,
+                              status = 0, message = "Success",
+                              success = True)
+    
+    def _adaptive(self, odesys, trange, t_eval, rtol, atol):
+        t0, t1 = trange
+        t_eval = np.asarray(t_eval, dtype = float)
+        m = self.size
+        
+        Y = self.y0.copy()
+        T = np.full(m, float(t0))
+        F = odesys(T, Y)
+        nfev = 1
+        
+        # Initial step sizes
+        scale = atol + np.abs(Y) * rtol
+        d0 = np.sqrt(np.mean((Y / scale)**2, axis = -1))
+        d1 = np.sqrt(np.mean((F / scale)**2, axis = -1))
+        H = np.where((d0 < 1e-5) | (d1 < 1e-5), 1e-6, 0.01 * d0 / d1)
+        H = np.minimum(H, t1 - t0)
+        
+        out = np.empty((t_eval.size, m, Y.shape[1]))
+        j0 = np.searchsorted(t_eval, t0, side = 'right')
+        out[:j0] = Y
+        j = np.full(m, j0) # Next output index of every member
+        
+        members = np.arange(m)
+        active = T < t1
+        while active.any():
+            H = np.where(active, np.minimum(H, t1 - T), 0)
+            h = H[:, None]
+            
+            # Bogacki-Shampine stages
+            K2 = odesys(T + H/2, Y + h/2 * F)
+            K3 = odesys(T + 3*H/4, Y + 3*h/4 * K2)
+            Y_new = Y + h * (2/9 * F + 1/3 * K2 + 4/9 * K3)
+            F_new = odesys(T + H, Y_new)
+            nfev += 3
+            
+            err = h * (5/72 * F - 1/12 * K2 - 1/9 * K3 + 1/8 * F_new)
+            scale = atol + np.maximum(np.abs(Y), np.abs(Y_new)) * rtol
+            err_norm = np.sqrt(np.mean((err / scale)**2, axis = -1))
+            
+            accept = active & (err_norm < 1)
+            factor = 0.9 * np.where(err_norm > 0, err_norm, 1e-10)**(-1/3)
+            factor = np.where(accept, np.clip(factor, 0.2, 10),
+                              np.clip(factor, 0.2, 1))
+            
+            # Interpolate accepted steps onto t_eval (cubic Hermite)
+            T_new = T + H
+            while True:
+                idx = members[accept & (j < t_eval.size)]
+                idx = idx[t_eval[j[idx]] <= T_new[idx]]
+                if (idx.size == 0):
+                    break
+                hi = H[idx, None]
+                s = ((t_eval[j[idx]] - T[idx]) / H[idx])[:, None]
+                out[j[idx], idx] = ((1 + 2*s) * (1 - s)**2 * Y[idx] +
+                                    s * (1 - s)**2 * hi * F[idx] +
+                                    s**2 * (3 - 2*s) * Y_new[idx] +
+                                    s**2 * (s - 1) * hi * F_new[idx])
+                j[idx] += 1
+            
+            Y = np.where(accept[:, None], Y_new, Y)
+            F = np.where(accept[:, None], F_new, F)
+            T = np.where(accept, T_new, T)
+            H = H * factor
+            active = T < t1
+        
+        return OptimizeResult(t = t_eval, y = out.transpose(1, 2, 0),
+                              nfev = nfev, status = 0, message = "Success",
+                              success = True)
@@ -7,10 +7,16 @@ simulations
 """
 
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+from matplotlib.transforms import Affine2D
 from matplotlib.widgets import Slider, Button
 import numpy as np
 
-from collections import deque
+import queue
+import threading
+import time
+
+from neuron_model import region_labels, label_segments
 
 class GUI:
     """
@@ -27,12 +33,21 @@ class GUI:
         plot_fixed_point: set to True to plot the fixed point in the I_ss
         time_step: step size for the Euler solver
         ymin, ymax: voltage range for the time plot
-        sstep: wait for sstep data points before updating the time plot
+        sstep: length of the simulation chunks computed between plot updates
         tint: length of the time plot
+        rate: simulated time per second of wall-clock time
+        frame_time: wall-clock time between plot updates (s)
+        decimate: set to True to reduce the time plot to the min/max of the
+        samples in every pixel column
+    
+    While running, the simulation is advanced by a background thread in
+    chunks of sstep and the parameter updates of the sliders are queued to
+    it, so that the drawing does not slow down the simulation.
     """
     _params = {'vmin': -3, 'vmax': 3.1, 'dv': 0.1, 'i0': 0,
                'plot_fixed_point': False, 'time_step': 1,
-               'ymin': -5, 'ymax': 5, 'sstep': 100, 'tint': 5000}
+               'ymin': -5, 'ymax': 5, 'sstep': 100, 'tint': 5000,
+               'rate': 2000, 'frame_time': 0.03, 'decimate': True}
                  
     def __init__(self, system, **kwargs):
         self.__dict__.update(self._params) # Default parameters
@@ -58,6 +73,9 @@ class GUI:
         self.IV_curves = [] # list of IV curve objects
         self.IV_size = 0
         
+        # Cached IV evaluators over V for each neuron with IV curves
+        self.IV_evaluators = {}
+        
         # Initial fixed point (guess)
         self.v_rest = 0
         self.I_ss_rest = 0
@@ -77,7 +95,20 @@ class GUI:
         self.axs_iv = [] # list of IV curve axis
         self.axsim = None # simulation plot axis
         
+        # Persistent artists of the IV curve plots
+        self.IV_lines = [] # LineCollection of the segments of each IV curve
+        self.iapp_line = None # Iapp line on the last IV curve
+        self.fixed_point = None # Fixed point circle on the last IV curve
+        
         self.pause_value = False
+        
+        # Simulation thread state
+        self.running = False
+        self.updates = queue.Queue() # Parameter updates for the simulation
+        self.lock = threading.Lock() # Held while the parameters are updated
+        self.worker_error = None # Exception of the simulation thread
+        self.IV_dirty = False # Set when the IV curves need recomputing
+        self.buffer = None # RingBuffer of the time plot window
     
     def add_sim_plot(self, coords):
         self.axsim = self.fig.add_subplot(2, 3, 4)
@@ -100,59 +131,95 @@ class GUI:
                                             [self.colors[0],
                                              self.colors[self.IV_size]]))
         
+        lines = LineCollection([])
+        ax.add_collection(lines)
+        self.IV_lines.append(lines)
+        
+        # Move the Iapp line and the fixed point to the last IV curve
+        if (self.iapp_line is not None):
+            self.iapp_line.remove()
+            self.fixed_point.remove()
+        self.iapp_line, = ax.plot(self.V, np.zeros(len(self.V)), 'C2')
+        self.fixed_point, = ax.plot([], [], 'C2', marker = '.',
+                                    markersize = 10)
+        
+        if (neuron not in self.IV_evaluators):
+            self.IV_evaluators[neuron] = neuron.IV_evaluator(self.V)
+        
+        # Segments of the preceding curves may have changed
+        for iv_curve in self.IV_curves:
+            iv_curve.I = []
         self.update_IV_curves()
         
     def update_IV_curves(self):
         # Update v_rest
         self.update_fixed_point()
         
-        for idx, (iv_curve, ax) in enumerate(zip(self.IV_curves, self.axs_iv)):
-            # Update the segments
-            if (idx > 0):
-                prev_segments = self.IV_curves[idx-1].get_segments()
-            else:
-                prev_segments = []
-            
-            iv_curve.update(self.v_rest, prev_segments)    
-            
-            # Plot
-            ax.cla()
-            ax.set_xlabel('V')
-            ax.set_ylabel('I')
-            ax.set_title(iv_curve.name)
-            for s in iv_curve.segments:
-                i1 = s.start
-                i2 = s.end
-                col = s.color
+        # Evaluate all IV curves of each neuron at once
+        I_curves = {}
+        for neuron, evaluator in self.IV_evaluators.items():
+            curves = [c for c in self.IV_curves if c.neuron is neuron]
+            I = evaluator.IV([c.timescale for c in curves], self.v_rest)
+            I_curves.update(zip(map(id, curves), I))
+        
+        # Only the curves whose values changed are updated, along with the
+        # following curves as their segments depend on the preceding ones
+        changed = False
+        prev_labels = None
+        for iv_curve, ax, lines in zip(self.IV_curves, self.axs_iv,
+                                       self.IV_lines):
+            I = I_curves[id(iv_curve)]
+            changed = changed or not np.array_equal(I, iv_curve.I)
+            if changed:
+                iv_curve.update(self.v_rest, prev_labels, I = I)
+                segments = iv_curve.get_segments()
                 # Add +1 to end points to include them in the plot
-                ax.plot(self.V[i1:i2+1], iv_curve.I[i1:i2+1], col)
-                
-        # Add Iapp line to the last IV curve
-        self.axs_iv[-1].plot(self.V, np.ones(len(self.V)) * self.i_app_const,
-                   'C2')
-        # Add fixed point circle
+                lines.set_segments([np.column_stack((self.V[s.start:s.end+1],
+                                                     I[s.start:s.end+1]))
+                                    for s in segments])
+                lines.set_color([s.color for s in segments])
+                self._autoscale_IV(ax, I)
+            prev_labels = iv_curve.labels
+        
+        # Iapp line and fixed point circle on the last IV curve
+        self.iapp_line.set_ydata(np.ones(len(self.V)) * self.i_app_const)
         if (self.plot_fixed_point and (self.vmin < self.v_rest < self.vmax)):
-            self.axs_iv[-1].plot(self.v_rest,self.I_ss_rest,'C2', marker = '.',
-                   markersize = 10)
+            self.fixed_point.set_data([self.v_rest], [self.I_ss_rest])
+        else:
+            self.fixed_point.set_data([], [])
+        self._autoscale_IV(self.axs_iv[-1], self.IV_curves[-1].I)
+    
+    def _autoscale_IV(self, ax, I):
+        # Data limits of an IV curve plot, including the Iapp line
+        ax.ignore_existing_data_limits = True
+        ax.update_datalim(np.column_stack((self.V, I)))
+        if (ax is self.axs_iv[-1]):
+            ax.update_datalim([(self.V[0], self.i_app_const),
+                               (self.V[-1], self.i_app_const)])
+        ax.autoscale_view()
         
     def update_fixed_point(self):
-        I_ss = self.system.IV_ss(self.V_extended)
-        zero_crossings = np.where(np.diff(np.sign(I_ss-self.i_app_const)))[0]
-        if (zero_crossings.size != 0):
-            # Take the equilibrium nearest to the previous equilibrium
-            vdiff = abs(self.V_extended[zero_crossings] - self.v_rest)
-            index = zero_crossings[vdiff.argmin()]
-            self.v_rest = (self.V_extended[index] + self.V_extended[index+1])/2
-            self.I_ss_rest = (I_ss[index] + I_ss[index+1])/2
+        # Continue the equilibrium from the previous one, falling back to
+        # the equilibrium nearest to it on V_extended
+        eq = self.system.equilibrium_v(self.i_app_const, self.v_rest,
+                                       V = self.V_extended)
+        if (eq is not None):
+            self.v_rest = eq.v
+            self.I_ss_rest = self.i_app_const
     
     def update_iapp(self, val):
         self.i_app_const = val
         self.i_app = lambda t: val
-        self.update_IV_curves()
         
     def update_val(self, val, update_method):
-        update_method(val)
-        self.update_IV_curves()
+        # While running, the update is applied by the simulation thread
+        # between two chunks and the IV curves are recomputed at most once
+        # per frame
+        if self.running:
+            self.updates.put((update_method, val))
+        else:
+            update_method(val)
+            self.update_IV_curves()
         
     def add_slider(self, name, coords, val_min, val_max, val_init,
                    update_method, sign = 1):
@@ -183,62 +250,207 @@ class GUI:
         if (self.axsim is None):
             print("Time plot needs to be specified before running")
             return
-            
-        sstep = self.sstep
-        tint = self.tint
         
         # Get time plot background for faster replotting
         self.fig.canvas.draw()
         background = self.fig.canvas.copy_from_bbox(self.axsim.bbox)
         
-        tdata = deque()
-        ydata_list = []
+        # The lines are plotted in simulation time and shifted to the
+        # (0, tint) range by their transform
+        shift = Affine2D()
         line_list = []
         for idx in idx_list:
-            ydata = deque()
-            line, = self.axsim.plot(tdata, ydata)
+            line, = self.axsim.plot([], [], animated = True,
+                                    transform = shift + self.axsim.transData)
             line_list.append(line)
-            ydata_list.append(ydata)
-        self.axsim.set_xlim(0, tint)
+        self.axsim.set_xlim(0, self.tint)
         
         # Set the simulation solver
-        t = 0
-        self.system.set_solver("Euler", self.i_app, t, sstep,
+        self.system.set_solver("Euler", self.i_app, 0, self.sstep,
                                dt = self.time_step)
         
-        while plt.fignum_exists(self.fig.number):
-            while self.pause_value:
-                plt.pause(0.01)
-        
-            last_t = t
-            
-            while t - last_t < sstep:                
-                # Simulation step
-                t, y = self.system.step()
+        capacity = int(np.ceil(self.tint / self.time_step)) + 1
+        self.buffer = RingBuffer(capacity, len(idx_list))
+        self.worker_error = None
+        self.running = True
+        worker = threading.Thread(target = self._simulate,
+                                  args = (list(idx_list),), daemon = True)
+        worker.start()
+        
+        try:
+            while plt.fignum_exists(self.fig.number):
+                if (self.worker_error is not None):
+                    raise self.worker_error
                 
-                tdata.append(t)
-                for i, idx in enumerate(idx_list):
-                    ydata_list[i].append(y[idx])
-        
-            while tdata[-1] - tdata[0] > tint:
-                tdata.popleft()
-                for ydata in ydata_list:
-                    ydata.popleft()
-            
-            # Restore background to draw on top
-            self.fig.canvas.restore_region(background)
-            
-            # Modify time data to (0, tint) range
-            tplot = np.array(tdata)
-            tplot = tplot - tplot[0]
-            
-            # Update each plot line
-            for i, idx in enumerate(idx_list):
-                line_list[i].set_data(tplot, ydata_list[i])
-                self.axsim.draw_artist(line_list[i])
-            self.fig.canvas.blit(self.axsim.bbox)          
-            self.fig.canvas.flush_events()
+                if self.IV_dirty:
+                    self.IV_dirty = False
+                    with self.lock:
+                        self.update_IV_curves()
+                    self.fig.canvas.draw()
+                    background = self.fig.canvas.copy_from_bbox(
+                        self.axsim.bbox)
+                
+                written, t, y = self.buffer.view()
+                if (t.size > 0):
+                    if self.decimate:
+                        width = self.tint / self.axsim.bbox.width
+                        t, y = minmax_decimate(t, y, width)
+                    
+                    # Restore background to draw on top
+                    self.fig.canvas.restore_region(background)
+                    
+                    # Shift the time data to (0, tint) range and update each
+                    # plot line
+                    shift.clear().translate(-t[0], 0)
+                    for i, line in enumerate(line_list):
+                        line.set_data(t, y[i])
+                        self.axsim.draw_artist(line)
+                    
+                    # Skip the frame if the simulation thread has overwritten
+                    # the window while it was drawn
+                    if self.buffer.intact(written):
+                        self.fig.canvas.blit(self.axsim.bbox)
+                
+                # Process the interface events until the next frame
+                self.fig.canvas.start_event_loop(self.frame_time)
+        finally:
+            self.running = False
+            worker.join()
+    
+    def _simulate(self, idx_list):
+        """
+        Simulation thread: advances the system in chunks of sstep at the
+        rate given by self.rate, applying the queued parameter updates
+        between the chunks. An exception is passed to run, which raises it.
+        """
+        try:
+            n_steps = max(1, int(np.ceil(self.sstep / self.time_step)))
+            t0 = self.system.solver.t
+            wall0 = time.perf_counter()
             
+            while self.running:
+                # Only the last queued value of every parameter is applied
+                updates = {}
+                while not self.updates.empty():
+                    update_method, val = self.updates.get()
+                    updates[update_method] = val
+                if (len(updates) > 0):
+                    # The parameters are only modified by this thread, the lock
+                    # keeps them from changing while the IV curves are computed
+                    with self.lock:
+                        for update_method, val in updates.items():
+                            update_method(val)
+                    self.IV_dirty = True
+                
+                if self.pause_value:
+                    time.sleep(0.01)
+                    # Restart the wall-clock reference after the pause
+                    t0 = self.system.solver.t
+                    wall0 = time.perf_counter()
+                    continue
+                
+                t_chunk, y_chunk = self.system.steps(n_steps, idx_list)
+                self.buffer.extend(t_chunk, y_chunk)
+                t = t_chunk[-1]
+                
+                # Keep the real-time factor, restarting the reference if the
+                # simulation falls behind
+                delay = wall0 + (t - t0) / self.rate - time.perf_counter()
+                if (delay > 0):
+                    time.sleep(delay)
+                elif (delay < -0.5):
+                    t0 = t
+                    wall0 = time.perf_counter()
+        except Exception as error:
+            self.worker_error = error
+
+class RingBuffer():
+    """
+    Lock-free circular buffer of the latest samples of several traces, with
+    a single writer thread and a single reader thread. The ring has room for
+    two windows and is written twice, so that every window of the latest
+    samples is a contiguous view.
+    
+    args:
+        capacity: number of samples in the window
+        n_traces: number of traces
+    
+    methods:
+        extend: append a chunk of samples (writer)
+        view: (written, t, y) views of the window in time order, with y of
+        shape (n_traces, samples) (reader)
+        intact: check that a view has not been overwritten (reader)
+    
+    The writer publishes the number of samples written after every chunk
+    (written), and the number of samples written once the current chunk is
+    complete before writing it (writing). The samples of a view are only
+    overwritten once the writer has started a full window of newer samples,
+    which the reader checks with intact after using the view.
+    """
+    def __init__(self, capacity, n_traces):
+        self.capacity = capacity
+        self.size = 2 * capacity # Samples in the ring
+        self.t = np.empty(2 * self.size)
+        self.y = np.empty((n_traces, 2 * self.size))
+        self.written = 0 # Samples written
+        self.writing = 0 # Samples written after the current chunk
+    
+    def extend(self, t, y):
+        """
+        t: sample times (k,)
+        y: trace values (n_traces, k)
+        """
+        self.writing = self.written + t.size
+        t = t[-self.capacity:]
+        y = y[:, -self.capacity:]
+        index = (self.writing - t.size + np.arange(t.size)) % self.size
+        for i in (index, index + self.size):
+            self.y[:, i] = y
+            self.t[i] = t
+        self.written = self.writing
+    
+    def view(self):
+        written = self.written
+        count = min(written, self.capacity)
+        start = (written - count) % self.size
+        return (written, self.t[start:start+count],
+                self.y[:, start:start+count])
+    
+    def intact(self, written):
+        """
+        Returns True if the view returned with written is unchanged
+        """
+        return (self.writing - written <= self.capacity)
+
+def minmax_decimate(t, y, width):
+    """
+    Reduces the samples of the traces y (n_traces, samples) to the minimum
+    and maximum within each time bin [k * width, (k + 1) * width), so that
+    the plotted envelope is unchanged at a resolution of one pixel per
+    width. The bins are fixed in time, so that the envelope of a bin does
+    not change once all its samples are plotted.
+    
+    Returns the times and values of the first and last sample of every bin
+    """
+    if (t.size == 0):
+        return t, y
+    
+    k0, k1 = np.floor(t[0] / width), np.floor(t[-1] / width)
+    if (t.size < 3 * (k1 - k0 + 1)):
+        return t, y
+    
+    # First sample of every non-empty bin
+    edges = np.arange(k0 + 1, k1 + 1) * width
+    start = np.unique(np.append(0, np.searchsorted(t, edges)))
+    start = start[start < t.size]
+    stop = np.append(start[1:], t.size)
+    
+    t_out = np.stack((t[start], t[stop - 1]), axis = 1).ravel()
+    y_out = np.stack((np.minimum.reduceat(y, start, axis = 1),
+                      np.maximum.reduceat(y, start, axis = 1)),
+                     axis = 2).reshape(y.shape[0], -1)
+    return t_out, y_out
+
 class IV_curve:
     """
     IV curve class with added functionality of finding regions of negative
@@ -252,11 +464,16 @@ class IV_curve:
         cols: coloring scheme -> cols[0] = positive conductance
                               -> cols[1] = negative conductance
     methods:
-        update: calculate segments used for plotting, by inserting negative
-        conductance segments into the segments of the preceeding IV curve
-        (prev_segments)
-        If IV curve corresponds to the fastest timescale no prev_segments are
+        update: calculate the colors of the curve, by coloring the negative
+        conductance regions over the colors of the preceeding IV curve
+        (prev_labels)
+        If IV curve corresponds to the fastest timescale no prev_labels are
         passed
+        If the IV curve values I are passed, they are not recalculated
+        get_segments: segments of constant color used for plotting
+    
+    attributes:
+        labels: color of each interval V[k], V[k+1]
     """
     class Segment():
         """
@@ -278,67 +495,30 @@ class IV_curve:
         self.V = V
         self.I = []
         self.cols = cols
-        self.segments = []
+        self.labels = np.full(V.size - 1, cols[0])
                         
-    def update(self, vrest, prev_segments = []):
-        # If no preceeding IV curves, put [Vmin, Vmax] as prev_segment
-        if (prev_segments == []):
-            prev_segments = [self.Segment(0, self.V.size-1, self.cols[0])]
-        
-        self.I = self.neuron.IV(self.V, self.timescale, vrest)
-        
-        col = self.cols[1] # color for -ve conductance
-        
-        # Find regions of -ve conductance
-        dIdV = np.diff(self.I)
-        indices = np.where(np.diff(np.sign(dIdV)) != 0)
-        indices = indices[0] + 1 # +1 for the correct max/min points
-        indices = np.append(indices, self.V.size) # add ending point
-        
-        slope = dIdV[0] < 0 # True if initial slope -ve
-        
-        prev = 0
-        
-        new_segments = []
-        
-        # Get regions of -ve conductance
-        for i in np.nditer(indices):
-            # If region of -ve conductance
-            if slope:
-                new_segments.append(self.Segment(prev, i, col))
-            slope = not(slope) # Sign changes after every point in indices
-            prev = i
-            
-        # Insert new segments
-        for new_segment in new_segments:
-            # Find which prev_segments containt new_segment start and end
-            for idx, prev_segment in enumerate(prev_segments):
-                if (prev_segment.start <= new_segment.start
-                    <= prev_segment.end):
-                    idx1 = idx
-                    col1 = prev_segment.color
-                    start1 = prev_segment.start
-                if (prev_segment.start <= new_segment.end <= prev_segment.end):
-                    idx2 = idx
-                    col3 = prev_segment.color
-                    end3 = prev_segment.end
-            
-            # Delete the old segments between idx1 and idx2
-            del prev_segments[idx1:idx2+1]
-            
-            # start and end variables of new segments to insert
-            end1 = new_segment.start
-            start3 = new_segment.end
-            
-            # Insert new segments
-            prev_segments.insert(idx1, self.Segment(start3, end3, col3))
-            prev_segments.insert(idx1, new_segment)
-            prev_segments.insert(idx1, self.Segment(start1, end1, col1))
-                
-        self.segments = prev_segments
-        
+    def update(self, vrest, prev_labels = None, I = None):
+        # If no preceeding IV curves, the whole curve has positive
+        # conductance color
+        if (prev_labels is None):
+            prev_labels = np.full(self.V.size - 1, self.cols[0])
+        
+        if (I is None):
+            I = self.neuron.IV(self.V, self.timescale, vrest)
+        self.I = I
+        
+        # Color the regions of -ve conductance
+        self.labels = region_labels(self.I, prev_labels, self.cols[1])
+        
+    @property
+    def segments(self):
+        return self.get_segments()
+    
     def get_segments(self):
-        return self.segments
+        # Run-length encoding of the interval colors
+        starts, ends, colors = label_segments(self.labels)
+        return [self.Segment(start, end, color)
+                for start, end, color in zip(starts, ends, colors)]
     
     def get_I(self):
-        return self.I
\ No newline at end of file
+        return self.I
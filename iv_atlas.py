@@ -0,0 +1,331 @@
+"""
+Headless computation of the I-V curves of batches of neurons, with the
+negative conductance regions labelled as in the graphical interface, saved
+as a compact array dataset and/or rendered to images with the Agg backend
+
+@author: Luka
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
+
+from neuron_model import region_labels, label_segments
+from population import Population
+
+# Colors of the region labels: label 0 is positive conductance, label k is
+# negative conductance in the k-th timescale (as in the GUI)
+COLORS = ['C0', 'C3', 'C1', 'C6']
+
+def _rest_voltages(arrays, i_app, V, v_guess = 0):
+    """
+    Equilibrium voltages IV_ss(v) = i_app of a batch of neurons given by the
+    stacked arrays: Newton iterations from v_guess, falling back to the
+    root nearest to v_guess bracketed on the grid V (nan if there is none)
+    """
+    n_states = len(arrays.tau) + 1
+    def IV_ss(v):
+        return arrays.i_sum(np.repeat(v[..., None], n_states, axis = -1))
+    
+    v = np.full(np.shape(i_app), float(v_guess))
+    for _ in range(50):
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            v = v - (IV_ss(v) - i_app) / arrays.dIV_ss(v)
+    converged = np.abs(IV_ss(v) - i_app) < 1e-9
+    converged &= (V[0] <= v) & (v <= V[-1])
+    if converged.all():
+        return v
+    
+    # Roots bracketed on the grid, refined by linear interpolation
+    f = IV_ss(V[:, None] + np.zeros(v.shape)) - i_app
+    k, member = np.nonzero(f[:-1] * f[1:] <= 0)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        s = np.where(f[k, member] == f[k+1, member], 0,
+                     f[k, member] / (f[k, member] - f[k+1, member]))
+    roots = V[k] + s * (V[k+1] - V[k])
+    
+    fallback = np.full(v.shape, np.nan)
+    distance = np.full(v.shape, np.inf)
+    for m, root in zip(member, roots):
+        if (abs(root - v_guess) < distance[m]):
+            fallback[m] = root
+            distance[m] = abs(root - v_guess)
+    return np.where(converged, v, fallback)
+
+class IVBatch():
+    """
+    I-V curves of a batch of neurons with identical structure
+    
+    attributes:
+        V: voltage range of the curves
+        timescales: timescales of the curves
+        I: IV curves, shape (neurons, timescales, len(V))
+        labels: region label of every interval V[k], V[k+1], shape
+        (neurons, timescales, len(V) - 1), see COLORS
+        v_rest: equilibrium voltage of each neuron (nan if none in V)
+        i_app: applied current of each neuron
+        param_names, params: names of the varied parameters and their values,
+        shape (neurons, parameters)
+    
+    methods:
+        save: write the batch to a compressed .npz file
+        load: read a batch written by save (classmethod)
+        concatenate: combine batches of the same IV curves (classmethod)
+        render: draw the IV curves of a neuron to an image file
+    """
+    
+    _fields = ('V', 'timescales', 'I', 'labels', 'v_rest', 'i_app',
+               'param_names', 'params')
+    
+    def __init__(self, V, timescales, I, labels, v_rest, i_app, param_names,
+                 params):
+        self.V = V
+        self.timescales = timescales
+        self.I = I
+        self.labels = labels
+        self.v_rest = v_rest
+        self.i_app = i_app
+        self.param_names = param_names
+        self.params = params
+    
+    def __len__(self):
+        return len(self.I)
+    
+    def save(self, path):
+        np.savez_compressed(path, **{name: getattr(self, name)
+                                     for name in self._fields})
+    
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(*(data[name] for name in cls._fields))
+    
+    @classmethod
+    def concatenate(cls, batches):
+        batches = list(batches)
+        first = batches[0]
+        return cls(first.V, first.timescales,
+                   np.concatenate([b.I for b in batches]),
+                   np.concatenate([b.labels for b in batches]),
+                   np.concatenate([b.v_rest for b in batches]),
+                   np.concatenate([b.i_app for b in batches]),
+                   first.param_names,
+                   np.concatenate([b.params for b in batches]))
+    
+    def render(self, index, path, names = None, figsize = (9, 2.6),
+               dpi = 100):
+        """
+        Draws the IV curves of neuron index side by side, as in the GUI, and
+        saves the image to path (format given by the file extension)
+        
+        kwargs:
+            names: titles of the IV curves
+        """
+        renderer = IVRenderer(self.V, len(self.timescales), names, figsize,
+                              dpi)
+        renderer.draw(self, index, path)
+
+class IVRenderer():
+    """
+    Agg figure with one plot per IV curve, whose artists are reused for
+    drawing the IV curves of many neurons
+    
+    args:
+        V: voltage range of the curves
+        n: number of IV curves
+        names: titles of the IV curves (None for no titles)
+        figsize, dpi: figure size and resolution
+    
+    methods:
+        draw: draw the IV curves of a neuron of an IVBatch and save the image
+    """
+    
+    def __init__(self, V, n, names = None, figsize = (9, 2.6), dpi = 100):
+        self.V = V
+        self.fig = Figure(figsize = figsize, dpi = dpi)
+        FigureCanvasAgg(self.fig)
+        # Fixed layout, as tight_layout would be recomputed for every image
+        self.fig.subplots_adjust(left = 0.07, right = 0.98, bottom = 0.18,
+                                 top = 0.88, wspace = 0.35)
+        
+        self.axs = self.fig.subplots(1, n, squeeze = False)[0]
+        self.lines = []
+        for j, ax in enumerate(self.axs):
+            ax.set_xlabel('V')
+            ax.set_ylabel('I')
+            if (names is not None):
+                ax.set_title(names[j])
+            lines = LineCollection([])
+            ax.add_collection(lines)
+            self.lines.append(lines)
+        
+        # Iapp line and fixed point on the last IV curve
+        self.iapp_line, = self.axs[-1].plot(V, np.zeros(V.size), 'C2')
+        self.fixed_point, = self.axs[-1].plot([], [], 'C2', marker = '.',
+                                              markersize = 10)
+    
+    def draw(self, batch, index, path):
+        i_app = batch.i_app[index]
+        v_rest = batch.v_rest[index]
+        for ax, lines, I, labels in zip(self.axs, self.lines, batch.I[index],
+                                        batch.labels[index]):
+            starts, ends, labels = label_segments(labels)
+            # Add +1 to end points to include them in the plot
+            lines.set_segments([np.column_stack((self.V[a:b+1], I[a:b+1]))
+                                for a, b in zip(starts, ends)])
+            lines.set_color([COLORS[label] for label in labels])
+            ax.ignore_existing_data_limits = True
+            ax.update_datalim(np.column_stack((self.V, I)))
+        
+        self.iapp_line.set_ydata(np.full(self.V.size, i_app))
+        self.axs[-1].update_datalim([(self.V[0], i_app), (self.V[-1], i_app)])
+        if np.isfinite(v_rest):
+            self.fixed_point.set_data([v_rest], [i_app])
+        else:
+            self.fixed_point.set_data([], [])
+        
+        for ax in self.axs:
+            ax.autoscale_view()
+        self.fig.savefig(path)
+
+def iv_batch(template, timescales, params = {}, i_app = 0, V = None,
+             size = None):
+    """
+    Computes the IV curves in the given timescales of a batch of copies of
+    template that differ in their parameters, with one vectorized evaluation
+    for the whole batch
+    
+    args:
+        template: Neuron defining the elements of every neuron
+        timescales: timescales of the IV curves, fastest first
+    
+    kwargs:
+        params: dictionary {update_method: values} of the varied parameters,
+        where update_method is an update method of an element of the template
+        (e.g. i1.update_a) and values contains one value per neuron
+        i_app: applied current, scalar or one value per neuron
+        V: voltage range (default as in the GUI, np.arange(-3, 3.1, 0.1))
+        size: number of neurons, only needed if params is empty
+    
+    The IV curves are evaluated around the equilibrium nearest to 0 and the
+    region labels are combined from the fastest to the slowest timescale.
+    
+    Returns an IVBatch
+    """
+    if (V is None):
+        V = np.arange(-3, 3.1, 0.1)
+    V = np.asarray(V, dtype = float)
+    sizes = {len(values) for values in params.values()}
+    if (size is not None):
+        sizes.add(size)
+    if (len(sizes) != 1):
+        raise ValueError("Batch size is undefined or inconsistent")
+    N = sizes.pop()
+    
+    population = Population(template, N, params = params)
+    arrays = population.arrays
+    i_app = np.asarray(i_app, dtype = float) + np.zeros(N)
+    
+    # Equilibria, on the extended voltage range used by the GUI
+    vrange = V[-1] - V[0]
+    V_extended = np.arange(V[0] - vrange / 2, V[-1] + vrange / 2,
+                           V[1] - V[0])
+    v_rest = _rest_voltages(arrays, i_app, V_extended)
+    
+    # Filters faster than the IV curve timescale follow V, slower filters
+    # stay at v_rest: states of shape (timescale, V, neuron, filter)
+    taus = np.asarray(timescales, dtype = float)
+    fast = np.array(template.timescales) <= taus[:, None]
+    y = np.where(fast[:, None, None, :], V[:, None, None],
+                 v_rest[:, None])
+    I = np.moveaxis(arrays.i_sum(y), -1, 0) # (neuron, timescale, V)
+    
+    labels = np.zeros(I.shape[:-1] + (V.size - 1,), dtype = np.uint8)
+    prev = 0
+    for j in range(len(taus)):
+        labels[:, j] = region_labels(I[:, j], prev, j + 1)
+        prev = labels[:, j]
+    
+    param_names = np.array([_param_name(template, method)
+                            for method in params], dtype = str)
+    values = np.array([np.asarray(v, dtype = float) for v in params.values()])
+    return IVBatch(V, taus, I, labels, v_rest, i_app, param_names,
+                   values.T.reshape(N, len(params)))
+
+def _param_name(neuron, method):
+    element = method.__self__
+    name = method.__name__[len('update_'):]
+    for i, el in enumerate(neuron.elements):
+        if (el is element):
+            return "elements[%d].%s" % (i, name)
+        for j, x in enumerate(getattr(el, 'gates', [])):
+            if (x is element):
+                return "elements[%d].gates[%d].%s" % (i, j, name)
+    raise ValueError("%s is not an element of the template" % element)
+
+def _atlas_chunk(template, timescales, params, i_app, V, start, stop,
+                 image_dir, names):
+    """
+    Worker task: compute the neurons start:stop of the atlas and render
+    their images
+    """
+    batch = iv_batch(template, timescales,
+                     {method: values[start:stop]
+                      for method, values in params.items()},
+                     i_app[start:stop], V, size = stop - start)
+    if (image_dir is not None):
+        renderer = IVRenderer(batch.V, len(batch.timescales), names)
+        for k in range(len(batch)):
+            renderer.draw(batch, k, os.path.join(image_dir, "iv_%06d.png"
+                                                 % (start + k)))
+    return start, batch
+
+def iv_atlas(template, timescales, params, i_app = 0, V = None, path = None,
+             image_dir = None, names = None, max_workers = None,
+             chunksize = 1000):
+    """
+    Computes the IV curves of a large batch of neurons in a pool of worker
+    processes, optionally rendering an image per neuron
+    
+    args:
+        template, timescales, params: as for iv_batch, the template and the
+        update methods need to be picklable together
+    
+    kwargs:
+        i_app, V: as for iv_batch
+        path: .npz file where the IVBatch is saved
+        image_dir: directory of the images iv_<index>.png, no images are
+        rendered if None
+        names: titles of the IV curves in the images
+        max_workers: number of worker processes (os.cpu_count() by default),
+        with max_workers = 1 the batch is computed in the calling process
+        chunksize: number of neurons per task
+    
+    Returns the IVBatch of all neurons
+    """
+    params = {method: np.asarray(values, dtype = float)
+              for method, values in params.items()}
+    N = len(next(iter(params.values())))
+    i_app = np.asarray(i_app, dtype = float) + np.zeros(N)
+    if (image_dir is not None):
+        os.makedirs(image_dir, exist_ok = True)
+    
+    tasks = [(template, timescales, params, i_app, V, start,
+              min(start + chunksize, N), image_dir, names)
+             for start in range(0, N, chunksize)]
+    
+    if (max_workers == 1):
+        results = [_atlas_chunk(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers) as executor:
+            results = list(executor.map(_atlas_chunk, *zip(*tasks)))
+    
+    batch = IVBatch.concatenate(batch for _, batch in sorted(
+        results, key = lambda result: result[0]))
+    if (path is not None):
+        batch.save(path)
+    return batch
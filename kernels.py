@@ -0,0 +1,336 @@
+"""
+Optional compiled backend: the state vector update of a neuron or network is
+evaluated by a single fused loop over its elements and synapses, and the
+fixed-step methods are iterated entirely in compiled code. Requires Numba,
+without it the systems use their NumPy implementation.
+
+@author: Luka
+"""
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+if (numba is not None):
+    jit = numba.njit(cache = True)
+else:
+    def jit(f):
+        return f
+
+def available():
+    """
+    True if the compiled backend can be used
+    """
+    return (numba is not None)
+
+@jit
+def _rhs(i_ext, y, params, out):
+    """
+    State vector update of a network of neurons with the parameters packed
+    by Kernel.params, written into out
+    """
+    (C, v_index, filt_index, filt_source, filt_tau,
+     cur_post, cur_state, cur_a, cur_voff, g_leak, gE_leak,
+     cond_post, cond_g, cond_E, gate_start, gate_state, gate_k, gate_voff,
+     syn_post, syn_pre, syn_w, syn_k, syn_voff, syn_E, syn_cond,
+     L_indptr, L_indices, L_data) = params
+    
+    # The total currents into the neurons are summed in out
+    n = v_index.size
+    for m in range(n):
+        V = y[v_index[m]]
+        out[v_index[m]] = i_ext[m] - (g_leak[m] * V - gE_leak[m])
+    
+    # Current elements a * tanh(Vx - voff)
+    for e in range(cur_a.size):
+        out[v_index[cur_post[e]]] -= cur_a[e] * np.tanh(y[cur_state[e]] -
+                                                        cur_voff[e])
+    
+    # Conductance elements g_max * (V - E_rev) * x1 * ... * xn
+    for c in range(cond_g.size):
+        P = 1.0
+        for g in range(gate_start[c], gate_start[c+1]):
+            P *= 1 / (1 + np.exp(-gate_k[g] * (y[gate_state[g]] -
+                                               gate_voff[g])))
+        m = cond_post[c]
+        out[v_index[m]] -= cond_g[c] * (y[v_index[m]] - cond_E[c]) * P
+    
+    # Synapses w * S(k * (Vpre - voff)) [* (Vpost - E_rev)]
+    for s in range(syn_w.size):
+        m = syn_post[s]
+        x = 1 / (1 + np.exp(-syn_k[s] * (y[syn_pre[s]] - syn_voff[s])))
+        if syn_cond[s]:
+            x *= y[v_index[m]] - syn_E[s]
+        out[v_index[m]] += syn_w[s] * x
+    
+    # Resistive connections -L @ V
+    for m in range(n):
+        for p in range(L_indptr[m], L_indptr[m+1]):
+            out[v_index[m]] -= L_data[p] * y[v_index[L_indices[p]]]
+    
+    for m in range(n):
+        out[v_index[m]] /= C[m]
+    for f in range(filt_index.size):
+        i = filt_index[f]
+        out[i] = (y[filt_source[f]] - y[i]) / filt_tau[f]
+
+@jit
+def _euler_loop(y, dt, i_values, record, first, skip, params, out):
+    """
+    Euler steps of size dt[k] with the applied currents i_values[k, 0],
+    recording y[record] into out after the steps first, first + skip, ...
+    """
+    dy = np.empty(y.size)
+    for k in range(dt.size):
+        _rhs(i_values[k, 0], y, params, dy)
+        for j in range(y.size):
+            y[j] += dt[k] * dy[j]
+        if (k >= first) and ((k - first) % skip == 0):
+            for r in range(record.size):
+                out[(k - first) // skip, r] = y[record[r]]
+
+@jit
+def _rk4_loop(y, dt, i_values, record, first, skip, params, out):
+    """
+    Classical Runge-Kutta steps of size dt[k] with the applied currents
+    i_values[k] at the step start, midpoint and end, recording y[record]
+    into out after the steps first, first + skip, ...
+    """
+    n = y.size
+    k1 = np.empty(n)
+    k2 = np.empty(n)
+    k3 = np.empty(n)
+    k4 = np.empty(n)
+    y_stage = np.empty(n)
+    for k in range(dt.size):
+        h = dt[k]
+        _rhs(i_values[k, 0], y, params, k1)
+        for j in range(n):
+            y_stage[j] = y[j] + k1[j] * h / 2
+        _rhs(i_values[k, 1], y_stage, params, k2)
+        for j in range(n):
+            y_stage[j] = y[j] + k2[j] * h / 2
+        _rhs(i_values[k, 1], y_stage, params, k3)
+        for j in range(n):
+            y_stage[j] = y[j] + k3[j] * h
+        _rhs(i_values[k, 2], y_stage, params, k4)
+        for j in range(n):
+            y[j] += (k1[j] + 2*k2[j] + 2*k3[j] + k4[j]) * h / 6
+        if (k >= first) and ((k - first) % skip == 0):
+            for r in range(record.size):
+                out[(k - first) // skip, r] = y[record[r]]
+
+class Kernel():
+    """
+    Compiled evaluation of a neuron or network
+    
+    args:
+        system: Neuron or Network with current and conductance elements,
+        CurrentSynapse, ConductanceSynapse and resistive connections
+    
+    attributes:
+        block_size: maximum number of steps run by iterate in a single
+        compiled loop, which bounds the arrays of the applied currents
+    
+    methods:
+        sys: state vector update, as system.sys
+        run: iterate a fixed-step method over the time points t
+    
+    The parameters are packed again whenever the neurons are modified or the
+    network is recompiled.
+    """
+    
+    # Fixed-step methods: loop and offsets of the i_app evaluation times
+    methods = {"Euler": (_euler_loop, (0,)),
+               "RK4": (_rk4_loop, (0, 0.5, 1))}
+    
+    block_size = 65536 # Maximum number of steps of a compiled loop in iterate
+    
+    def __init__(self, system):
+        from neuron_model import Neuron
+        
+        self.system = system
+        if isinstance(system, Neuron):
+            self.neurons = [system]
+            self.offsets = [0]
+        else:
+            self.neurons = system.neurons
+            self.offsets = list(system.neuron_index)
+        self.n = len(self.neurons)
+        self._key = None
+        self.params() # Check that the system is supported
+    
+    def _current_key(self):
+        key = [neuron.get_arrays() for neuron in self.neurons]
+        if hasattr(self.system, 'connections'):
+            key += [self.system.connections, self.system._laplacian]
+        return key
+    
+    def params(self):
+        """
+        Returns the packed parameter arrays, see _rhs
+        """
+        key = self._current_key()
+        if (self._key is None) or any(a is not b for a, b in
+                                      zip(key, self._key)):
+            self._params = self._pack()
+            self._key = key
+        return self._params
+    
+    def _pack(self):
+        from network_model import CurrentSynapse, ConductanceSynapse
+        
+        arrays = [neuron.get_arrays() for neuron in self.neurons]
+        base = np.array(self.offsets, dtype = np.int64)
+        index, source, tau = self.system.linear_filters()
+        
+        def cat(values, dtype = float):
+            values = [np.ravel(v) for v in values]
+            if (len(values) == 0):
+                return np.empty(0, dtype = dtype)
+            return np.concatenate(values).astype(dtype)
+        
+        n_cur = [a.a.size for a in arrays]
+        n_cond = [a.g_max.size for a in arrays]
+        n_gates = [a.k.size for a in arrays]
+        gate_offset = np.cumsum([0] + n_gates[:-1])
+        gate_start = cat([a.gate_start + o for a, o in
+                          zip(arrays, gate_offset)] + [[sum(n_gates)]],
+                         np.int64)
+        
+        params = [cat([a.C for a in arrays]), base,
+                  np.asarray(index, dtype = np.int64),
+                  np.asarray(source, dtype = np.int64),
+                  np.asarray(tau, dtype = float),
+                  cat([np.full(k, m) for m, k in enumerate(n_cur)], np.int64),
+                  cat([a.v_index + b for a, b in zip(arrays, base)], np.int64),
+                  cat([a.a for a in arrays]), cat([a.voff for a in arrays]),
+                  cat([a.g_leak for a in arrays]),
+                  cat([a.gE_leak for a in arrays]),
+                  cat([np.full(k, m) for m, k in enumerate(n_cond)],
+                      np.int64),
+                  cat([a.g_max for a in arrays]),
+                  cat([a.E_rev for a in arrays]),
+                  gate_start,
+                  cat([a.gate_index + b for a, b in zip(arrays, base)],
+                      np.int64),
+                  cat([a.k for a in arrays]),
+                  cat([a.gate_voff for a in arrays])]
+        
+        # Synapses
+        post, pre, w, k, voff, E, cond = [], [], [], [], [], [], []
+        for syn, weights, pre_index, _, post_neuron in getattr(
+                self.system, 'connections', []):
+            if (type(syn) is CurrentSynapse):
+                w.append(weights * syn.sign)
+                k.append(np.full(weights.size, syn.k))
+                E.append(np.zeros(weights.size))
+                cond.append(np.zeros(weights.size, dtype = bool))
+            elif (type(syn) is ConductanceSynapse):
+                w.append(weights)
+                k.append(np.full(weights.size, syn.slope))
+                E.append(np.full(weights.size, syn.E_rev))
+                cond.append(np.ones(weights.size, dtype = bool))
+            else:
+                raise ValueError("%s is not supported by the compiled backend"
+                                 % type(syn).__name__)
+            voff.append(np.full(weights.size, syn.voff))
+            post.append(post_neuron)
+            pre.append(pre_index)
+        params += [cat(post, np.int64), cat(pre, np.int64), cat(w), cat(k),
+                   cat(voff), cat(E), cat(cond, bool)]
+        
+        # Resistive connections
+        L = getattr(self.system, '_laplacian', None)
+        if (L is None):
+            params += [np.zeros(self.n + 1, dtype = np.int64),
+                       np.empty(0, dtype = np.int64), np.empty(0)]
+        else:
+            params += [L.indptr.astype(np.int64),
+                       L.indices.astype(np.int64), L.data.astype(float)]
+        
+        return tuple(params)
+    
+    def _currents(self, i_app, times):
+        """
+        Returns i_app evaluated at times as an array (times.shape, neurons)
+        
+        i_app is first called once with the array of all times, which is
+        used if it gives a constant, one value per time or one value per time
+        and neuron that agrees with i_app at the last time. Otherwise i_app
+        is called once per time.
+        """
+        t = times.ravel()
+        shape = (t.size, self.n)
+        if (t.size == 0):
+            return np.empty(times.shape + (self.n,))
+        last = np.broadcast_to(np.asarray(i_app(t[-1]), dtype = float),
+                               (self.n,))
+        try:
+            values = np.asarray(i_app(t), dtype = float)
+        except Exception: # i_app is not vectorized
+            values = None
+        
+        candidates = []
+        if (values is not None):
+            if (values.shape in [(), (self.n,)]):
+                candidates.append(values)
+            if (values.shape == (t.size,)):
+                candidates.append(values[:, None])
+            if (values.shape == shape):
+                candidates.append(values)
+            if (values.shape == shape[::-1]):
+                candidates.append(values.T)
+        for values in candidates:
+            values = np.broadcast_to(values, shape)
+            if np.array_equal(values[-1], last):
+                return values.reshape(times.shape + (self.n,))
+        
+        values = [np.broadcast_to(np.asarray(i_app(s), dtype = float),
+                                  (self.n,)) for s in t[:-1]]
+        return np.array(values + [last]).reshape(times.shape + (self.n,))
+    
+    def sys(self, i_app, y, out = None):
+        if (out is None):
+            out = np.empty(len(y))
+        i_ext = np.broadcast_to(np.asarray(i_app, dtype = float), (self.n,))
+        y = np.ascontiguousarray(y, dtype = float)
+        _rhs(np.ascontiguousarray(i_ext), y, self.params(), out)
+        return out
+    
+    def run(self, method, y, t, i_app, record, skip = 1, offset = 0):
+        """
+        Iterates method from y at t[0] through the time points t, with the
+        applied current function i_app(t)
+        
+        Returns the final state and the recorded states y[record] after
+        the steps to t[j] with j + offset a multiple of skip, shape
+        (steps, len(record))
+        """
+        loop, stages = self.methods[method]
+        y = np.array(y, dtype = float)
+        t = np.asarray(t, dtype = float)
+        dt = np.diff(t)
+        times = t[:-1, None] + dt[:, None] * np.array(stages)
+        record = np.asarray(record, dtype = np.int64)
+        first = (-offset - 1) % skip # First recorded step within dt
+        out = np.empty((max(0, dt.size - first + skip - 1) // skip,
+                        record.size))
+        loop(y, dt, np.ascontiguousarray(self._currents(i_app, times)),
+             record, first, skip, self.params(), out)
+        return y, out
+
+def compile_kernel(system):
+    """
+    Returns the Kernel of system, or None if the compiled backend is not
+    available or the system contains unsupported elements
+    """
+    if not available():
+        return None
+    try:
+        return Kernel(system)
+    except (ValueError, AttributeError):
+        return None
@@ -5,8 +5,10 @@ Synaptic connections use either the 'Current' or 'Conductance' model
 @author: Luka
 """
 
-from neuron_model import System, sigmoid
+from neuron_model import System, Neuron, NeuronArrays, sigmoid, dsigmoid
+from neuron_model import _plain
 import numpy as np
+from scipy.sparse import csr_matrix, coo_matrix, diags
 
 class Network(System):
     """
@@ -17,9 +19,31 @@ class Network(System):
         
         Note: g[i][j] is the weight of the synaptic connection FROM neuron i TO
         neuron j.
+    
+    kwargs:
+        compiled: if True, the synaptic currents are evaluated as batched
+        array expressions over the nonzero connections only, and the neurons
+        of networks of at least stack_size neurons with identical structure
+        together as stacked NeuronArrays (as in a Population), otherwise by
+        iterating over all pairs of neurons
+    
+    attributes:
+        stack_size: minimum number of neurons evaluated as stacked arrays,
+        smaller networks evaluate their neurons one by one, which is faster
+        than the array operations for a few neurons
+    
+    methods:
+        compile: (re)build the sparse connectivity arrays, needed if the
+        connectivity matrices are modified after construction
+        i_syn: total synaptic and resistive current into each neuron
+        jac: sparse Jacobian of the state vector update
+        to_spec: declarative description of the network (dict)
+        from_spec: build a network from its spec (classmethod)
     """
     
-    def __init__(self, neurons, *args):    
+    stack_size = 4
+    
+    def __init__(self, neurons, *args, compiled = True):    
         self.neurons = neurons # List containing all neurons
         self.n = len(self.neurons) # Number of neurons
         self.neuron_index = [] # Starting state index for every neuron
@@ -40,15 +64,198 @@ class Network(System):
             syn.check_connectivity_matrix(g, self.n)
         
         self.synapses = args # List of synapse model/connectivity matrix pairs
+        
+        self.compiled = compiled
+        self.compile()
     
     def get_init_conditions(self):
         return self.y0
+    
+    def to_spec(self):
+        """
+        Returns a JSON-compatible description of the network:
+            {'type': 'Network', 'neurons': [...], 'synapses': [...],
+             'compiled': ..., 'y0': [...]}
+        where every synapse is {'model': <interconnection spec>, 'g': g}
+        """
+        spec = {'type': 'Network',
+                'neurons': [neuron.to_spec() for neuron in self.neurons],
+                'synapses': [{'model': syn.to_spec(), 'g': np.asarray(g)}
+                             for syn, g in self.synapses],
+                'compiled': self.compiled,
+                'y0': list(self.y0)}
+        return _plain(spec)
+    
+    @classmethod
+    def from_spec(cls, spec):
+        """
+        Builds a network from a spec returned by to_spec
+        """
+        neurons = [Neuron.from_spec(neuron) for neuron in spec['neurons']]
+        synapses = [(Interconnection.from_spec(syn['model']), syn['g'])
+                    for syn in spec['synapses']]
+        network = cls(neurons, *synapses,
+                      compiled = spec.get('compiled', True))
+        if ('y0' in spec):
+            if (len(spec['y0']) != len(network.y0)):
+                raise ValueError("Initial conditions do not match the "
+                                 "neurons")
+            network.y0 = list(spec['y0'])
+        return network
+    
+    def membrane_index(self):
+        return np.array(self.neuron_index)
+    
+    def linear_filters(self):
+        filters = [neuron.linear_filters() for neuron in self.neurons]
+        index = [f[0] + i for f, i in zip(filters, self.neuron_index)]
+        source = [f[1] + i for f, i in zip(filters, self.neuron_index)]
+        tau = [f[2] for f in filters]
+        return (np.concatenate(index), np.concatenate(source),
+                np.concatenate(tau))
+    
+    def compile(self):
+        """
+        Convert each connectivity matrix into the list of its nonzero
+        connections: weights, state indices of the presynaptic filtered
+        voltages Vpre and of the postsynaptic membrane voltages Vpost.
+        Resistive connections are combined into a single graph Laplacian.
+        Connectivity matrices without nonzero weights are left out.
+        """
+        self.v_index = np.array(self.neuron_index) # Membrane voltage indices
+        self.slices = [slice(index, index + len(neuron.timescales))
+                       for index, neuron in zip(self.neuron_index,
+                                                self.neurons)]
+        
+        self.connections = []
+        self._laplacian = None
+        for syn, g in self.synapses:
+            if isinstance(syn, ResistorInterconnection):
+                L = syn.laplacian(g)
+                if (self._laplacian is not None):
+                    L = L + self._laplacian
+                self._laplacian = L
+                continue
+            
+            # State index of Vpre in the synapse timescale for each neuron
+            pre_index = []
+            for index, neuron in zip(self.neuron_index, self.neurons):
+                if syn.timescale not in neuron.timescales:
+                    raise ValueError("Synapse timescale %s is not defined in "
+                                     "every neuron" % syn.timescale)
+                pre_index.append(index +
+                                 neuron.timescales.index(syn.timescale))
+            pre_index = np.array(pre_index, dtype = int)
+            
+            # Rows of the transposed matrix are the postsynaptic neurons
+            G = csr_matrix(np.array(g, dtype = float).T)
+            G.eliminate_zeros()
+            if (G.nnz == 0):
+                continue
+            post = np.repeat(np.arange(self.n), np.diff(G.indptr))
+            pre = G.indices
+            
+            self.connections.append((syn, G.data, pre_index[pre],
+                                     self.v_index[post], post))
+        
+        if (self._laplacian is not None):
+            self._laplacian.eliminate_zeros()
+            if (self._laplacian.nnz == 0):
+                self._laplacian = None
         
-    def sys(self, i_app, y):
+        # Summation of the connection currents into postsynaptic neurons
+        self._aggregate = [csr_matrix((np.ones(post.size),
+                                       (post, np.arange(post.size))),
+                                      shape = (self.n, post.size))
+                           for _, _, _, _, post in self.connections]
+        
+        # Sparsity pattern of the diagonal blocks of the individual neurons
+        rows, cols = [], []
+        for sl in self.slices:
+            r, c = np.mgrid[sl, sl]
+            rows.append(r.ravel())
+            cols.append(c.ravel())
+        self._block_rows = np.concatenate(rows)
+        self._block_cols = np.concatenate(cols)
+        
+        self._stacked = None # Stacked NeuronArrays, see _stacked_arrays
+        self._stacked_key = None
+    
+    def _stacked_arrays(self):
+        """
+        Returns the NeuronArrays of all neurons stacked along a leading
+        dimension, or None if the network is smaller than stack_size or the
+        neurons do not have identical structure
+        
+        The arrays are stacked again whenever the neurons are modified.
+        """
+        if (self.n < self.stack_size) or (self._stacked is False):
+            return None
+        
+        n_states = len(self.neurons[0].timescales)
+        if (self._stacked is None) and any(
+                (type(neuron).sys is not Neuron.sys) or
+                (len(neuron.timescales) != n_states)
+                for neuron in self.neurons):
+            self._stacked = False
+            return None
+        
+        key = [neuron.get_arrays() for neuron in self.neurons]
+        if (self._stacked_key is None) or any(a is not b for a, b in
+                                              zip(key, self._stacked_key)):
+            self._stacked = False
+            try:
+                self._stacked = NeuronArrays.stack(key)
+            except ValueError: # Neurons of different structure
+                return None
+            self._stacked_key = key
+        return self._stacked
+    
+    def i_syn(self, y):
+        """
+        Returns the total synaptic and resistive current into each neuron
+        y can contain a batch of network states along its leading dimensions
+        """
+        y = np.asarray(y)
+        if (y.ndim > 1):
+            return self._i_syn_batch(y)
+        
+        i_syn = np.zeros(self.n)
+        for syn, w, pre, post_v, post in self.connections:
+            i_conn = w * syn.out(y[pre], y[post_v])
+            i_syn += np.bincount(post, i_conn, minlength = self.n)
+        
+        if (self._laplacian is not None):
+            i_syn -= self._laplacian @ y[self.v_index]
+        
+        return i_syn
+    
+    def _i_syn_batch(self, y):
+        i_syn = np.zeros(y.shape[:-1] + (self.n,))
+        for (syn, w, pre, post_v, _), agg in zip(self.connections,
+                                                 self._aggregate):
+            if (w.size == 0):
+                continue
+            i_conn = w * syn.out(y[..., pre], y[..., post_v])
+            i_syn += (agg @ i_conn.reshape(-1, w.size).T).T.reshape(
+                i_syn.shape)
+        
+        if (self._laplacian is not None):
+            V = y[..., self.v_index].reshape(-1, self.n)
+            i_syn -= (self._laplacian @ V.T).T.reshape(i_syn.shape)
+        
+        return i_syn
+    
+    def sys(self, i_app, y, out = None):
         """
         Returns the state vector update
         y = vector containing states of all neurons, in order of definition
+        
+        If out is given, the update is written into it instead of a new array
         """
+        if (self.compiled):
+            return self._sys_compiled(i_app, y, out)
+        
         dy = []
         
         for i, neuron_i in enumerate(self.neurons):
@@ -64,26 +271,139 @@ class Network(System):
                     tau = syn.timescale
                     Vpre = y[index_j + neuron_j.timescales.index(tau)]
                     i_syn = i_syn + g[j][i] * syn.out(Vpre, Vpost)
-                        
+            
             i_external = i_app[i] + i_syn
             index_i_end = index_i + len(neuron_i.timescales)
             dv = neuron_i.sys(i_external, y[index_i:index_i_end])
             dy.extend(dv)
         
+        if (out is not None):
+            out[:] = dy
+            return out
         return np.array(dy)
     
+    def jac(self, i_app, y):
+        """
+        Returns the Jacobian of the state vector update as a sparse matrix
+        """
+        y = np.asarray(y)
+        n_states = len(y)
+        
+        # Individual neurons
+        vals = [neuron.jac(None, y[sl]).ravel()
+                for neuron, sl in zip(self.neurons, self.slices)]
+        rows = [self._block_rows]
+        cols = [self._block_cols]
+        
+        # Synaptic and resistive connections
+        C = np.array([neuron.C for neuron in self.neurons], dtype = float)
+        for syn, w, pre, post_v, post in self.connections:
+            d_pre, d_post = syn.dout(y[pre], y[post_v])
+            vals.append(np.broadcast_to(w * d_pre / C[post], w.shape))
+            vals.append(np.broadcast_to(w * d_post / C[post], w.shape))
+            rows.extend([post_v, post_v])
+            cols.extend([pre, post_v])
+        
+        # Resistive connections: -L / C
+        if (self._laplacian is not None):
+            L = self._laplacian.tocoo()
+            vals.append(-L.data / C[L.row])
+            rows.append(self.v_index[L.row])
+            cols.append(self.v_index[L.col])
+        
+        J = coo_matrix((np.concatenate(vals),
+                        (np.concatenate(rows), np.concatenate(cols))),
+                       shape = (n_states, n_states))
+        return J.tocsr()
+    
+    def _sys_compiled(self, i_app, y, out = None):
+        y = np.asarray(y)
+        dy = np.empty(len(y)) if (out is None) else out
+        i_external = np.asarray(i_app) + self.i_syn(y)
+        
+        arrays = self._stacked_arrays()
+        if (arrays is not None):
+            Y = y.reshape(self.n, -1)
+            arrays.sys(i_external, Y, out = dy.reshape(Y.shape))
+            return dy
+        
+        for i, (neuron, sl) in enumerate(zip(self.neurons, self.slices)):
+            neuron.sys(i_external[i], y[sl], out = dy[sl])
+        
+        return dy
+    
+    def _sys_parts(self, i_app, y, timer):
+        if not (self.compiled):
+            return super()._sys_parts(i_app, y, timer)
+        
+        y = np.asarray(y)
+        dy = np.empty(len(y))
+        i_syn = np.zeros(self.n)
+        for syn, w, pre, post_v, post in self.connections:
+            with timer.section(type(syn).__name__):
+                i_conn = w * syn.out(y[pre], y[post_v])
+                i_syn += np.bincount(post, i_conn, minlength = self.n)
+        if (self._laplacian is not None):
+            with timer.section("ResistorInterconnection"):
+                i_syn -= self._laplacian @ y[self.v_index]
+        
+        i_external = np.asarray(i_app) + i_syn
+        arrays = self._stacked_arrays()
+        if (arrays is not None):
+            Y = y.reshape(self.n, -1)
+            arrays.sys_parts(i_external, Y, timer, out = dy.reshape(Y.shape))
+            return dy
+        
+        for i, (neuron, sl) in enumerate(zip(self.neurons, self.slices)):
+            neuron._sys_parts(i_external[i], y[sl], timer, out = dy[sl])
+        
+        return dy
+
 class Interconnection():
     """
     Arbitrary interconnecting element between two neurons
+    
+    methods:
+        out: output current for presynaptic and postsynaptic voltages
+        dout: derivatives of out with respect to Vpre and Vpost
+        presynaptic, postsynaptic: factorization of chemical synapses,
+        out(Vpre, Vpost) = postsynaptic(presynaptic(Vpre), Vpost) where
+        postsynaptic is linear in its first argument, so that the weighted
+        sum over presynaptic neurons can be taken before postsynaptic
+        to_spec: {'type': class name, <constructor arguments>}
+        from_spec: build an interconnection from its spec (classmethod)
+    
+    Subclasses list their constructor arguments in _spec_args.
     """
     
+    _spec_args = ()
+    
     def __init__(self, timescale):
         self.timescale = timescale # element is instantaneous by default
     
+    def to_spec(self):
+        spec = {'type': type(self).__name__}
+        spec.update({arg: getattr(self, arg) for arg in self._spec_args})
+        return _plain(spec)
+    
+    @classmethod
+    def from_spec(cls, spec):
+        types = {}
+        subclasses = [cls]
+        while subclasses:
+            c = subclasses.pop()
+            types[c.__name__] = c
+            subclasses.extend(c.__subclasses__())
+        if (spec['type'] not in types):
+            raise ValueError("Undefined interconnection type %s"
+                             % spec['type'])
+        args = {arg: value for arg, value in spec.items() if arg != 'type'}
+        return types[spec['type']](**args)
+    
     def check_connectivity_matrix(self, g, n):
         if np.array(g).shape != (n, n):
             raise ValueError("Invalid connectivity matrix size")
-    
+
 class CurrentSynapse(Interconnection):
     """
     Current source model of a synapse of the form:
@@ -92,16 +412,27 @@ class CurrentSynapse(Interconnection):
         -: inhibitory synapse
     """
     
+    _spec_args = ('sign', 'voff', 'timescale', 'k')
+    
     def __init__(self, sign, voff, timescale, k = 2):
         super().__init__(timescale)
         
         self.voff = voff
         self.sign = sign
         self.k = k
-        
+    
     def out(self, Vpre, Vpost = None):
         return self.sign * sigmoid(Vpre - self.voff, self.k)
     
+    def dout(self, Vpre, Vpost = None):
+        return self.sign * dsigmoid(Vpre - self.voff, self.k), 0
+    
+    def presynaptic(self, Vpre):
+        return self.out(Vpre)
+    
+    def postsynaptic(self, s, Vpost):
+        return s
+
 class ConductanceSynapse(Interconnection):
     """
     Conductance-based model of a synapse of the form:
@@ -110,6 +441,8 @@ class ConductanceSynapse(Interconnection):
         tau dVpre_x/dt = Vpre - Vpre_x
     """
     
+    _spec_args = ('slope', 'voff', 'E_rev', 'timescale')
+    
     def __init__(self, slope, voff, E_rev, timescale):
         super().__init__(timescale)
         
@@ -120,10 +453,25 @@ class ConductanceSynapse(Interconnection):
     def out(self, Vpre, Vpost):
         x = sigmoid(Vpre - self.voff, self.slope)
         return x * (Vpost - self.E_rev)
+    
+    def dout(self, Vpre, Vpost):
+        x = sigmoid(Vpre - self.voff, self.slope)
+        dx = dsigmoid(Vpre - self.voff, self.slope)
+        return dx * (Vpost - self.E_rev), x
+    
+    def presynaptic(self, Vpre):
+        return sigmoid(Vpre - self.voff, self.slope)
+    
+    def postsynaptic(self, x, Vpost):
+        return x * (Vpost - self.E_rev)
 
 class ResistorInterconnection(Interconnection):
     """
     Ires = (Vpre - Vpost)
+    
+    In a network the resistive currents of all connections are evaluated
+    together as -L @ V, where L is the graph Laplacian of the connectivity
+    matrix and V the membrane voltages
     """
     
     def __init__(self):
@@ -135,4 +483,19 @@ class ResistorInterconnection(Interconnection):
             raise ValueError("Resistive matrix is not symmetric")
     
     def out(self, Vpre, Vpost):
-        return (Vpre - Vpost)
\ No newline at end of file
+        return (Vpre - Vpost)
+    
+    def dout(self, Vpre, Vpost):
+        return 1, -1
+    
+    def laplacian(self, g):
+        """
+        Returns the sparse graph Laplacian L = D - g of the symmetric
+        connectivity matrix g (dense or sparse), where D is the diagonal
+        matrix of the total conductances of every neuron
+        """
+        G = csr_matrix(g, dtype = float)
+        if (abs(G - G.T).max() > 1e-8 * max(1, abs(G).max())):
+            raise ValueError("Resistive matrix is not symmetric")
+        L = diags(np.asarray(G.sum(axis = 0)).ravel()) - G.T
+        return csr_matrix(L)
\ No newline at end of file
@@ -7,16 +7,277 @@ Circuit consists of a parallel interconnection of an arbitrary number of either
 """
 from numpy import tanh, exp
 import numpy as np
-from scipy.integrate import solve_ivp, BDF
+import copy
+import hashlib
+import itertools
+import json
+import math
+from operator import mul
+from scipy.integrate import solve_ivp, RK45, BDF, Radau, LSODA
+from scipy.optimize import OptimizeResult, brentq, root
+from scipy.sparse import issparse
+
+from spikes import SpikeDetector, SpikeTrains
+from profiling import Profiler, clock
 
 def sigmoid(x, k = 1):
     return 1 / (1 + exp(-k * (x)))
 
-class EulerSolver():
+def dsigmoid(x, k = 1):
     """
-    ODE solver using the basic Euler step
+    Derivative of sigmoid(x, k) with respect to x
+    """
+    s = sigmoid(x, k)
+    return k * s * (1 - s)
+
+def _dot(x, w):
+    """
+    Sum of x * w over the last axis, for 1D or batched weights w
+    """
+    if (w.ndim == 1):
+        return x @ w
+    return (x * w).sum(axis = -1)
+
+def _scatter(x, index, n):
+    """
+    Sums x over its last axis into n bins given by index, for 1D or batched x
+    """
+    if (x.ndim == 1):
+        return np.bincount(index, x, minlength = n)
+    return x @ (index[:, None] == np.arange(n))
+
+def _plain(x):
+    """
+    Converts numpy scalars and arrays in x into JSON-compatible values
+    """
+    if isinstance(x, np.ndarray):
+        return x.tolist()
+    if isinstance(x, np.generic):
+        return x.item()
+    if isinstance(x, (list, tuple)):
+        return [_plain(item) for item in x]
+    if isinstance(x, dict):
+        return {key: _plain(value) for key, value in x.items()}
+    return x
+
+def spec_hash(spec):
+    """
+    Returns a hash of a model spec, e.g. as a key for caching compiled models
+    """
+    text = json.dumps(_plain(spec), sort_keys = True)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def euler_step(odesys, t, y, dt):
+    """
+    Single explicit Euler step of dy/dt = odesys(t, y)
+    """
+    return y + odesys(t, y) * dt
+
+def rk4_step(odesys, t, y, dt):
+    """
+    Single classical Runge-Kutta step of dy/dt = odesys(t, y)
+    """
+    k1 = odesys(t, y)
+    k2 = odesys(t + dt/2, y + k1 * dt/2)
+    k3 = odesys(t + dt/2, y + k2 * dt/2)
+    k4 = odesys(t + dt, y + k3 * dt)
+    return y + (k1 + 2*k2 + 2*k3 + k4) * dt/6
+
+def exp_euler_step(odesys, t, y, dt, filters):
+    """
+    Euler step in which the linear first-order filters
+        tau * dy[index]/dt = y[source] - y[index]
+    are integrated exactly for y[source] held constant over the step
+    
+    filters: (index, source, tau) arrays, see System.linear_filters
+    """
+    index, source, tau = filters
+    y_next = y + odesys(t, y) * dt
+    y_next[..., index] = (y[..., source] + (y[..., index] - y[..., source]) *
+                          exp(-dt / tau))
+    return y_next
+
+def output_skip(dt, dt_out):
+    """
+    Returns the number of fixed steps of size dt per output sample of the
+    grid t0 + k * dt_out, or None if dt_out is not a multiple of dt, in which
+    case the output is interpolated onto the grid
+    """
+    if (dt_out is None):
+        return 1
+    skip = int(round(dt_out / dt))
+    if (skip >= 1) and (abs(skip * dt - dt_out) <= 1e-9 * dt_out):
+        return skip
+    return None
+
+# Dormand-Prince 5(4) coefficients as Python floats, see dopri_steps_float
+_DP_A = [row[:i] for i, row in enumerate(RK45.A.tolist())]
+_DP_B = RK45.B.tolist()
+_DP_C = RK45.C.tolist()
+_DP_E = RK45.E.tolist()
+
+def _step_factor(error, rejected):
+    """
+    Step size factor of the Dormand-Prince steps, not above 1 after a
+    rejected step
+    """
+    factor = min(max(0.9 * error**(-1/5) if (error > 0) else 10, 0.2), 10)
+    return min(factor, 1) if (rejected) else factor
+
+def dopri_steps(odesys, t, y, t_stop, t_end, h, rtol, atol, index,
+                check = None, f = None):
+    """
+    Adaptive Dormand-Prince 5(4) steps of dy/dt = odesys(t, y, out) from
+    (t, y) until the first step reaching t_stop, without passing t_end
+    
+    index: states included in the error norm
+    check: check(t, Y, t_new, y_new) -> error of a step passing the error
+    control in a second test, relative to its tolerance, where Y are the
+    states at the stages of the step. This error is taken to grow with the
+    third power of the time since the first step: the steps end before a
+    step expected to fail or after a failed step, which is repeated with a
+    smaller step size if it is the first step.
+    f: odesys at (t, y) if already evaluated
+    
+    Returns the accepted steps [(t, y)], the next step size, the number of
+    odesys calls and the number of rejected steps
+    """
+    A, B, C, E = RK45.A, RK45.B, RK45.C, RK45.E
+    K = np.empty((RK45.n_stages + 1, y.size))
+    Y = np.empty((RK45.n_stages, y.size))
+    if (f is None):
+        odesys(t, y, K[0])
+    else:
+        K[0] = f
+    t_start = t
+    steps = []
+    n_calls, n_rejected = int(f is None), 0
+    rejected = False
+    while (t < t_stop) and (t < t_end):
+        h = min(h, t_end - t)
+        Y[0] = y
+        for i in range(1, RK45.n_stages):
+            Y[i] = y + h * (A[i, :i] @ K[:i])
+            odesys(t + C[i] * h, Y[i], K[i])
+        y_new = y + h * (B @ K[:-1])
+        odesys(t + h, y_new, K[-1])
+        n_calls += RK45.n_stages
+        
+        scale = atol + rtol * np.maximum(np.abs(y[index]),
+                                         np.abs(y_new[index]))
+        error = np.sqrt(np.mean((h * (E @ K[:, index]) / scale)**2))
+        factor = _step_factor(error, rejected)
+        rejected = (error > 1)
+        
+        if (not rejected) and (check is not None):
+            check_error = check(t, Y, t + h, y_new)
+            if (check_error > 1) and (len(steps) > 0):
+                h = min(h, 0.9 * (t + h - t_start) * check_error**(-1/3))
+                break
+            elif (check_error > 1):
+                rejected = True
+                factor = min(factor, max(0.9 * check_error**(-1/3), 0.2))
+        
+        if (rejected):
+            n_rejected += 1
+        else:
+            t, y = t + h, y_new
+            K[0] = K[-1]
+            steps.append((t, y))
+            if (check is not None) and (check_error * (
+                    1 + h * factor / (t - t_start))**3 > 1):
+                h = min(h * factor,
+                        0.9 * (t - t_start) * check_error**(-1/3))
+                break
+        h = h * factor
+    return steps, h, n_calls, n_rejected
+
+def dopri_steps_float(odesys, t, y, t_stop, t_end, h, rtol, atol,
+                      check = None, f = None):
+    """
+    dopri_steps for a state y given as a list of Python floats, with
+    odesys(t, y) returning a list; the error norm includes all states. For
+    the few states of a single neuron this avoids the overhead of the array
+    operations.
+    """
+    K = [odesys(t, y) if (f is None) else f]
+    t_start = t
+    steps = []
+    n_calls, n_rejected = int(f is None), 0
+    rejected = False
+    while (t < t_stop) and (t < t_end):
+        h = min(h, t_end - t)
+        Y = [y]
+        for i in range(1, 6):
+            Y.append([y_m + h * sum(map(mul, _DP_A[i], k_m))
+                      for y_m, k_m in zip(y, zip(*K))])
+            K.append(odesys(t + _DP_C[i] * h, Y[i]))
+        y_new = [y_m + h * sum(map(mul, _DP_B, k_m))
+                 for y_m, k_m in zip(y, zip(*K))]
+        K.append(odesys(t + h, y_new))
+        n_calls += 6
+        
+        error = math.sqrt(sum([
+            (h * sum(map(mul, _DP_E, k_m)) /
+             (atol + rtol * max(abs(y_m), abs(y_new_m))))**2
+            for y_m, y_new_m, k_m in zip(y, y_new, zip(*K))]) / len(y))
+        factor = _step_factor(error, rejected)
+        rejected = (error > 1)
+        
+        if (not rejected) and (check is not None):
+            check_error = check(t, Y, t + h, y_new)
+            if (check_error > 1) and (len(steps) > 0):
+                h = min(h, 0.9 * (t + h - t_start) * check_error**(-1/3))
+                break
+            elif (check_error > 1):
+                rejected = True
+                factor = min(factor, max(0.9 * check_error**(-1/3), 0.2))
+        
+        if (rejected):
+            n_rejected += 1
+            del K[1:]
+        else:
+            t, y = t + h, y_new
+            K = K[-1:]
+            steps.append((t, y))
+            if (check is not None) and (check_error * (
+                    1 + h * factor / (t - t_start))**3 > 1):
+                h = min(h * factor,
+                        0.9 * (t - t_start) * check_error**(-1/3))
+                break
+        h = h * factor
+    return steps, h, n_calls, n_rejected
+
+class Equilibrium():
+    """
+    Equilibrium of a neuron or a network
+    
+    attributes:
+        y: equilibrium state
+        v: membrane voltage(s)
+        i_app: applied current
+        eigenvalues: eigenvalues of the linearization
+        stable: True if all eigenvalues have negative real parts
+    """
+    def __init__(self, system, i_app, y):
+        self.y = np.asarray(y, dtype = float)
+        self.v = self.y[system.membrane_index()]
+        if (self.v.size == 1):
+            self.v = self.v[0]
+        self.i_app = i_app
+        
+        J = system.jac(i_app, self.y)
+        if issparse(J):
+            J = J.toarray()
+        self.eigenvalues = np.linalg.eigvals(J)
+        self.stable = bool(np.all(self.eigenvalues.real < 0))
+
+class FixedStepSolver():
+    """
+    ODE solver iterating a fixed-step method
     
     args:
+        step: step(odesys, t, y, dt) -> y(t + dt)
         odesys: f(t,y) -> dy/dt = f(t,y)
         t0: initial time
         y0: initial state
@@ -25,68 +286,920 @@ class EulerSolver():
     methods:
         step: iterate a single simulation step
     """
-    def __init__(self, odesys, t0, y0, dt):
+    def __init__(self, step, odesys, t0, y0, dt):
+        self.method = step
         self.odesys = odesys
         self.t = t0
-        self.y = y0
+        self.y = np.array(y0, dtype = float)
         self.dt = dt
         
     def step(self):
-        self.y += self.odesys(self.t,self.y)*self.dt
+        self.y = self.method(self.odesys, self.t, self.y, self.dt)
         self.t += self.dt
         
         # Return error message for compatibility with scipy solvers
         errorMessage = False
         return errorMessage
+    
+    def steps(self, n, index):
+        """
+        Iterates n steps, returns the times and the states y[index] after
+        every step
+        """
+        t = np.empty(n)
+        y = np.empty((len(index), n))
+        for k in range(n):
+            self.step()
+            t[k] = self.t
+            y[:, k] = self.y[index]
+        return t, y
+
+class EulerSolver(FixedStepSolver):
+    """
+    ODE solver using the basic Euler step
+    
+    args:
+        odesys: f(t,y) -> dy/dt = f(t,y)
+        t0: initial time
+        y0: initial state
+        dt: time step
+    
+    methods:
+        step: iterate a single simulation step
+    """
+    def __init__(self, odesys, t0, y0, dt):
+        super().__init__(euler_step, odesys, t0, y0, dt)
+
+class KernelSolver(FixedStepSolver):
+    """
+    Fixed-step solver iterating the compiled loops of a kernel
+    
+    args:
+        kernel: kernels.Kernel of the system
+        method: Euler or RK4
+        i_app: applied current function of t
+        t0: initial time
+        y0: initial state
+        dt: time step
+    
+    methods:
+        step: iterate a single simulation step
+        steps: iterate n steps in a single compiled loop
+    """
+    def __init__(self, kernel, method, i_app, t0, y0, dt):
+        self.kernel = kernel
+        self.method = method
+        self.i_app = i_app
+        self.t = t0
+        self.y = np.array(y0, dtype = float)
+        self.dt = dt
+    
+    def step(self):
+        self.steps(1, np.empty(0, dtype = int))
+        return False
+    
+    def steps(self, n, index):
+        t = self.t + self.dt * np.arange(n + 1)
+        self.y, y = self.kernel.run(self.method, self.y, t, self.i_app, index)
+        self.t = t[-1]
+        return t[1:], y.T
 
 class System():
     """
     Parent class implementing basic simulation methods
     
     methods:
-        sys: f(i_app, y) -> dV/dt = f(i_app, y)
+        sys: f(i_app, y) -> dV/dt = f(i_app, y), written into out if given
+        jac: J(i_app, y) -> Jacobian of sys with respect to y
+        linear_filters: states described by linear first-order filters
+        membrane_index: indices of the membrane voltages
+        equilibrium: equilibrium near an initial guess, with its stability
         set_solver: set the ODE solver and simulation parameters
         step: iterate a single simulation step and return next (t,y)
+        steps: iterate several simulation steps and return their (t,y)
+        simulate: simulate over trange and return a solve_ivp-like solution
+        detect_spikes: simulate and return the spike and burst times
+        profile: enable the instrumentation of simulate, iterate and step
+        to_spec: declarative description of the model (dict)
+        spec_hash: hash of the model spec
+        
+    The implicit solvers (BDF, Radau, LSODA) are given the analytic Jacobian.
+    The fixed-step methods are Euler, RK4 and ExpEuler, where ExpEuler is the
+    Euler method with the linear first-order filters integrated exactly.
+    
+    The Multirate method separates the states by timescale: the filters
+    with timescales above multirate_split are slow, the membrane voltages
+    and the faster filters are fast. Every macro-step of at most dt starts
+    with a second-order prediction of the slow filters from their
+    derivatives, along which the elements on them are linearized, and the
+    fast states are integrated with adaptive Dormand-Prince substeps. The
+    slow filters are then integrated for the resulting voltages with the
+    quadrature rule of the substeps, and the macro-step ends early where
+    they leave the tolerance of the prediction. The error control of the
+    substeps and of the slow filters uses multirate_rtol and multirate_atol.
+    
+    With backend = "numba", neurons and networks are evaluated by the
+    compiled kernels of kernels.py, and the Euler and RK4 methods are
+    iterated in compiled loops. The applied current of these loops is
+    evaluated beforehand on their time grid, with a single call of i_app if
+    it accepts an array of times (see kernels.Kernel). If Numba is not
+    installed or the system contains elements the kernels do not support,
+    the NumPy implementation is used.
+    
+    The profiler attribute is None unless the instrumentation is enabled with
+    profile, so that a plain simulation only checks it once per run (once per
+    step for step).
     """
+    
+    implicit_solvers = {"BDF": BDF, "Radau": Radau, "LSODA": LSODA}
+    
+    backend = "numpy" # or "numba" for the compiled kernels
+    
+    # Multirate method parameters
+    multirate_split = 10
+    multirate_rtol = 1e-3
+    multirate_atol = 1e-6
+    
+    profiler = None # Profiler, see profile
+    _solver_stats = None # SimulationStats of the solver set by set_solver
+    
     def __init__(self):
         self.y0 = []
     
-    def sys(self, i_app, y):
+    def sys(self, i_app, y, out = None):
+        pass
+    
+    def jac(self, i_app, y):
+        pass
+    
+    def _sys_parts(self, i_app, y, timer):
+        """
+        Evaluates sys with the parts of the evaluation (element, synapse and
+        connection types) timed by timer.section(name), for the profiler
+        """
+        with timer.section(type(self).__name__):
+            return self.sys(i_app, y)
+    
+    def linear_filters(self):
+        """
+        Returns (index, source, tau) arrays such that the states obey
+            tau * dy[index]/dt = y[source] - y[index]
+        """
+        return (np.array([], dtype = int), np.array([], dtype = int),
+                np.array([]))
+    
+    def membrane_index(self):
+        return np.array([0])
+    
+    def to_spec(self):
         pass
     
+    def spec_hash(self):
+        return spec_hash(self.to_spec())
+    
+    def profile(self, enable = True, hooks = [], interval = 1000,
+                sample = 100):
+        """
+        Enables (or with enable = False disables) the instrumentation of
+        simulate, iterate and step, returns the Profiler
+        
+        kwargs:
+            hooks: functions hook(event, stats), see Profiler
+            interval: number of steps between the 'step' events of step
+            sample: every sample-th sys call is evaluated again part by part
+            for the time breakdown by element type, 0 disables the breakdown
+        
+        The SimulationStats of a run is available as profiler.stats and as
+        the stats attribute of the solution returned by simulate. Solvers set
+        by set_solver are instrumented if the profiler is enabled before.
+        """
+        self.profiler = Profiler(hooks, interval, sample) if enable else None
+        return self.profiler
+    
+    def equilibrium(self, i_app, y_guess = None):
+        """
+        Returns the Equilibrium found by Newton iterations with the analytic
+        Jacobian started from y_guess (initial conditions by default), or
+        None if the iterations do not converge
+        """
+        if (y_guess is None):
+            y_guess = self.get_init_conditions()
+        
+        def jac(y):
+            J = self.jac(i_app, y)
+            return J.toarray() if issparse(J) else J
+        
+        res = root(lambda y: self.sys(i_app, y), np.asarray(y_guess,
+                   dtype = float), jac = jac)
+        if not res.success:
+            return None
+        return Equilibrium(self, i_app, res.x)
+    
+    def _fixed_step_method(self, method):
+        """
+        Returns the step function and the number of sys calls per step
+        """
+        if (method == "Euler"):
+            return euler_step, 1
+        elif (method == "RK4"):
+            return rk4_step, 4
+        elif (method == "ExpEuler"):
+            filters = self.linear_filters()
+            def step(odesys, t, y, dt):
+                return exp_euler_step(odesys, t, y, dt, filters)
+            return step, 1
+        else:
+            return None, 0
+    
+    def _multirate_split(self, slow):
+        """
+        Returns the split of the dynamics into the fast part and the slow
+        terms for the Multirate method (see MultirateArrays), or None if the
+        slow terms are evaluated with the full state vector update
+        """
+        return None
+    
+    def _multirate_steps(self, i_app, t0, t1, dt, stats = None, y0 = None):
+        """
+        Generator of the Multirate method, yielding (t, y) after every
+        substep and returning the number of fast evaluations and of
+        macro-steps (y0: initial state, initial conditions by default)
+        """
+        index, source, tau = self.linear_filters()
+        is_slow = tau > self.multirate_split
+        slow, source, tau = index[is_slow], source[is_slow], tau[is_slow]
+        split = self._multirate_split(slow)
+        rtol, atol = self.multirate_rtol, self.multirate_atol
+        
+        full_sys = self.sys
+        if (stats is not None):
+            full_sys = stats.wrap_sys(full_sys, self._sys_parts)
+        
+        y = np.array(self.y0 if (y0 is None) else y0, dtype = float)
+        fast = np.setdiff1d(np.arange(y.size), slow)
+        single = (split is not None) and (split.single)
+        if (single):
+            position = {i: p for p, i in enumerate(fast.tolist())}
+            filters = [(position[i], tau_i) for i, tau_i in
+                       zip(source.tolist(), tau.tolist())]
+            nodes = [(i, b, c) for i, (b, c) in
+                     enumerate(zip(_DP_B, _DP_C)) if (b != 0)]
+        
+        def check_float(t0, ys, g, ys_steps):
+            """
+            Returns the check of the substeps (see dopri_steps) for the fast
+            states given as lists: the slow filters are integrated over the
+            substep with the quadrature rule of the Dormand-Prince step for
+            their source voltages, and compared with the prediction
+            ys + g[0] * (t - t0) + g[1] * (t - t0)**2. The slow filters after
+            the substeps within the tolerance are appended to ys_steps.
+            """
+            ys_k = ys = ys.tolist()
+            g1, g2 = g.tolist()
+            def check(t, Y, t_new, y_new):
+                nonlocal ys_k
+                h = t_new - t
+                dt = t_new - t0
+                ys_new = []
+                error = 0.0
+                for (p, tau), ys_j, ys0, g1_j, g2_j in zip(filters, ys_k, ys,
+                                                           g1, g2):
+                    v = ys_j * math.exp(-h / tau) + h / tau * sum([
+                        b * math.exp((c - 1) * h / tau) * Y[i][p]
+                        for i, b, c in nodes])
+                    error = max(error, abs(v - ys0 - (g1_j + g2_j * dt) * dt)
+                                / (atol + rtol * max(abs(ys0), abs(v))))
+                    ys_new.append(v)
+                if (error <= 1):
+                    ys_k = ys_new
+                    ys_steps.append(ys_new)
+                return error
+            return check
+        
+        def check_array(t0, ys, g, ys_steps):
+            """
+            check_float for the full state arrays
+            """
+            ys_k = ys
+            B, C = RK45.B[:, None], RK45.C[:, None]
+            def check(t, Y, t_new, y_new):
+                nonlocal ys_k
+                h = t_new - t
+                dt = t_new - t0
+                v = ys_k * np.exp(-h / tau) + np.sum(
+                    h / tau * B * np.exp((C - 1) * h / tau) * Y[:, source],
+                    axis = 0)
+                error = np.max(np.abs(v - ys - (g[0] + g[1] * dt) * dt) /
+                               (atol + rtol * np.maximum(np.abs(ys),
+                                                         np.abs(v))),
+                               initial = 0)
+                if (error <= 1):
+                    ys_k = v
+                    ys_steps.append(v)
+                return error
+            return check
+        
+        t = t0
+        n_fast, n_slow = 0, 0
+        h = dt / 10 # Substep
+        while (t < t1):
+            # Second-order prediction of the slow filters from the
+            # derivatives of the filters and of their sources
+            dy = full_sys(i_app(t), y)
+            ys = y[slow]
+            g = np.array([dy[slow], (dy[source] - dy[slow]) / (2 * tau)])
+            t_stop = t + dt * (1 - 1e-9)
+            
+            # Fast substeps with the slow filters following the prediction,
+            # until the end of the macro-step or until the slow filters
+            # leave its tolerance
+            ys_steps = []
+            if (single):
+                f = split.fast_sys(y, g, t, i_app)
+                if (stats is not None):
+                    f = stats.wrap_sys(f)
+                steps, h, n_calls, n_rejected = dopri_steps_float(
+                    f, t, y[fast].tolist(), t_stop, t1, h, rtol, atol,
+                    check_float(t, ys, g, ys_steps), dy[fast].tolist())
+                Y = np.empty((len(steps), y.size))
+                Y[:, fast] = [y_k for _, y_k in steps]
+            else:
+                if (split is not None):
+                    sys = split.macro_sys(y)
+                    if (stats is not None):
+                        sys = stats.wrap_sys(sys)
+                else:
+                    sys = full_sys
+                def f(s, y, out, t0 = t, g = g, sys = sys):
+                    sys(i_app(s), y, out)
+                    out[slow] = g[0] + 2 * g[1] * (s - t0)
+                steps, h, n_calls, n_rejected = dopri_steps(
+                    f, t, y, t_stop, t1, h, rtol, atol, fast,
+                    check_array(t, ys, g, ys_steps), dy)
+                Y = np.array([y_k for _, y_k in steps])
+            Y[:, slow] = ys_steps
+            n_fast += n_calls + 1
+            n_slow += 1
+            if (stats is not None):
+                stats.n_accepted += len(steps)
+                stats.n_rejected += n_rejected
+            
+            for (t, _), y in zip(steps, Y):
+                yield t, y
+        
+        return n_fast, n_slow
+    
+    def _kernel(self):
+        """
+        Returns the compiled kernel of the system, or None if the NumPy
+        backend is used
+        """
+        if (self.backend != "numba"):
+            return None
+        kernel = getattr(self, '_compiled_kernel', None)
+        if (kernel is None) or (kernel.system is not self):
+            from kernels import compile_kernel
+            kernel = compile_kernel(self)
+            if (kernel is None):
+                return None
+            self._compiled_kernel = kernel
+        return kernel
+    
+    def _odesys_jac(self, i_app, dense = False, stats = None, buffers = 0):
+        """
+        Returns f(t, y) and J(t, y) for the scipy solvers, counted and timed
+        by stats if given
+        
+        With buffers > 0, f writes into a cycle of that many preallocated
+        arrays instead of returning a new array: for the fixed-step methods,
+        whose sys calls of a step are consumed within the step. The scipy
+        solvers keep the returned derivatives across steps (e.g. RK45.f),
+        so they need buffers = 0.
+        """
+        kernel = self._kernel()
+        sys = self.sys if (kernel is None) else kernel.sys
+        system_jac = self.jac
+        if (stats is not None):
+            parts = self._sys_parts if (kernel is None) else None
+            sys = stats.wrap_sys(sys, parts)
+            system_jac = stats.wrap_jac(system_jac)
+        
+        if (buffers > 0):
+            cycle = itertools.cycle(list(np.empty((buffers, len(self.y0)))))
+            def odesys(t, y):
+                return sys(i_app(t), y, next(cycle))
+        else:
+            def odesys(t, y):
+                return sys(i_app(t), y)
+        
+        def jac(t, y):
+            J = system_jac(i_app(t), y)
+            if (dense and issparse(J)):
+                J = J.toarray()
+            return J
+        
+        return odesys, jac
+    
     def set_solver(self, solver, i_app, t0, sstep, dt = 1):
-        def odesys(t, y):
-            return self.sys(i_app(t), y)
+        self._solver_stats = None
+        if (self.profiler is not None):
+            self._solver_stats = self.profiler.start(solver)
+            i_app = self._solver_stats.wrap_i_app(i_app)
+            if (solver in self.implicit_solvers):
+                self._solver_stats.n_rejected = None
+        fixed_step, n_calls = self._fixed_step_method(solver)
+        odesys, jac = self._odesys_jac(i_app, dense = (solver == "LSODA"),
+                                       stats = self._solver_stats,
+                                       buffers = n_calls)
         
-        if (solver == "Euler"):
+        kernel = self._kernel()
+        if (kernel is not None) and (solver in kernel.methods):
+            self.solver = KernelSolver(kernel, solver, i_app, t0, self.y0, dt)
+        elif (solver == "Euler"):
             self.solver = EulerSolver(odesys, t0, self.y0, dt)  
-        elif (solver == "BDF"):
-            self.solver = BDF(odesys, t0, self.y0, np.inf, max_step = sstep)
+        elif (fixed_step is not None):
+            self.solver = FixedStepSolver(fixed_step, odesys, t0, self.y0, dt)
+        elif (solver in self.implicit_solvers):
+            self.solver = self.implicit_solvers[solver](odesys, t0, self.y0,
+                                                        np.inf,
+                                                        max_step = sstep,
+                                                        jac = jac)
         else:
             raise ValueError("Undefined solver")
     
     def step(self):
+        stats = self._solver_stats
+        if (stats is not None):
+            start = clock()
+        
         msg = self.solver.step()
         t = self.solver.t
         y = self.solver.y
         if msg:
             raise ValueError('Solver terminated with message: %s ' % msg)
-            
+        
+        if (stats is not None):
+            self._count_steps(stats, 1, clock() - start)
         return t,y
     
-    def simulate(self, trange, i_app, method = "Default", dt = 1):
-        def odesys(t, y):
-            return self.sys(i_app(t), y)
+    def _count_steps(self, stats, n, elapsed):
+        if isinstance(self.solver, KernelSolver):
+            stats.nfev += n * self._fixed_step_method(self.solver.method)[1]
+        stats.nlu = int(getattr(self.solver, 'nlu', 0))
+        self.profiler.steps_done(stats, n, elapsed)
+    
+    def steps(self, n, index = None):
+        """
+        Iterates n simulation steps and returns the times (n,) and the
+        states y[index] after every step, shape (len(index), n)
+        """
+        if (index is None):
+            index = np.arange(len(self.y0))
+        if hasattr(self.solver, 'steps'):
+            stats = self._solver_stats
+            if (stats is None):
+                return self.solver.steps(n, index)
+            start = clock()
+            t, y = self.solver.steps(n, index)
+            self._count_steps(stats, n, clock() - start)
+            return t, y
         
-        if (method == "Default"):
-            sol = solve_ivp(odesys, trange, self.y0)
-        elif (method == "Euler"):
-            print("Not implemented")
-        else:
-            raise ValueError("Undefined solver")
-            
+        t = np.empty(n)
+        y = np.empty((len(index), n))
+        for k in range(n):
+            t[k], y_k = self.step()
+            y[:, k] = y_k[index]
+        return t, y
+    
+    def simulate(self, trange, i_app, method = "Default", dt = 1,
+                 record = None, dt_out = None, callback = None,
+                 chunk_size = 10000, checkpoint = None, resume = None):
+        """
+        Simulate over trange with i_app(t), where method is either Default
+        (solve_ivp RK45), an implicit solver, a fixed-step method with
+        step size dt or Multirate with fast substeps of at most dt
+        
+        kwargs:
+            record: indices of the recorded states (all states by default),
+            e.g. Network.neuron_index for the membrane voltages only
+            dt_out: output time step (every solver step by default), the
+            output of all methods is on the grid t0 + k * dt_out. The
+            fixed-step methods output every dt_out / dt steps if dt_out is a
+            multiple of dt, and otherwise interpolate linearly between steps
+            callback: f(t, y) called with each output chunk instead of
+            storing the output, in which case the returned solution only
+            contains the final output sample
+            chunk_size: number of output samples per chunk
+            checkpoint: checkpoint.Checkpointer writing the state of the
+            simulation at regular intervals
+            resume: checkpoint.Checkpoint to continue from, in which case the
+            output starts after the checkpoint (see checkpoint.resume)
+        
+        With the profiler enabled (see profile), the solution has the
+        SimulationStats of the run as its stats attribute.
+        """
+        plain = ((record is None) and (dt_out is None) and (callback is None)
+                 and (checkpoint is None) and (resume is None))
+        if (plain) and (self.profiler is None):
+            if (method == "Default"):
+                return solve_ivp(self._odesys_jac(i_app)[0], trange, self.y0)
+            if (method in self.implicit_solvers):
+                odesys, jac = self._odesys_jac(i_app,
+                                               dense = (method == "LSODA"))
+                return solve_ivp(odesys, trange, self.y0, method = method,
+                                 jac = jac)
+        
+        # Fixed-step output fits in a single preallocated chunk
+        if (callback is None) and (self._fixed_step_method(method)[0]
+                                   is not None):
+            skip = output_skip(dt, dt_out)
+            if (skip is None):
+                chunk_size = int((trange[1] - trange[0]) / dt_out + 1e-9) + 2
+            else:
+                chunk_size = int(np.ceil((trange[1] - trange[0]) / dt - 1e-9)
+                                 / skip) + 2
+        
+        chunks = self.iterate(trange, i_app, method, dt, record, dt_out,
+                              chunk_size, checkpoint, resume)
+        t_list, y_list = [], []
+        while True:
+            try:
+                t, y = next(chunks)
+            except StopIteration as stop:
+                sol = stop.value
+                break
+            if (callback is None):
+                t_list.append(t)
+                y_list.append(y)
+            else:
+                callback(t, y)
+                t_list, y_list = [t[-1:]], [y[:, -1:]]
+        
+        if (len(t_list) == 0):
+            # No output, e.g. when resuming at the end of trange
+            n_record = len(self.y0) if (record is None) else np.size(record)
+            t_list, y_list = [np.empty(0)], [np.empty((n_record, 0))]
+        sol.t = np.concatenate(t_list)
+        sol.y = np.concatenate(y_list, axis = 1)
         return sol
+    
+    def detect_spikes(self, trange, i_app, method = "Default", dt = 1,
+                      threshold = 0, refractory = 0, max_isi = None,
+                      min_spikes = 2, keep_trace = False, dt_out = None,
+                      chunk_size = 10000):
+        """
+        Simulate and detect the spikes of every neuron as the upward crossings
+        of threshold by its membrane voltage, processing the output in chunks
+        
+        kwargs:
+            threshold: spike threshold, scalar or one value per neuron
+            refractory: minimum interval between two spikes of a neuron
+            max_isi: if given, spikes are grouped into bursts of at least
+            min_spikes spikes separated by at most max_isi
+            keep_trace: if True, the membrane voltage traces are kept
+            dt_out: output time step used for detection (by default every
+            solver step)
+        
+        Returns a SpikeTrains object
+        """
+        index = self.membrane_index()
+        detector = SpikeDetector(index.size, threshold, refractory)
+        
+        t_list, V_list = [], []
+        def process(t, V):
+            detector.update(t, V)
+            if (keep_trace):
+                t_list.append(t)
+                V_list.append(V)
+        
+        sol = self.simulate(trange, i_app, method, dt, record = index,
+                            dt_out = dt_out, callback = process,
+                            chunk_size = chunk_size)
+        
+        t, V = None, None
+        if (keep_trace):
+            t = np.concatenate(t_list)
+            V = np.concatenate(V_list, axis = 1)
         
+        return SpikeTrains(detector.get_spikes(), max_isi, min_spikes, t, V,
+                           sol)
+    
+    def iterate(self, trange, i_app, method = "Default", dt = 1,
+                record = None, dt_out = None, chunk_size = 1000,
+                checkpoint = None, resume = None):
+        """
+        Generator yielding the simulation output in chunks (t, y), where t
+        has shape (k,) and y has shape (len(record), k) with k <= chunk_size
+        Arguments are the same as for simulate
+
+        The generator returns a solve_ivp-like solution without t and y
+        """
+        if (self.profiler is None):
+            return (yield from self._iterate(trange, i_app, method, dt,
+                                             record, dt_out, chunk_size,
+                                             None, checkpoint, resume))
+
+        stats = self.profiler.start(method)
+        chunks = self._iterate(trange, stats.wrap_i_app(i_app), method, dt,
+                               record, dt_out, chunk_size, stats, checkpoint,
+                               resume)
+        return (yield from self.profiler.chunks(chunks, stats))
+
+    def _iterate(self, trange, i_app, method, dt, record, dt_out, chunk_size,
+                 stats = None, checkpoint = None, resume = None):
+        fixed_step, n_calls = self._fixed_step_method(method)
+        odesys, jac = self._odesys_jac(i_app, dense = (method == "LSODA"),
+                                       stats = stats, buffers = n_calls)
+
+        t0, t1 = trange
+        if (record is None):
+            record = np.arange(len(self.y0))
+        record = np.asarray(record, dtype = int)
+
+        t_buf = np.empty(chunk_size)
+        y_buf = np.empty((chunk_size, record.size))
+        k = 0 # Number of samples in the current chunk
+
+        # Start from the initial conditions or from a checkpoint, in which
+        # case the output continues after the checkpoint
+        if (resume is None):
+            t_start = t0
+            y_start = np.array(self.y0, dtype = float)
+            step_start = 0
+            n_samples = 1 # Output samples produced
+            n_out = 1 # Index of the next point of the dt_out output grid
+            counts = {}
+            t_buf[0] = t0
+            y_buf[0] = y_start[record]
+            k = 1
+        else:
+            t_start = resume.t
+            y_start = np.array(resume.y, dtype = float)
+            step_start = resume.step
+            n_samples = resume.samples
+            n_out = resume.n_out
+            counts = resume.counts
+
+        if (checkpoint is not None):
+            checkpoint.start(self, t_start, method = method, trange = trange,
+                             dt = dt, record = record, dt_out = dt_out,
+                             chunk_size = chunk_size)
+
+        def flush():
+            # Pass the buffered samples on before writing a checkpoint
+            nonlocal t_buf, y_buf, k
+            if (k > 0):
+                yield t_buf[:k], y_buf[:k].T
+                t_buf = np.empty(chunk_size)
+                y_buf = np.empty((chunk_size, record.size))
+                k = 0
+
+        kernel = self._kernel()
+        if (kernel is not None) and (method in kernel.methods):
+            n_steps = int(np.ceil((t1 - t0) / dt - 1e-9))
+            t = np.minimum(t0 + dt * np.arange(n_steps + 1), t1)
+            skip = output_skip(dt, dt_out)
+            interpolate = (skip is None)
+            if (interpolate):
+                skip = 1
+
+            # Compiled steps in blocks of at most one output chunk, ending at
+            # the checkpoint times; only the output samples are recorded by
+            # the loops, or every step if the output is interpolated
+            y = y_start
+            y_prev = y_start[record]
+            block = min(skip * chunk_size, kernel.block_size)
+            start = step_start
+            while (start < n_steps):
+                stop = min(start + block, n_steps)
+                if (checkpoint is not None):
+                    stop = min(stop, max(start + 1, int(np.searchsorted(
+                        t, checkpoint.next_t))))
+                if (stats is not None):
+                    clock_start, t_i_app = clock(), stats.t_i_app
+                y, y_out = kernel.run(method, y, t[start:stop+1], i_app,
+                                      record, skip, start)
+                if (stats is not None):
+                    # Compiled loop: sys calls are not timed separately
+                    stats.t_sys += (clock() - clock_start -
+                                    (stats.t_i_app - t_i_app))
+                    stats.nfev += (stop - start) * n_calls
+                if (interpolate):
+                    # Linear interpolation onto the output grid
+                    t_steps = t[start:stop+1]
+                    y_steps = np.vstack((y_prev, y_out))
+                    y_prev = y_steps[-1]
+                    n_stop = int((t[stop] - t0) / dt_out + 1e-9) + 1
+                    t_out = np.minimum(t0 + dt_out * np.arange(n_out, n_stop),
+                                       t1)
+                    y_out = np.empty((t_out.size, record.size))
+                    for r in range(record.size):
+                        y_out[:, r] = np.interp(t_out, t_steps, y_steps[:, r])
+                    n_out = max(n_out, n_stop)
+                else:
+                    t_out = t[start + skip - start % skip:stop + 1:skip]
+                    if (stop == n_steps) and (n_steps % skip != 0):
+                        t_out = np.append(t_out, t[n_steps])
+                        y_out = np.vstack((y_out, y[record]))
+                n_samples += t_out.size
+
+                pos = 0
+                while (pos < t_out.size):
+                    if (k == chunk_size):
+                        yield t_buf, y_buf.T
+                        t_buf = np.empty(chunk_size)
+                        y_buf = np.empty((chunk_size, record.size))
+                        k = 0
+                    m = min(chunk_size - k, t_out.size - pos)
+                    t_buf[k:k+m] = t_out[pos:pos+m]
+                    y_buf[k:k+m] = y_out[pos:pos+m]
+                    k += m
+                    pos += m
+
+                if (checkpoint is not None) and (stop < n_steps) and (
+                        checkpoint.due(t[stop])):
+                    yield from flush()
+                    checkpoint.save(t[stop], y, step = stop,
+                                    samples = n_samples, n_out = n_out)
+                start = stop
+
+            sol = OptimizeResult(nfev = n_steps * n_calls, njev = 0, nlu = 0)
+            if (stats is not None):
+                stats.n_accepted = n_steps - step_start
+        elif (fixed_step is not None):
+            n_steps = int(np.ceil((t1 - t0) / dt - 1e-9))
+            t = np.minimum(t0 + dt * np.arange(n_steps + 1), t1)
+            skip = output_skip(dt, dt_out)
+
+            y = y_start
+            y_prev = y_start[record]
+            for step in range(step_start + 1, n_steps + 1):
+                y = fixed_step(odesys, t[step-1], y, t[step] - t[step-1])
+                if (skip is None):
+                    # Linear interpolation onto the output grid
+                    samples = []
+                    while (t0 + n_out * dt_out <= t[step] + 1e-9 * dt_out):
+                        t_k = min(t0 + n_out * dt_out, t1)
+                        s = (t_k - t[step-1]) / (t[step] - t[step-1])
+                        samples.append((t_k, (1 - s) * y_prev +
+                                        s * y[record]))
+                        n_out += 1
+                    y_prev = y[record]
+                elif (step % skip == 0) or (step == n_steps):
+                    samples = [(t[step], y[record])]
+                else:
+                    samples = []
+
+                for t_k, y_k in samples:
+                    if (k == chunk_size):
+                        yield t_buf, y_buf.T
+                        t_buf = np.empty(chunk_size)
+                        y_buf = np.empty((chunk_size, record.size))
+                        k = 0
+                    t_buf[k] = t_k
+                    y_buf[k] = y_k
+                    k += 1
+                n_samples += len(samples)
+
+                if (checkpoint is not None) and (step < n_steps) and (
+                        checkpoint.due(t[step])):
+                    yield from flush()
+                    checkpoint.save(t[step], y, step = step,
+                                    samples = n_samples, n_out = n_out)
+
+            sol = OptimizeResult(nfev = n_steps * n_calls, njev = 0, nlu = 0)
+            if (stats is not None):
+                stats.n_accepted = n_steps - step_start
+        elif (method == "Multirate"):
+            steps = self._multirate_steps(i_app, t_start, t1, dt, stats,
+                                          y_start)
+            t_prev, y_prev = t_start, y_start[record]
+            while True:
+                try:
+                    t, y = next(steps)
+                except StopIteration as stop:
+                    n_fast, n_slow = stop.value
+                    break
+
+                if (dt_out is None):
+                    samples = [(t, y[record])]
+                else:
+                    # Linear interpolation onto the output grid
+                    samples = []
+                    while (t0 + n_out * dt_out <= min(t, t1) + 1e-9 * dt):
+                        t_k = min(t0 + n_out * dt_out, t1)
+                        s = (t_k - t_prev) / (t - t_prev)
+                        samples.append((t_k, (1 - s) * y_prev +
+                                        s * y[record]))
+                        n_out += 1
+                t_prev, y_prev = t, y[record]
+
+                for t_k, y_k in samples:
+                    if (k == chunk_size):
+                        yield t_buf, y_buf.T
+                        t_buf = np.empty(chunk_size)
+                        y_buf = np.empty((chunk_size, record.size))
+                        k = 0
+                    t_buf[k] = t_k
+                    y_buf[k] = y_k
+                    k += 1
+                n_samples += len(samples)
+
+                if (checkpoint is not None) and (t < t1) and (
+                        checkpoint.due(t)):
+                    yield from flush()
+                    checkpoint.save(t, y, samples = n_samples, n_out = n_out)
+
+            sol = OptimizeResult(nfev = n_fast, nslow = n_slow, njev = 0,
+                                 nlu = 0)
+        else:
+            from checkpoint import solver_state, solver_options, restore_solver
+
+            options = {}
+            if (resume is not None):
+                options = solver_options(resume.solver)
+            if (method == "Default"):
+                solver = RK45(odesys, t_start, y_start, t1)
+            elif (method in self.implicit_solvers):
+                solver = self.implicit_solvers[method](odesys, t_start,
+                                                       y_start, t1, jac = jac,
+                                                       **options)
+            else:
+                raise ValueError("Undefined solver")
+            if (resume is not None):
+                restore_solver(solver, resume.solver)
+
+            # Explicit Runge-Kutta steps take n_stages evaluations per attempt
+            n_stages = getattr(solver, 'n_stages', None)
+            if (stats is not None) and (n_stages is None):
+                stats.n_rejected = None
+
+            def solver_counts():
+                return {name: counts.get(name, 0) + getattr(solver, name)
+                        for name in ('nfev', 'njev', 'nlu')}
+
+            while (solver.status == "running"):
+                if (stats is not None):
+                    nfev = solver.nfev
+                solver.step()
+                if (solver.status == "failed"):
+                    break
+                if (stats is not None):
+                    stats.n_accepted += 1
+                    if (n_stages is not None):
+                        attempts = (solver.nfev - nfev) // n_stages
+                        stats.n_rejected += attempts - 1
+
+                if (dt_out is None):
+                    t_new = [solver.t]
+                    y_new = [solver.y[record]]
+                else:
+                    # Interpolate onto the output grid within the last step,
+                    # up to rounding of the grid times
+                    t_new, y_new = [], []
+                    while (t0 + n_out * dt_out <= min(solver.t, t1) +
+                           1e-9 * dt_out):
+                        t_new.append(min(t0 + n_out * dt_out, t1))
+                        n_out += 1
+                    if (len(t_new) > 0):
+                        y_new = solver.dense_output()(t_new)[record].T
+
+                for t_k, y_k in zip(t_new, y_new):
+                    if (k == chunk_size):
+                        yield t_buf, y_buf.T
+                        t_buf = np.empty(chunk_size)
+                        y_buf = np.empty((chunk_size, record.size))
+                        k = 0
+                    t_buf[k] = t_k
+                    y_buf[k] = y_k
+                    k += 1
+                n_samples += len(t_new)
+
+                if (checkpoint is not None) and (solver.t < t1) and (
+                        checkpoint.due(solver.t)):
+                    yield from flush()
+                    checkpoint.save(solver.t, solver.y,
+                                    solver = solver_state(solver),
+                                    samples = n_samples, n_out = n_out,
+                                    counts = solver_counts())
+
+            sol = OptimizeResult(**solver_counts())
+            if (stats is not None):
+                stats.nlu = int(solver.nlu)
+            if (solver.status == "failed"):
+                sol.status = -1
+                sol.message = "Solver failed at t = %s" % solver.t
+                sol.success = False
+
+        if (k > 0):
+            yield t_buf[:k], y_buf[:k].T
+
+        sol.setdefault("status", 0)
+        sol.setdefault("message", "The solver successfully reached the end "
+                       "of the integration interval.")
+        sol.setdefault("success", True)
+        sol.update(sol = None, t_events = None, y_events = None)
+        return sol
 
 class SingleTimescaleElement():
     """
@@ -98,6 +1211,8 @@ class SingleTimescaleElement():
         v0: initial condition
         v_index: index of Vx, assigned when interconnected in a circuit
         
+    Filters without an initial condition start at the neuron's vx0.
+    
     methods:
         out: Iout for input V
         outx: Iout using the appropriate Vx (when interconnected)
@@ -106,20 +1221,28 @@ class SingleTimescaleElement():
             -> return out(Vrest) if tau > timescale
     """
     
-    vx0 = None # Default initial conditions for first-order filters
-    
     def __init__(self, neuron, timescale, v0):
         self.neuron = neuron
         self.timescale = timescale
         self.v0 = v0
         self.v_index = None
         
+        self._version = 0 # Incremented on every parameter change
+        neuron._invalidate()
+        
         if (timescale == 0) and (v0 is not None):
             raise ValueError("Initial condition of an instantaneous element "
                              "cannot be set")
         
         self._add_timescale(neuron.timescales, neuron.y0)
     
+    def _modified(self):
+        """
+        Register a parameter change with the neuron
+        """
+        self._version += 1
+        self.neuron._invalidate()
+    
     def _add_timescale(self, timescales, y0):
         """
         Add a first-order filter for Vx, or associate the element with an
@@ -134,7 +1257,7 @@ class SingleTimescaleElement():
             if (self.v0):
                 y0.append(self.v0)
             else:
-                y0.append(self.vx0)
+                y0.append(self.neuron.vx0)
                 
     def out(self, V):
         """
@@ -157,6 +1280,575 @@ class SingleTimescaleElement():
         else:
             return self.out(Vrest)
         
+class NeuronArrays():
+    """
+    Element parameters of a neuron collected into arrays, so that the neuron
+    dynamics are evaluated with a fixed number of vectorized operations
+    
+    args:
+        neuron: neuron whose elements are compiled
+    
+    attributes:
+        C: membrane capacitance
+        tau: time constants of the first-order filters y[1:]
+        a, voff, v_index: current element parameters and filter indices
+        k, gate_voff, gate_index: gating variable parameters and filter indices
+        g_max, E_rev: parameters of the conductance elements with gates
+        gate_start: index of the first gate of each conductance element, gates
+        of the same element being contiguous
+        gate_cond: conductance element of each gate
+        g_leak, gE_leak: sum of g_max and g_max * E_rev of the conductance
+        elements without gates
+    
+    Parameter arrays can be replaced by arrays with an additional leading
+    dimension and used with states y of shape (..., len(tau) + 1)
+    
+    methods:
+        stack: combine the arrays of neurons with identical structure
+        i_sum: sum(Ix) for all conductance/circuit elements
+        di_sum: gradient of i_sum with respect to the state
+        dIV_ss: derivative of the steady-state IV curve
+        sys: state vector update
+        sys_parts: sys with the element types timed separately
+        jac: Jacobian of the state vector update
+    """
+    
+    # Attributes that can differ between neurons with identical structure
+    _parameters = ('C', 'tau', 'a', 'voff', 'k', 'gate_voff', 'g_max', 'E_rev',
+                   'g_leak', 'gE_leak')
+    
+    def __init__(self, neuron):
+        self.C = neuron.C
+        self.tau = np.array(neuron.timescales[1:], dtype = float)
+        
+        currents = [el for el in neuron.elements
+                    if isinstance(el, Neuron.CurrentElement)]
+        conductances = [el for el in neuron.elements
+                        if isinstance(el, Neuron.ConductanceElement)]
+        leaks = [el for el in conductances if not el.gates]
+        conductances = [el for el in conductances if el.gates]
+        gates = [x for el in conductances for x in el.gates]
+        
+        self.a = np.array([el.a for el in currents], dtype = float)
+        self.voff = np.array([el.voff for el in currents], dtype = float)
+        self.v_index = np.array([el.v_index for el in currents], dtype = int)
+        
+        self.k = np.array([x.k for x in gates], dtype = float)
+        self.gate_voff = np.array([x.voff for x in gates], dtype = float)
+        self.gate_index = np.array([x.v_index for x in gates], dtype = int)
+        
+        self.g_max = np.array([el.g_max for el in conductances], dtype = float)
+        self.E_rev = np.array([el.E_rev for el in conductances], dtype = float)
+        
+        n_gates = [len(el.gates) for el in conductances]
+        self.gate_start = np.cumsum([0] + n_gates[:-1], dtype = int)
+        self.gate_cond = np.repeat(np.arange(len(conductances)), n_gates)
+        
+        # Single gate per conductance: product is the gate itself
+        self._single_gate = (len(gates) == len(conductances))
+        
+        self.g_leak = float(sum(el.g_max for el in leaks))
+        self.gE_leak = float(sum(el.g_max * el.E_rev for el in leaks))
+        
+        # Parameters of a single neuron as Python floats, see _sys_single
+        self._single = ([(el.v_index, el.voff, el.a) for el in currents],
+                        [(el.g_max, el.E_rev,
+                          [(x.v_index, x.k, x.voff) for x in el.gates])
+                         for el in conductances],
+                        [float(tau) for tau in neuron.timescales[1:]])
+    
+    @classmethod
+    def stack(cls, arrays_list):
+        """
+        Combine the arrays of neurons with identical structure into arrays
+        with a leading ensemble dimension (parameters shared by all neurons
+        are kept unbatched)
+        """
+        arrays = copy.copy(arrays_list[0])
+        arrays._single = None
+        for name in ('v_index', 'gate_index', 'gate_start'):
+            if any(not np.array_equal(getattr(arrays, name), getattr(a, name))
+                   for a in arrays_list[1:]):
+                raise ValueError("Neurons do not have identical structure")
+        
+        for name in cls._parameters:
+            values = [getattr(a, name) for a in arrays_list]
+            if any(not np.array_equal(values[0], v) for v in values[1:]):
+                setattr(arrays, name, np.array(values, dtype = float))
+        
+        return arrays
+    
+    def gate_product(self, y):
+        """
+        Returns the product of the gating variables of each conductance
+        """
+        x = sigmoid(y[..., self.gate_index] - self.gate_voff, self.k)
+        if (self._single_gate):
+            return x
+        
+        return np.multiply.reduceat(x, self.gate_start, axis = -1)
+    
+    def i_sum(self, y):
+        y = np.asarray(y)
+        V = y[..., 0]
+        
+        s = self.g_leak * V - self.gE_leak
+        if (self.a.size > 0):
+            s = s + _dot(tanh(y[..., self.v_index] - self.voff), self.a)
+        if (self.g_max.size > 0):
+            s = s + _dot((V[..., None] - self.E_rev) * self.gate_product(y),
+                         self.g_max)
+        
+        return s
+    
+    def di_sum(self, y):
+        y = np.asarray(y)
+        n = y.shape[-1]
+        V = y[..., 0]
+        
+        d = np.zeros(y.shape)
+        d[..., 0] = self.g_leak
+        
+        # d/dVx a * tanh(Vx - voff) = a * (1 - tanh^2)
+        if (self.a.size > 0):
+            th = tanh(y[..., self.v_index] - self.voff)
+            d += _scatter(self.a * (1 - th**2), self.v_index, n)
+        
+        # d/dVx of g_max * (V - E_rev) * x1 * ... * xn, using
+        # dxj/dVx = k * xj * (1 - xj)
+        if (self.g_max.size > 0):
+            x = sigmoid(y[..., self.gate_index] - self.gate_voff, self.k)
+            if (self._single_gate):
+                P = x
+            else:
+                P = np.multiply.reduceat(x, self.gate_start, axis = -1)
+            I = self.g_max * (V[..., None] - self.E_rev) * P
+            d[..., 0] += (self.g_max * P).sum(axis = -1)
+            d += _scatter(I[..., self.gate_cond] * self.k * (1 - x),
+                          self.gate_index, n)
+        
+        return d
+    
+    def dIV_ss(self, V):
+        V = np.asarray(V, dtype = float)
+        
+        d = self.g_leak + np.zeros(V.shape)
+        if (self.a.size > 0):
+            th = tanh(V[..., None] - self.voff)
+            d = d + _dot(1 - th**2, self.a)
+        if (self.g_max.size > 0):
+            x = sigmoid(V[..., None] - self.gate_voff, self.k)
+            if (self._single_gate):
+                P = x
+                S = self.k * (1 - x)
+            else:
+                P = np.multiply.reduceat(x, self.gate_start, axis = -1)
+                S = np.add.reduceat(self.k * (1 - x), self.gate_start,
+                                    axis = -1)
+            # d/dV g_max * (V - E_rev) * P = g_max * P * (1 + (V - E_rev) * S)
+            d = d + _dot(P * (1 + (V[..., None] - self.E_rev) * S),
+                         self.g_max)
+        
+        return d
+    
+    def jac(self, y):
+        y = np.asarray(y)
+        n = y.shape[-1]
+        J = np.zeros(y.shape + (n,))
+        
+        J[..., 0, :] = -self.di_sum(y) / np.asarray(self.C)[..., None]
+        
+        # First-order filters
+        rows = np.arange(1, n)
+        J[..., rows, 0] = 1 / self.tau
+        J[..., rows, rows] = -1 / self.tau
+        
+        return J
+    
+    def sys(self, i_app, y, out = None):
+        if (self._single is not None) and (type(y) is np.ndarray) and (
+                y.ndim == 1):
+            try:
+                return self._sys_single(i_app, y, out)
+            except OverflowError:
+                pass # Saturated gates, evaluated below
+        
+        y = np.asarray(y)
+        if (out is None):
+            out = np.empty(y.shape)
+        
+        out[..., 0] = (i_app - self.i_sum(y)) / self.C
+        
+        # First-order filters
+        out[..., 1:] = (y[..., :1] - y[..., 1:]) / self.tau
+        
+        return out
+    
+    def _sys_single(self, i_app, y, out = None):
+        """
+        sys for the state y of a single neuron, evaluated element by element
+        with Python floats: for the few elements of a neuron this is faster
+        than the array operations, whose overhead is paid on every call
+        """
+        currents, conductances, tau = self._single
+        y = y.tolist()
+        V = y[0]
+        
+        s = self.g_leak * V - self.gE_leak
+        for index, voff, a in currents:
+            s += a * math.tanh(y[index] - voff)
+        for g_max, E_rev, gates in conductances:
+            I = g_max * (V - E_rev)
+            for index, k, voff in gates:
+                I /= 1 + math.exp(-k * (y[index] - voff))
+            s += I
+        
+        dy = [(i_app - s) / self.C]
+        dy += [(V - y_x) / tau_x for y_x, tau_x in zip(y[1:], tau)]
+        if (out is None):
+            return np.array(dy)
+        out[:] = dy
+        return out
+    
+    def sys_parts(self, i_app, y, timer, out = None):
+        """
+        Evaluates sys with the current elements, the conductance elements and
+        the first-order filters timed by timer.section(name)
+        """
+        y = np.asarray(y)
+        if (out is None):
+            out = np.empty(y.shape)
+        V = y[..., 0]
+        
+        with timer.section("ConductanceElement"):
+            s = self.g_leak * V - self.gE_leak
+            if (self.g_max.size > 0):
+                s = s + _dot((V[..., None] - self.E_rev) *
+                             self.gate_product(y), self.g_max)
+        with timer.section("CurrentElement"):
+            if (self.a.size > 0):
+                s = s + _dot(tanh(y[..., self.v_index] - self.voff), self.a)
+        with timer.section("filters"):
+            out[..., 0] = (i_app - s) / self.C
+            out[..., 1:] = (y[..., :1] - y[..., 1:]) / self.tau
+        
+        return out
+        
+class MultirateArrays():
+    """
+    Split of NeuronArrays into the fast dynamics and the slow terms of the
+    membrane current for the Multirate method. The slow terms are the current
+    of the elements on slow filters and the product of the slow gates of every
+    gated conductance.
+    
+    args:
+        arrays: NeuronArrays of a neuron or a batch of neurons
+        slow: indices of the slow filters in the neuron state
+    
+    attributes:
+        fast: indices of the membrane voltage and the fast filters
+        single: True for a single neuron, whose fast states are integrated
+        with fast_sys
+    
+    methods:
+        linearize: linearization of the slow terms in the slow filters
+        macro_sys: state vector update within a macro-step
+        fast_sys: update of the fast states of a single neuron within a
+        macro-step, on Python floats
+        sys: state vector update with the linearized slow terms
+    """
+    
+    def __init__(self, arrays, slow):
+        A = self.arrays = arrays
+        self.slow = np.asarray(slow, dtype = int)
+        position = np.full(len(A.tau) + 1, -1)
+        position[self.slow] = np.arange(self.slow.size)
+        
+        cur_position = position[A.v_index]
+        self.cur_slow = np.nonzero(cur_position >= 0)[0]
+        self.cur_fast = np.nonzero(cur_position < 0)[0]
+        self.cur_position = cur_position[self.cur_slow]
+        
+        gate_position = position[A.gate_index]
+        self.gate_slow = np.nonzero(gate_position >= 0)[0]
+        self.gate_fast = np.nonzero(gate_position < 0)[0]
+        
+        # Maps the slow gates to the (conductance, slow filter) entries of
+        # the derivatives of the gate products
+        n_cond = A.gate_start.size
+        entry = (A.gate_cond[self.gate_slow] * self.slow.size +
+                 gate_position[self.gate_slow])
+        self.gate_map = (entry[:, None] ==
+                         np.arange(n_cond * self.slow.size)).astype(float)
+        
+        # Fast states, and for a single neuron the fast and slow elements
+        # with their filters given by positions in the fast and slow states
+        self.fast = np.setdiff1d(np.arange(len(A.tau) + 1), self.slow)
+        self.single = (A._single is not None)
+        if (self.single):
+            fast = {i: p for p, i in enumerate(self.fast.tolist())}
+            slow = {i: p for p, i in enumerate(self.slow.tolist())}
+            currents, conductances, tau = A._single
+            gates = [[(fast.get(index), slow.get(index), k, voff)
+                      for index, k, voff in el_gates]
+                     for _, _, el_gates in conductances]
+            self._single = (
+                [(fast[index], voff, a) for index, voff, a in currents
+                 if (index in fast)],
+                [(g_max, E_rev,
+                  [(p, k, voff) for p, _, k, voff in el_gates
+                   if (p is not None)],
+                  [(q, k, voff) for _, q, k, voff in el_gates
+                   if (q is not None)])
+                 for (g_max, E_rev, _), el_gates in zip(conductances, gates)],
+                [(fast[i], tau[i-1]) for i in self.fast.tolist()[1:]],
+                [(slow[index], voff, a) for index, voff, a in currents
+                 if (index in slow)])
+    
+    def _currents(self, y, index):
+        A = self.arrays
+        return tanh(y[..., A.v_index[index]] - A.voff[..., index])
+    
+    def _gates(self, y, index):
+        A = self.arrays
+        return sigmoid(y[..., A.gate_index[index]] - A.gate_voff[..., index],
+                       A.k[..., index])
+    
+    def _gate_product(self, x, index, shape):
+        A = self.arrays
+        x_all = np.ones(shape + A.gate_index.shape)
+        x_all[..., index] = x
+        return np.multiply.reduceat(x_all, A.gate_start, axis = -1)
+    
+    def linearize(self, y):
+        """
+        Returns the slow terms, their derivatives with respect to the slow
+        filters and the slow filters at y
+        """
+        A = self.arrays
+        shape = y.shape[:-1]
+        n = self.slow.size
+        
+        th = self._currents(y, self.cur_slow)
+        I = _dot(th, A.a[..., self.cur_slow]) + np.zeros(shape)
+        dI = _scatter(A.a[..., self.cur_slow] * (1 - th**2) +
+                      np.zeros(th.shape), self.cur_position, n)
+        T = [I[..., None]]
+        D = [dI[..., None, :]]
+        
+        if (A.g_max.size > 0):
+            x = self._gates(y, self.gate_slow)
+            P = self._gate_product(x, self.gate_slow, shape)
+            # dP/dVx = P * sum of k * (1 - x) over the gates on Vx
+            dlogP = (A.k[..., self.gate_slow] * (1 - x)) @ self.gate_map
+            T.append(P)
+            D.append(dlogP.reshape(shape + (-1, n)) * P[..., None])
+        
+        return (np.concatenate(T, axis = -1), np.concatenate(D, axis = -2),
+                y[..., self.slow])
+    
+    def macro_sys(self, y):
+        """
+        Returns f(i_app, y, out = None) for the macro-step starting at y,
+        with the slow terms linearized at y. The updates of the slow filters
+        are left to the caller.
+        """
+        lin = self.linearize(y)
+        def macro_sys(i_app, y, out = None):
+            return self.sys(i_app, y, lin, out)
+        return macro_sys
+    
+    def fast_sys(self, y, g, t0, i_app):
+        """
+        Returns f(t, y_fast) for the macro-step of a single neuron starting
+        at time t0 and state y, where y_fast is the list of the fast states
+        (self.fast) as Python floats. The slow terms are linearized along
+        the prediction of the slow filters ys + g[0] * dt + g[1] * dt**2,
+        dt = t - t0.
+        """
+        A = self.arrays
+        currents, conductances, filters, slow_currents = self._single
+        ys = y[self.slow].tolist()
+        g1, g2 = np.asarray(g).tolist()
+        
+        # Slow terms and their derivatives along the prediction
+        I0, I1, I2 = 0.0, 0.0, 0.0
+        for index, voff, a in slow_currents:
+            th = math.tanh(ys[index] - voff)
+            I0 += a * th
+            I1 += a * (1 - th * th) * g1[index]
+            I2 += a * (1 - th * th) * g2[index]
+        gated = []
+        for g_max, E_rev, fast_gates, slow_gates in conductances:
+            P0, dlogP1, dlogP2 = 1.0, 0.0, 0.0
+            for index, k, voff in slow_gates:
+                x = 0.5 + 0.5 * math.tanh(k * (ys[index] - voff) / 2)
+                P0 *= x
+                dlogP1 += k * (1 - x) * g1[index]
+                dlogP2 += k * (1 - x) * g2[index]
+            gated.append((g_max, E_rev, P0, P0 * dlogP1, P0 * dlogP2,
+                          fast_gates))
+        g_leak, gE_leak, C = float(A.g_leak), float(A.gE_leak), float(A.C)
+        
+        def fast_sys(t, y):
+            dt = t - t0
+            V = y[0]
+            
+            s = g_leak * V - gE_leak + I0 + (I1 + I2 * dt) * dt
+            for index, voff, a in currents:
+                s += a * math.tanh(y[index] - voff)
+            for g_max, E_rev, P0, P1, P2, gates in gated:
+                I = g_max * (V - E_rev) * (P0 + (P1 + P2 * dt) * dt)
+                for index, k, voff in gates:
+                    I *= 0.5 + 0.5 * math.tanh(k * (y[index] - voff) / 2)
+                s += I
+            
+            dy = [(i_app(t) - s) / C]
+            dy += [(V - y[index]) / tau for index, tau in filters]
+            return dy
+        return fast_sys
+    
+    def sys(self, i_app, y, lin, out = None):
+        """
+        Returns the state vector update with the slow terms from the
+        linearization lin
+        """
+        A = self.arrays
+        y = np.asarray(y)
+        V = y[..., 0]
+        T0, D0, ys0 = lin
+        T = T0 + (D0 @ (y[..., self.slow] - ys0)[..., None])[..., 0]
+        
+        s = A.g_leak * V - A.gE_leak + T[..., 0]
+        if (self.cur_fast.size > 0):
+            s = s + _dot(self._currents(y, self.cur_fast),
+                         A.a[..., self.cur_fast])
+        if (A.g_max.size > 0):
+            P = T[..., 1:]
+            if (self.gate_fast.size > 0):
+                x = self._gates(y, self.gate_fast)
+                P = P * self._gate_product(x, self.gate_fast, y.shape[:-1])
+            s = s + _dot((V[..., None] - A.E_rev) * P, A.g_max)
+        
+        if (out is None):
+            out = np.empty(y.shape)
+        out[..., 0] = (i_app - s) / A.C
+        out[..., 1:] = (y[..., :1] - y[..., 1:]) / A.tau
+        return out
+
+def region_labels(I, prev_labels, label):
+    """
+    Labels of the intervals between consecutive samples of the IV curves I
+    (..., len(V)): the intervals with negative conductance get label, the
+    others keep prev_labels (..., len(V) - 1)
+    """
+    return np.where(np.diff(I, axis = -1) < 0, label, prev_labels)
+
+def label_segments(labels):
+    """
+    Run-length encoding of a label array
+    Returns the (start, end) sample indices of the segments of constant label
+    and their labels
+    """
+    change = np.nonzero(labels[1:] != labels[:-1])[0] + 1
+    starts = np.concatenate(([0], change))
+    ends = np.concatenate((change, [labels.size]))
+    return starts, ends, labels[starts]
+
+class IVEvaluator():
+    """
+    Evaluates the IV curves of a neuron over a fixed voltage range V in
+    several timescales at once. The outputs of every element over V are
+    cached and only recomputed for elements whose parameters have changed.
+    
+    args:
+        neuron: neuron whose IV curves are evaluated
+        V: voltage range
+    
+    methods:
+        IV: (len(taus), len(V)) array of the IV curves in timescales taus
+        IV_ss: steady-state IV curve
+    """
+    
+    def __init__(self, neuron, V):
+        self.neuron = neuron
+        self.V = np.asarray(V, dtype = float)
+        self._elements = None
+    
+    def _update_cache(self):
+        neuron = self.neuron
+        currents = [el for el in neuron.elements
+                    if isinstance(el, Neuron.CurrentElement)]
+        conductances = [el for el in neuron.elements
+                        if isinstance(el, Neuron.ConductanceElement)]
+        gates = [x for el in conductances for x in el.gates]
+        
+        # Rebuild the cache if elements were added
+        elements = currents + conductances + gates
+        if (self._elements != elements):
+            self._elements = elements
+            self._versions = [None] * len(elements)
+            self.currents = currents
+            self.conductances = conductances
+            self.gates = gates
+            self.I_current = np.empty((len(currents), self.V.size))
+            self.I_linear = np.empty((len(conductances), self.V.size))
+            self.x_gate = np.empty((len(gates), self.V.size))
+            self.current_timescale = np.array([el.timescale for el in
+                                               currents], dtype = float)
+            self.gate_timescale = np.array([x.timescale for x in gates],
+                                           dtype = float)
+            self.gate_cond = [c for c, el in enumerate(conductances)
+                              for x in el.gates]
+        
+        # Recompute the outputs of the modified elements only
+        n_cur = len(currents)
+        n_cond = len(conductances)
+        for i, el in enumerate(elements):
+            if (self._versions[i] == el._version):
+                continue
+            self._versions[i] = el._version
+            if (i < n_cur):
+                self.I_current[i] = el.out(self.V)
+            elif (i < n_cur + n_cond):
+                self.I_linear[i - n_cur] = el.g_max * (self.V - el.E_rev)
+            else:
+                self.x_gate[i - n_cur - n_cond] = el.out(self.V)
+    
+    def _gate_product(self, x):
+        prod = np.ones(x.shape[:-2] + (len(self.conductances), self.V.size))
+        for i, c in enumerate(self.gate_cond):
+            prod[..., c, :] *= x[..., i, :]
+        return prod
+    
+    def IV(self, taus, Vrest = 0):
+        self._update_cache()
+        taus = np.atleast_1d(np.asarray(taus, dtype = float))
+        
+        # Current elements: out(V) if fast, out(Vrest) if slow
+        fast = self.current_timescale <= taus[:, None]
+        I_rest = np.array([el.out(Vrest) for el in self.currents])
+        I = fast @ self.I_current + ((~fast) @ I_rest)[:, None]
+        
+        # Conductance elements: fast gates at V and slow gates at Vrest
+        if (len(self.conductances) > 0):
+            fast = self.gate_timescale <= taus[:, None]
+            x_rest = np.array([x.out(Vrest) for x in self.gates])
+            x = np.where(fast[:, :, None], self.x_gate,
+                         x_rest.reshape(-1, 1))
+            I = I + (self.I_linear * self._gate_product(x)).sum(axis = 1)
+        
+        return I
+    
+    def IV_ss(self):
+        self._update_cache()
+        I = self.I_current.sum(axis = 0)
+        if (len(self.conductances) > 0):
+            I = I + (self.I_linear *
+                     self._gate_product(self.x_gate)).sum(axis = 0)
+        
+        return I
+        
 class Neuron(System):
     """
     Parallel interconnection of current or conductance elements
@@ -173,8 +1865,19 @@ class Neuron(System):
         add_conductance: add conductance element
         IV: IV curve in timescale tau and resting voltage Vrest
         IV_ss: steady-state IV curve
+        IV_evaluator: cached evaluation of the IV curves over a fixed V
+        dIV_ss: derivative of the steady-state IV curve
+        equilibria: all equilibria for a constant i_app
+        equilibrium: equilibrium nearest to an initial state, as for System
+        equilibrium_v: equilibrium nearest to an initial voltage
         get_init_conditions: return y0
         i_sum: sum(Ix) for all conductance/circuit elements
+        get_arrays: return the element parameters compiled into NeuronArrays
+        to_spec: declarative description of the neuron (dict)
+        from_spec: build a neuron from its spec (classmethod)
+        
+    Note: the compiled arrays are rebuilt automatically after adding elements
+    or changing parameters through the update_* methods of the elements
     """
 
     # Membrane capacitor value + init conditions
@@ -188,13 +1891,59 @@ class Neuron(System):
         self.__dict__.update(self.stdPar) # Default circuit parameters
         self.__dict__.update(kwargs) # Modify circuit parameters
         
-        SingleTimescaleElement.vx0 = self.vx0 # Default initial conditions
-        
         self.timescales = [0] # Timescales of membrane voltage + all filters
         self.y0 = [self.v0] # Initial conditions
                 
         self.elements = [] # List containing all circuit elements
         
+        self._arrays = None # Compiled element parameters
+        
+    def _invalidate(self):
+        self._arrays = None
+        
+    def get_arrays(self):
+        if (self._arrays is None):
+            self._arrays = NeuronArrays(self)
+        return self._arrays
+        
+    def to_spec(self):
+        """
+        Returns a JSON-compatible description of the neuron:
+            {'type': 'Neuron', <parameters>, 'elements': [...], 'y0': [...]}
+        with the elements in order of definition
+        """
+        spec = {'type': 'Neuron'}
+        spec.update({key: getattr(self, key) for key in self.stdPar})
+        spec['elements'] = [el.to_spec() for el in self.elements]
+        spec['y0'] = list(self.y0)
+        return _plain(spec)
+    
+    @classmethod
+    def from_spec(cls, spec):
+        """
+        Builds a neuron from a spec returned by to_spec. The filters are
+        created in order of the elements in the spec.
+        """
+        params = {key: spec[key] for key in cls._stdPar if key in spec}
+        neuron = cls(**params)
+        for el in spec['elements']:
+            if (el['type'] == 'current'):
+                neuron.add_current(el['a'], el['voff'], el['timescale'],
+                                   el.get('v0'))
+            elif (el['type'] == 'conductance'):
+                g = neuron.add_conductance(el['g_max'], el['E_rev'])
+                for x in el['gates']:
+                    g.add_gate(x['k'], x['voff'], x['timescale'], x.get('v0'))
+            else:
+                raise ValueError("Undefined element type %s" % el['type'])
+        
+        if ('y0' in spec):
+            if (len(spec['y0']) != len(neuron.y0)):
+                raise ValueError("Initial conditions do not match the "
+                                 "elements")
+            neuron.y0 = list(spec['y0'])
+        return neuron
+    
     def add_current(self, a, voff, timescale, v0 = None):
         I = self.CurrentElement(self, a, voff, timescale, v0)
         self.elements.append(I)
@@ -206,46 +1955,134 @@ class Neuron(System):
         return I
                 
     def IV(self, V, tau, Vrest = 0):
-        I = 0
-        for el in self.elements:
-            I += el.IV(V, tau, Vrest)
-        
-        return I
+        # Filters faster than tau follow V, slower filters stay at Vrest
+        V = np.asarray(V, dtype = float)
+        fast = np.array(self.timescales) <= tau
+        y = np.where(fast, V[..., None], Vrest)
+        return self.get_arrays().i_sum(y)
     
     def IV_ss(self, V):
-        I = 0
-        for el in self.elements:
-            I += el.out(V)
-            
-        return I
+        V = np.asarray(V, dtype = float)
+        y = np.repeat(V[..., None], len(self.timescales), axis = -1)
+        return self.get_arrays().i_sum(y)
+    
+    def dIV_ss(self, V):
+        """
+        Derivative of the steady-state IV curve
+        """
+        return self.get_arrays().dIV_ss(V)
+    
+    def equilibria(self, i_app, V = None, I_ss = None):
+        """
+        Returns all equilibria, as a list of Equilibrium objects, found by
+        bracketing the roots of IV_ss(V) = i_app on the grid V and refining
+        them with Brent's method
+        
+        kwargs:
+            V: voltage grid for bracketing the roots (default [-10, 10])
+            I_ss: precomputed IV_ss(V)
+        """
+        if (V is None):
+            V = np.linspace(-10, 10, 201)
+        V = np.asarray(V, dtype = float)
+        if (I_ss is None):
+            I_ss = self.IV_ss(V)
+        
+        f = I_ss - i_app
+        sign = np.sign(f)
+        roots = list(V[sign == 0])
+        for k in np.nonzero(sign[:-1] * sign[1:] < 0)[0]:
+            roots.append(brentq(lambda v: self.IV_ss(v) - i_app, V[k],
+                                V[k+1], xtol = 1e-12))
+        
+        return [self._equilibrium_at(i_app, v) for v in sorted(roots)]
+    
+    def equilibrium(self, i_app, y_guess = None):
+        """
+        Returns the Equilibrium nearest to the state y_guess (initial
+        conditions by default), see equilibrium_v for its membrane voltage
+        """
+        if (y_guess is None):
+            y_guess = self.get_init_conditions()
+        return self.equilibrium_v(i_app, np.ravel(y_guess)[0])
+    
+    def equilibrium_v(self, i_app, v_guess = None, V = None):
+        """
+        Returns the Equilibrium found by Newton iterations on
+        IV_ss(V) = i_app with the analytic dI/dV, started from the voltage
+        v_guess (e.g. a previous equilibrium during continuation). If the
+        iterations fail, the equilibrium nearest to v_guess on the grid V is
+        returned, or None if there is none. Newton solutions outside the grid
+        V are discarded.
+        """
+        if (v_guess is None):
+            v_guess = self.v0
+        
+        i_app = float(np.asarray(i_app))
+        v = float(v_guess)
+        for _ in range(50):
+            d = self.dIV_ss(v)
+            if (d == 0):
+                break
+            dv = (self.IV_ss(v) - i_app) / d
+            v = v - dv
+            if (abs(dv) < 1e-12 * max(1, abs(v))):
+                if (V is None) or (V[0] <= v <= V[-1]):
+                    return self._equilibrium_at(i_app, v)
+                break
+            if not np.isfinite(v):
+                break
+        
+        eqs = self.equilibria(i_app, V)
+        if (len(eqs) == 0):
+            return None
+        return min(eqs, key = lambda eq: abs(eq.v - v_guess))
+    
+    def _equilibrium_at(self, i_app, v):
+        # At equilibrium all the filters are at the membrane voltage
+        return Equilibrium(self, i_app, np.full(len(self.timescales), v))
+    
+    def IV_evaluator(self, V):
+        """
+        Returns an IVEvaluator caching the element contributions over V
+        """
+        return IVEvaluator(self, V)
         
     def get_init_conditions(self):
         return np.array(self.y0)
     
+    def linear_filters(self):
+        n = len(self.timescales)
+        return (np.arange(1, n), np.zeros(n - 1, dtype = int),
+                np.array(self.timescales[1:], dtype = float))
+    
     def i_sum(self, y):
         """
         Returns total internal current
         """
-        s = 0
-        for el in self.elements:
-            s += el.outx(y)
-        return s
+        return self.get_arrays().i_sum(y)
     
-    def sys(self, i_app, y):
+    def sys(self, i_app, y, out = None):
         """
         Returns the state vector update
         y[0] = membrane voltage
         y[1],y[2],... = Element first-order filters, in order of definition
-        """
-        dy = []
-        dvmem = (i_app - self.i_sum(y)) / self.C
-        dy.append(dvmem)
         
-        # First-order filters
-        for index, tau in enumerate(self.timescales[1:]):
-            dy.append((y[0] - y[index+1]) / tau)
-        
-        return np.array(dy)
+        If out is given, the update is written into it instead of a new array
+        """
+        return self.get_arrays().sys(i_app, y, out)
+    
+    def _sys_parts(self, i_app, y, timer, out = None):
+        return self.get_arrays().sys_parts(i_app, y, timer, out)
+    
+    def jac(self, i_app, y):
+        """
+        Returns the Jacobian of the state vector update
+        """
+        return self.get_arrays().jac(y)
+    
+    def _multirate_split(self, slow):
+        return MultirateArrays(self.get_arrays(), slow)
 
     class CurrentElement(SingleTimescaleElement):
         """
@@ -263,11 +2100,17 @@ class Neuron(System):
         def out(self, V):
             return (self.a * tanh(V - self.voff))
         
+        def to_spec(self):
+            return {'type': 'current', 'a': self.a, 'voff': self.voff,
+                    'timescale': self.timescale, 'v0': self.v0}
+        
         def update_a(self, a):
             self.a = a
+            self._modified()
             
         def update_voff(self, voff):
             self.voff = voff
+            self._modified()
             
     class ConductanceElement:
         """
@@ -281,6 +2124,13 @@ class Neuron(System):
             self.E_rev = E_rev
             self.gates = []
             
+            self._version = 0 # Incremented on every parameter change
+            neuron._invalidate()
+            
+        def _modified(self):
+            self._version += 1
+            self.neuron._invalidate()
+            
         class Gate(SingleTimescaleElement):
             """
             Single gating variable with sigmoidal activation/inactivation:
@@ -297,11 +2147,17 @@ class Neuron(System):
             def out(self, V):
                 return sigmoid(V - self.voff, self.k)
             
+            def to_spec(self):
+                return {'k': self.k, 'voff': self.voff,
+                        'timescale': self.timescale, 'v0': self.v0}
+            
             def update_voff(self, voff):
                 self.voff = voff
+                self._modified()
                 
             def update_k(self, k):
                 self.k = k
+                self._modified()
         
         # Add a gating variable to the conductance element
         def add_gate(self, k, voff, timescale, v0 = None):
@@ -309,6 +2165,11 @@ class Neuron(System):
             self.gates.append(x)
             return x
         
+        def to_spec(self):
+            return {'type': 'conductance', 'g_max': self.g_max,
+                    'E_rev': self.E_rev,
+                    'gates': [x.to_spec() for x in self.gates]}
+        
         def out(self, V):
             iout = self.g_max * (V - self.E_rev)
             for x in self.gates:
@@ -323,9 +2184,11 @@ class Neuron(System):
         
         def update_g_max(self, g_max):
             self.g_max = g_max
+            self._modified()
             
         def update_E_rev(self, E_rev):
             self.E_rev = E_rev
+            self._modified()
         
         def IV(self, V, tau, Vrest = 0):
             I = self.g_max * (V - self.E_rev)
@@ -0,0 +1,328 @@
+"""
+Population of neurons sharing the structure of a single template neuron.
+The states and parameters of all neurons are stored as (neurons, states)
+arrays and the synaptic input is computed with sparse matrix products.
+
+@author: Luka
+"""
+
+import copy
+import numpy as np
+from scipy.sparse import csr_matrix, coo_matrix
+
+from neuron_model import System, NeuronArrays, MultirateArrays, _plain, Neuron
+from network_model import Interconnection, ResistorInterconnection
+
+class Population(System):
+    """
+    Network of N neurons with the elements of a template neuron, evaluated
+    with a single vectorized call for all neurons
+    
+    args:
+        template: Neuron defining the elements of every neuron
+        N: number of neurons
+        args: (synapse_model, g) tuples as for Network, where g is an (N, N)
+        array or scipy sparse matrix.
+        
+        Note: g[i][j] is the weight of the synaptic connection FROM neuron i TO
+        neuron j.
+    
+    kwargs:
+        params: dictionary {update_method: values} of the parameters that
+        differ between the neurons, where update_method is an update method
+        of an element of the template (e.g. i1.update_a) and values contains
+        one parameter value per neuron
+        y0: initial conditions, either a single neuron state shared by all
+        neurons or an (N, states) array
+    
+    methods:
+        compile: (re)build the sparse connectivity, needed if the
+        connectivity matrices are modified after construction
+        i_syn: total synaptic and resistive current into each neuron
+        jac: sparse Jacobian of the state vector update
+        to_spec: declarative description of the population (dict)
+        from_spec: build a population from its spec (classmethod)
+    
+    The state vector is the (N, states) array of the neuron states flattened
+    row by row, as in Network. The synapse models need to provide the
+    presynaptic/postsynaptic factorization (CurrentSynapse and
+    ConductanceSynapse), resistive connections are evaluated with the graph
+    Laplacian. The template parameters are read at construction.
+    """
+    
+    def __init__(self, template, N, *args, params = {}, y0 = None):
+        self.template = template
+        self.N = N
+        self.n_states = len(template.timescales)
+        
+        # Parameters that differ between neurons: (element, gate, name, values)
+        self.params = []
+        for method, values in params.items():
+            element = getattr(method, '__self__', None)
+            values = np.asarray(values, dtype = float)
+            if (values.shape != (N,)):
+                raise ValueError("%s needs one value per neuron" % method)
+            i, j = _element_location(template, element)
+            self.params.append((i, j, method.__name__[len('update_'):],
+                                values))
+        self.arrays = self._stack_arrays()
+        
+        if (y0 is None):
+            y0 = template.get_init_conditions()
+        self.y0 = np.array(np.broadcast_to(np.asarray(y0, dtype = float),
+                                           (N, self.n_states))).ravel()
+        
+        for syn, g in args:
+            if not (hasattr(syn, 'presynaptic') or
+                    isinstance(syn, ResistorInterconnection)):
+                raise ValueError("%s is not supported in a population"
+                                 % type(syn).__name__)
+            if (np.shape(g) != (N, N)) and (getattr(g, 'shape', None) !=
+                                            (N, N)):
+                raise ValueError("Invalid connectivity matrix size")
+        
+        self.synapses = args # List of synapse model/connectivity matrix pairs
+        self.compile()
+    
+    def _stack_arrays(self):
+        """
+        Compile the arrays of every distinct parameter combination and
+        expand them to one row per neuron
+        """
+        if (len(self.params) == 0):
+            return self.template.get_arrays()
+        
+        working = copy.deepcopy(self.template)
+        P = np.column_stack([values for _, _, _, values in self.params])
+        unique, inverse = np.unique(P, axis = 0, return_inverse = True)
+        
+        member_arrays = []
+        for row in unique:
+            for (i, j, name, _), value in zip(self.params, row):
+                element = _element_at(working, i, j)
+                getattr(element, 'update_' + name)(value)
+            member_arrays.append(working.get_arrays())
+        
+        arrays = NeuronArrays.stack(member_arrays)
+        inverse = inverse.ravel()
+        for name in NeuronArrays._parameters:
+            value = getattr(arrays, name)
+            if (value is not getattr(member_arrays[0], name)):
+                setattr(arrays, name, value[inverse])
+        return arrays
+    
+    def compile(self):
+        """
+        Convert each connectivity matrix into a sparse (post, pre) matrix
+        and find the column of the presynaptic filtered voltage
+        """
+        n = self.n_states
+        self.v_index = np.arange(self.N) * n # Membrane voltage indices
+        
+        self.connections = []
+        self._laplacian = None
+        for syn, g in self.synapses:
+            if isinstance(syn, ResistorInterconnection):
+                L = syn.laplacian(g)
+                if (self._laplacian is not None):
+                    L = L + self._laplacian
+                self._laplacian = L
+                continue
+            
+            if syn.timescale not in self.template.timescales:
+                raise ValueError("Synapse timescale %s is not defined in the "
+                                 "template" % syn.timescale)
+            pre_col = self.template.timescales.index(syn.timescale)
+            
+            W = csr_matrix(csr_matrix(g, dtype = float).T)
+            W.eliminate_zeros()
+            self.connections.append((syn, W, pre_col))
+        
+        # Sparsity pattern of the diagonal blocks of the individual neurons
+        r, c = np.mgrid[0:n, 0:n]
+        self._block_rows = (self.v_index[:, None] + r.ravel()).ravel()
+        self._block_cols = (self.v_index[:, None] + c.ravel()).ravel()
+    
+    def get_init_conditions(self):
+        return self.y0
+    
+    def membrane_index(self):
+        return self.v_index
+    
+    def linear_filters(self):
+        n = self.n_states
+        index = (self.v_index[:, None] + np.arange(1, n)).ravel()
+        source = np.repeat(self.v_index, n - 1)
+        tau = np.tile(np.array(self.template.timescales[1:], dtype = float),
+                      self.N)
+        return index, source, tau
+    
+    def i_syn(self, Y):
+        """
+        Returns the total synaptic and resistive current into each neuron
+        for the (N, states) array Y
+        """
+        i_syn = np.zeros(self.N)
+        for syn, W, pre_col in self.connections:
+            s = W @ syn.presynaptic(Y[:, pre_col])
+            i_syn += syn.postsynaptic(s, Y[:, 0])
+        if (self._laplacian is not None):
+            i_syn -= self._laplacian @ Y[:, 0]
+        return i_syn
+    
+    def sys(self, i_app, y, out = None):
+        """
+        Returns the state vector update (written into out if given)
+        i_app: scalar or one value per neuron
+        """
+        Y = np.asarray(y).reshape(self.N, self.n_states)
+        if (out is None):
+            out = np.empty(Y.size)
+        self.arrays.sys(np.asarray(i_app) + self.i_syn(Y), Y,
+                        out = out.reshape(Y.shape))
+        return out
+    
+    def _sys_parts(self, i_app, y, timer):
+        Y = np.asarray(y).reshape(self.N, self.n_states)
+        dY = np.empty(Y.shape)
+        i_syn = np.zeros(self.N)
+        for syn, W, pre_col in self.connections:
+            with timer.section(type(syn).__name__):
+                s = W @ syn.presynaptic(Y[:, pre_col])
+                i_syn += syn.postsynaptic(s, Y[:, 0])
+        if (self._laplacian is not None):
+            with timer.section("ResistorInterconnection"):
+                i_syn -= self._laplacian @ Y[:, 0]
+        self.arrays.sys_parts(np.asarray(i_app) + i_syn, Y, timer, out = dY)
+        return dY.ravel()
+    
+    def jac(self, i_app, y):
+        """
+        Returns the Jacobian of the state vector update as a sparse matrix
+        """
+        n = self.n_states
+        Y = np.asarray(y).reshape(self.N, n)
+        n_total = self.N * n
+        
+        # Individual neurons
+        vals = [self.arrays.jac(Y).ravel()]
+        rows = [self._block_rows]
+        cols = [self._block_cols]
+        
+        # Synaptic connections
+        C = np.broadcast_to(self.arrays.C, (self.N,))
+        for syn, W, pre_col in self.connections:
+            G = W.tocoo()
+            post, pre, w = G.row, G.col, G.data
+            d_pre, d_post = syn.dout(Y[pre, pre_col], Y[post, 0])
+            vals.append(np.broadcast_to(w * d_pre / C[post], w.shape))
+            vals.append(np.broadcast_to(w * d_post / C[post], w.shape))
+            rows.extend([post * n, post * n])
+            cols.extend([pre * n + pre_col, post * n])
+        
+        # Resistive connections: -L / C
+        if (self._laplacian is not None):
+            L = self._laplacian.tocoo()
+            vals.append(-L.data / C[L.row])
+            rows.append(L.row * n)
+            cols.append(L.col * n)
+        
+        J = coo_matrix((np.concatenate(vals),
+                        (np.concatenate(rows), np.concatenate(cols))),
+                       shape = (n_total, n_total))
+        return J.tocsr()
+    
+    def _multirate_split(self, slow):
+        return PopulationMultirate(self, slow)
+    
+    def to_spec(self):
+        """
+        Returns a JSON-compatible description of the population, with the
+        connectivity matrices as sparse (row, col, data) triplets
+        """
+        synapses = []
+        for syn, g in self.synapses:
+            G = coo_matrix(csr_matrix(g, dtype = float))
+            synapses.append({'model': syn.to_spec(),
+                             'g': {'shape': G.shape, 'row': G.row,
+                                   'col': G.col, 'data': G.data}})
+        
+        spec = {'type': 'Population',
+                'template': self.template.to_spec(),
+                'N': self.N,
+                'params': [{'element': i, 'gate': j, 'parameter': name,
+                            'values': values}
+                           for i, j, name, values in self.params],
+                'synapses': synapses,
+                'y0': self.y0}
+        return _plain(spec)
+    
+    @classmethod
+    def from_spec(cls, spec):
+        """
+        Builds a population from a spec returned by to_spec
+        """
+        template = Neuron.from_spec(spec['template'])
+        params = {}
+        for p in spec['params']:
+            element = _element_at(template, p['element'], p['gate'])
+            params[getattr(element, 'update_' + p['parameter'])] = p['values']
+        
+        synapses = []
+        for syn in spec['synapses']:
+            g = syn['g']
+            G = coo_matrix((g['data'], (g['row'], g['col'])),
+                           shape = tuple(g['shape']))
+            synapses.append((Interconnection.from_spec(syn['model']), G))
+        
+        return cls(template, spec['N'], *synapses, params = params,
+                   y0 = np.reshape(spec['y0'], (spec['N'], -1)))
+
+class PopulationMultirate():
+    """
+    Multirate split of a population (see MultirateArrays): the slow terms of
+    all neurons are linearized, the synaptic currents are evaluated in every
+    substep
+    """
+    
+    single = False # The substeps use macro_sys
+    
+    def __init__(self, population, slow):
+        self.population = population
+        self.split = MultirateArrays(population.arrays,
+                                     np.unique(slow % population.n_states))
+    
+    def _states(self, y):
+        return np.asarray(y).reshape(self.population.N, -1)
+    
+    def macro_sys(self, y):
+        """
+        Returns f(i_app, y, out = None) for the macro-step starting at y,
+        see MultirateArrays.macro_sys
+        """
+        lin = self.split.linearize(self._states(y))
+        def macro_sys(i_app, y, out = None):
+            Y = self._states(y)
+            if (out is None):
+                out = np.empty(Y.size)
+            i_external = np.asarray(i_app) + self.population.i_syn(Y)
+            self.split.sys(i_external, Y, lin, out.reshape(Y.shape))
+            return out
+        return macro_sys
+
+def _element_location(neuron, element):
+    """
+    Returns (element index, gate index) of an element of neuron, where the
+    gate index is None for current and conductance elements
+    """
+    for i, el in enumerate(neuron.elements):
+        if (el is element):
+            return i, None
+        for j, x in enumerate(getattr(el, 'gates', [])):
+            if (x is element):
+                return i, j
+    raise ValueError("%s is not an element of the template" % element)
+
+def _element_at(neuron, i, j):
+    element = neuron.elements[i]
+    return element if (j is None) else element.gates[j]
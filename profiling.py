@@ -0,0 +1,219 @@
+"""
+Opt-in instrumentation of the simulations: counts and wall times of the state
+vector updates, Jacobians, applied current calls and solver steps, collected
+into a SimulationStats object and passed to user hooks. Enabled per system
+with System.profile, without it the simulations run unchanged.
+
+@author: Luka
+"""
+
+import time
+from contextlib import contextmanager
+
+clock = time.perf_counter
+
+class SimulationStats():
+    """
+    Statistics of a simulation run
+    
+    attributes:
+        method: simulation method
+        nfev: number of state vector updates (sys calls), including the
+        evaluations inside the compiled loops
+        njev: number of Jacobian evaluations
+        nlu: number of LU decompositions of the implicit solvers
+        n_i_app: number of i_app calls
+        n_accepted: number of accepted steps
+        n_rejected: number of rejected steps, None if the solver does not
+        report them (implicit scipy solvers)
+        t_total: wall time of the run
+        t_sys, t_jac, t_i_app: wall time spent in sys, jac and i_app
+        t_sample: wall time of the sampled part-by-part evaluations
+        parts: wall time of the sampled evaluations by element, synapse or
+        connection type
+        n_samples: number of sampled evaluations
+    
+    properties:
+        t_solver: remaining time, spent in the solver and output handling
+        sys_breakdown: t_sys divided between the parts in proportion to the
+        sampled times
+    
+    methods:
+        section: context manager timing a part of the sampled evaluations
+        as_dict: flat dictionary of the statistics, e.g. for a metrics
+        pipeline
+    
+    Every sample-th sys call is evaluated a second time part by part (see
+    System._sys_parts), the time of these evaluations is not included in
+    t_sys.
+    """
+    
+    def __init__(self, method, sample = 100):
+        self.method = method
+        self.sample = sample
+        self.nfev = 0
+        self.njev = 0
+        self.nlu = 0
+        self.n_i_app = 0
+        self.n_accepted = 0
+        self.n_rejected = 0
+        self.t_total = 0.0
+        self.t_sys = 0.0
+        self.t_jac = 0.0
+        self.t_i_app = 0.0
+        self.t_sample = 0.0
+        self.parts = {}
+        self.n_samples = 0
+        self._t_sections = 0.0
+    
+    @property
+    def t_solver(self):
+        return (self.t_total - self.t_sys - self.t_jac - self.t_i_app -
+                self.t_sample)
+    
+    @property
+    def sys_breakdown(self):
+        total = sum(self.parts.values())
+        if (total == 0):
+            return {}
+        return {name: self.t_sys * t / total
+                for name, t in self.parts.items()}
+    
+    @contextmanager
+    def section(self, name):
+        start = clock()
+        yield
+        elapsed = clock() - start
+        self.parts[name] = self.parts.get(name, 0.0) + elapsed
+        self._t_sections += elapsed
+    
+    def wrap_sys(self, sys, parts = None):
+        """
+        Returns sys counting its calls and time, where every sample-th call
+        is also evaluated by parts(i_app, y, timer = self)
+        """
+        def timed_sys(*args):
+            start = clock()
+            out = sys(*args)
+            self.t_sys += clock() - start
+            self.nfev += 1
+            if (parts is not None) and (self.sample > 0) and (
+                    self.nfev % self.sample == 0):
+                self._sample(parts, args)
+            return out
+        return timed_sys
+    
+    def wrap_jac(self, jac):
+        def timed_jac(*args):
+            start = clock()
+            J = jac(*args)
+            self.t_jac += clock() - start
+            self.njev += 1
+            return J
+        return timed_jac
+    
+    def wrap_i_app(self, i_app):
+        def timed_i_app(t):
+            start = clock()
+            i = i_app(t)
+            self.t_i_app += clock() - start
+            self.n_i_app += 1
+            return i
+        return timed_i_app
+    
+    def _sample(self, parts, args):
+        self._t_sections = 0.0
+        start = clock()
+        parts(*args[:2], timer = self) # Without the output buffer
+        elapsed = clock() - start
+        other = elapsed - self._t_sections
+        self.parts["other"] = self.parts.get("other", 0.0) + other
+        self.t_sample += elapsed
+        self.n_samples += 1
+    
+    def as_dict(self):
+        stats = {'method': self.method, 'nfev': self.nfev,
+                 'njev': self.njev, 'nlu': self.nlu, 'n_i_app': self.n_i_app,
+                 'n_accepted': self.n_accepted,
+                 'n_rejected': self.n_rejected, 't_total': self.t_total,
+                 't_sys': self.t_sys, 't_jac': self.t_jac,
+                 't_i_app': self.t_i_app, 't_solver': self.t_solver}
+        for name, t in self.sys_breakdown.items():
+            stats['t_sys_' + name] = t
+        return stats
+    
+    def __str__(self):
+        rejected = "-" if (self.n_rejected is None) else self.n_rejected
+        lines = ["%s: %d accepted, %s rejected steps, %d sys, %d jac, %d LU"
+                 % (self.method, self.n_accepted, rejected, self.nfev,
+                    self.njev, self.nlu),
+                 "total %.3f s: sys %.3f s, jac %.3f s, i_app %.3f s, "
+                 "solver %.3f s" % (self.t_total, self.t_sys, self.t_jac,
+                                    self.t_i_app, self.t_solver)]
+        for name, t in sorted(self.sys_breakdown.items(),
+                              key = lambda item: -item[1]):
+            lines.append("    %-24s %.3f s" % (name, t))
+        return "\n".join(lines)
+
+class Profiler():
+    """
+    Instrumentation of the simulations of a system, see System.profile
+    
+    kwargs:
+        hooks: functions hook(event, stats) called with the SimulationStats
+        of the run, where event is
+            'start' at the start of simulate/iterate or set_solver
+            'chunk' after every output chunk of simulate/iterate
+            'step' every interval steps of System.step/steps
+            'end' at the end of simulate/iterate
+        interval: number of steps between the 'step' events
+        sample: every sample-th sys call is evaluated again part by part for
+        the time breakdown, 0 disables the breakdown
+    
+    attributes:
+        stats: SimulationStats of the current or last run
+    """
+    
+    def __init__(self, hooks = [], interval = 1000, sample = 100):
+        self.hooks = list(hooks)
+        self.interval = interval
+        self.sample = sample
+        self.stats = None
+    
+    def start(self, method):
+        self.stats = SimulationStats(method, self.sample)
+        self.emit('start')
+        return self.stats
+    
+    def emit(self, event):
+        for hook in self.hooks:
+            hook(event, self.stats)
+    
+    def steps_done(self, stats, n, elapsed):
+        """
+        Counts n accepted steps of System.step/steps taking elapsed seconds
+        """
+        before = stats.n_accepted // self.interval
+        stats.n_accepted += n
+        stats.t_total += elapsed
+        if (stats.n_accepted // self.interval > before):
+            self.emit('step')
+    
+    def chunks(self, chunks, stats):
+        """
+        Passes through the output chunks of iterate, timing the work done
+        between them; the returned solution gets the stats attribute
+        """
+        while True:
+            start = clock()
+            try:
+                chunk = next(chunks)
+            except StopIteration as stop:
+                stats.t_total += clock() - start
+                sol = stop.value
+                sol.stats = stats
+                self.emit('end')
+                return sol
+            stats.t_total += clock() - start
+            self.emit('chunk')
+            yield chunk
@@ -0,0 +1,132 @@
+"""
+Spike and burst detection on membrane voltage traces, applied incrementally to
+the output chunks of a simulation
+
+@author: Luka
+"""
+
+import numpy as np
+
+class SpikeDetector():
+    """
+    Detects upward threshold crossings of the membrane voltages of n neurons,
+    with the crossing times obtained by linear interpolation between samples
+    
+    args:
+        n: number of neurons
+    
+    kwargs:
+        threshold: spike threshold, scalar or one value per neuron
+        refractory: crossings closer than refractory to the previous spike of
+        the same neuron are ignored
+    
+    methods:
+        update: process the next chunk of voltages
+        get_spikes: list of spike time arrays, one per neuron
+    """
+    
+    def __init__(self, n, threshold = 0, refractory = 0):
+        self.n = n
+        self.threshold = np.broadcast_to(np.asarray(threshold, dtype = float),
+                                         (n,))[:, None]
+        self.refractory = refractory
+        
+        self.t_last = None # Last sample of the previous chunk
+        self.V_last = None
+        self.last_spike = np.full(n, -np.inf)
+        self.spikes = [[] for _ in range(n)]
+    
+    def update(self, t, V):
+        """
+        t: sample times (k,)
+        V: membrane voltages (n, k)
+        """
+        if (self.t_last is not None):
+            t = np.concatenate(([self.t_last], t))
+            V = np.concatenate((self.V_last[:, None], V), axis = 1)
+        if (t.size == 0):
+            return
+        self.t_last = t[-1]
+        self.V_last = V[:, -1].copy()
+        
+        above = V >= self.threshold
+        neurons, k = np.nonzero(~above[:, :-1] & above[:, 1:])
+        if (k.size == 0):
+            return
+        
+        # Linear interpolation of the crossing times
+        V1 = V[neurons, k]
+        V2 = V[neurons, k+1]
+        s = (self.threshold[neurons, 0] - V1) / (V2 - V1)
+        t_cross = t[k] + s * (t[k+1] - t[k])
+        
+        # Crossings are ordered by neuron and time
+        for i, t_spike in zip(neurons, t_cross):
+            if (t_spike - self.last_spike[i] >= self.refractory):
+                self.spikes[i].append(t_spike)
+                self.last_spike[i] = t_spike
+    
+    def get_spikes(self):
+        return [np.array(s) for s in self.spikes]
+
+def group_bursts(spikes, max_isi, min_spikes = 2):
+    """
+    Group the spike times of a single neuron into bursts: consecutive spikes
+    with interspike interval at most max_isi belong to the same burst, and
+    only groups of at least min_spikes spikes are kept
+    
+    Returns an (n_bursts, 2) array of burst (onset, offset) times and the
+    number of spikes in each burst
+    """
+    spikes = np.asarray(spikes)
+    if (spikes.size == 0):
+        return np.empty((0, 2)), np.empty(0, dtype = int)
+    
+    breaks = np.nonzero(np.diff(spikes) > max_isi)[0] + 1
+    start = np.concatenate(([0], breaks))
+    end = np.concatenate((breaks, [spikes.size])) - 1
+    count = end - start + 1
+    
+    keep = count >= min_spikes
+    bursts = np.stack((spikes[start[keep]], spikes[end[keep]]), axis = 1)
+    return bursts, count[keep]
+
+class SpikeTrains():
+    """
+    Spike and burst times of all neurons of a simulation
+    
+    attributes:
+        spikes: list of spike time arrays, one per neuron
+        bursts: list of (n_bursts, 2) arrays of burst (onset, offset) times,
+        None if no burst grouping was requested
+        burst_sizes: list of arrays with the number of spikes in each burst
+        t, V: membrane voltage traces, None if not kept
+        sol: solver statistics of the simulation
+    
+    methods:
+        spike_counts: number of spikes of each neuron
+        burst_periods: mean onset-to-onset interval of each neuron's bursts
+    """
+    
+    def __init__(self, spikes, max_isi = None, min_spikes = 2, t = None,
+                 V = None, sol = None):
+        self.spikes = spikes
+        self.t = t
+        self.V = V
+        self.sol = sol
+        
+        self.bursts = None
+        self.burst_sizes = None
+        if (max_isi is not None):
+            grouped = [group_bursts(s, max_isi, min_spikes) for s in spikes]
+            self.bursts = [b for b, _ in grouped]
+            self.burst_sizes = [c for _, c in grouped]
+    
+    def spike_counts(self):
+        return np.array([s.size for s in self.spikes])
+    
+    def burst_periods(self):
+        if (self.bursts is None):
+            raise ValueError("Bursts were not detected")
+        return np.array([np.diff(b[:, 0]).mean() if len(b) > 1 else np.nan
+                         for b in self.bursts])
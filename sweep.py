@@ -0,0 +1,351 @@
+"""
+Parameter sweeps: simulate a neuron or network model over a grid of
+parameter values in a pool of worker processes and collect per-point
+summaries (spike counts, burst periods, equilibrium) into a result table
+
+@author: Luka
+"""
+
+import copy
+import csv
+import itertools
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from checkpoint import system_from_spec
+
+class ConstantCurrent():
+    """
+    Picklable constant applied current i_app(t) = value
+    """
+    def __init__(self, value):
+        self.value = value
+    
+    def __call__(self, t):
+        return self.value
+
+def parameter_grid(grid):
+    """
+    Returns the list of parameter points of grid, either a dictionary
+    {name: values} expanded into the cartesian product of the values, or a
+    list of dictionaries {name: value}
+    """
+    if isinstance(grid, dict):
+        names = list(grid)
+        return [dict(zip(names, values))
+                for values in itertools.product(*grid.values())]
+    return [dict(point) for point in grid]
+
+def override_spec(spec, point):
+    """
+    Returns a copy of a model spec (see to_spec) with the values of point
+    {name: value}, where every name is the path of an existing entry of the
+    spec with its keys and list indices separated by dots, e.g. 'C',
+    'elements.2.a', 'elements.1.gates.0.voff' or 'neurons.0.elements.1.a'
+    """
+    spec = copy.deepcopy(spec)
+    for name, value in point.items():
+        keys = name.split('.')
+        entry = spec
+        try:
+            for key in keys[:-1]:
+                entry = entry[int(key) if isinstance(entry, list) else key]
+            key = int(keys[-1]) if isinstance(entry, list) else keys[-1]
+            entry[key] # The entry must exist
+        except (KeyError, IndexError, ValueError, TypeError):
+            raise ValueError("%s is not a parameter of the spec" % name)
+        entry[key] = value
+    return spec
+
+def build_system(model, point):
+    """
+    Returns the system of a parameter point (without an 'i_app' entry),
+    built as model(**point) if model is callable, otherwise from the spec
+    model with the values of point, see override_spec
+    """
+    if callable(model):
+        return model(**point)
+    return system_from_spec(override_spec(model, point))
+
+def summary_columns(n_neurons, max_isi = None):
+    """
+    Names of the summary columns of a sweep over networks of n_neurons
+    """
+    columns = ["spikes_%d" % k for k in range(n_neurons)]
+    if (max_isi is not None):
+        columns += ["period_%d" % k for k in range(n_neurons)]
+    columns += ["v_eq_%d" % k for k in range(n_neurons)]
+    columns += ["eq_stable"]
+    return columns
+
+def summarize(system, i_app, trange, options):
+    """
+    Simulate system and return the list of its summary values, in the order
+    of summary_columns
+    
+    args:
+        system: Neuron or Network
+        i_app: function of t
+        trange: simulation time range
+        options: keyword arguments of detect_spikes
+    """
+    n = system.membrane_index().size
+    
+    trains = system.detect_spikes(trange, i_app, **options)
+    row = list(trains.spike_counts())
+    if (options.get('max_isi') is not None):
+        row += list(trains.burst_periods())
+    
+    # Equilibrium at the initial applied current
+    eq = system.equilibrium(np.asarray(i_app(trange[0]), dtype = float))
+    if (eq is None):
+        row += [np.nan] * n + [np.nan]
+    else:
+        row += list(np.atleast_1d(eq.v)) + [float(eq.stable)]
+    
+    return row
+
+def _run_points(model, points, i_app, trange, options):
+    """
+    Worker task: build, simulate and summarize a list of (index, point)
+    Returns a list of (index, summary, error message)
+    """
+    results = []
+    for index, point in points:
+        point = dict(point)
+        # An i_app entry of the grid is the constant applied current
+        current = i_app
+        if ('i_app' in point):
+            current = ConstantCurrent(point.pop('i_app'))
+        try:
+            system = build_system(model, point)
+            results.append((index, summarize(system, current, trange,
+                                             options), ""))
+        except Exception as error:
+            results.append((index, None, "%s: %s" % (type(error).__name__,
+                                                     error)))
+    return results
+
+class SweepResult():
+    """
+    Columnar table of sweep results, with one row per parameter point
+    
+    args:
+        columns: dictionary {name: values}
+    
+    methods:
+        to_csv: write the table to a csv file
+        from_csv: read a table written by to_csv or by sweep (classmethod)
+        point: dictionary of the row of a parameter point index
+    
+    Columns are accessible as result[name] and result.names lists them in
+    order: the point index, the parameters, the summaries and the error
+    message of the points that failed (empty otherwise).
+    """
+    
+    def __init__(self, columns):
+        self.columns = columns
+        self.names = list(columns)
+    
+    def __getitem__(self, name):
+        return self.columns[name]
+    
+    def __len__(self):
+        return len(self.columns['index'])
+    
+    def point(self, index):
+        row = np.nonzero(self.columns['index'] == index)[0][0]
+        return {name: values[row] for name, values in self.columns.items()}
+    
+    def to_csv(self, path):
+        with open(path, 'w', newline = '') as f:
+            writer = csv.writer(f)
+            writer.writerow(self.names)
+            writer.writerows(zip(*(self.columns[name]
+                                   for name in self.names)))
+    
+    @classmethod
+    def from_csv(cls, path):
+        names, rows = _read_csv(path)
+        return cls(_columns(names, rows))
+
+def _columns(names, rows):
+    """
+    Converts a list of rows into a dictionary of column arrays
+    """
+    columns = {}
+    for k, name in enumerate(names):
+        values = [row[k] for row in rows]
+        if (name == 'index'):
+            columns[name] = np.array(values, dtype = int)
+        elif (name == 'error'):
+            columns[name] = np.array(values, dtype = str)
+        else:
+            try:
+                columns[name] = np.array(values, dtype = float)
+            except ValueError:
+                columns[name] = np.array(values)
+    return columns
+
+def _read_csv(path):
+    """
+    Returns the header and the complete rows of a csv file, dropping a
+    last row truncated by an interruption
+    """
+    with open(path, newline = '') as f:
+        text = f.read()
+    lines = text.splitlines(keepends = True)
+    if lines and not lines[-1].endswith('\n'):
+        lines = lines[:-1]
+    rows = list(csv.reader(lines))
+    if (len(rows) == 0):
+        return [], []
+    header = rows[0]
+    return header, [row for row in rows[1:] if len(row) == len(header)]
+
+def sweep(model, grid, trange, i_app = 0, path = None, max_workers = None,
+          chunksize = None, progress = True, **options):
+    """
+    Simulate the model built from every point of a parameter grid and collect
+    the summaries into a SweepResult
+    
+    args:
+        model: spec of a Neuron, Network or Population (see to_spec) or the
+        system itself, rebuilt in the workers with the parameter values of
+        every point (see override_spec). Alternatively, a picklable callable
+        (e.g. a module-level function) returning the system of a point as
+        model(**point).
+        grid: dictionary {name: values} expanded into its cartesian product,
+        or a list of dictionaries {name: value}. An 'i_app' entry is used as
+        the constant applied current of the point instead of a parameter of
+        the model.
+        trange: simulation time range
+    
+    kwargs:
+        i_app: constant applied current (scalar or one value per neuron) or
+        a picklable function of t
+        path: csv file where the rows are written as the points complete.
+        If the file exists, the points already in it are skipped, so that an
+        interrupted sweep is resumed by calling sweep again. Points with an
+        error are run again.
+        max_workers: number of worker processes (os.cpu_count() by default),
+        with max_workers = 1 the points are run in the calling process
+        chunksize: number of points per task, by default chosen so that
+        every worker gets about 8 tasks for load balancing
+        progress: print progress to stderr if True, or call
+        progress(done, total) if callable
+        options: keyword arguments of detect_spikes (method, dt, threshold,
+        refractory, max_isi, min_spikes, dt_out)
+    
+    Returns a SweepResult, rows ordered by point index
+    """
+    points = parameter_grid(grid)
+    if not callable(i_app):
+        i_app = ConstantCurrent(i_app)
+    if not (callable(model) or isinstance(model, dict)):
+        model = model.to_spec()
+    
+    # The first model defines the number of neurons
+    first = dict(points[0])
+    first.pop('i_app', None)
+    n_neurons = build_system(model, first).membrane_index().size
+    
+    parameters = list(points[0])
+    header = (["index"] + parameters +
+              summary_columns(n_neurons, options.get('max_isi')) + ["error"])
+    n_summary = len(header) - len(parameters) - 2
+    
+    # Rows already written by an interrupted sweep
+    rows = {}
+    if (path is not None) and os.path.exists(path):
+        names, old_rows = _read_csv(path)
+        if (len(names) > 0) and (names != header):
+            raise ValueError("%s contains the results of a different sweep"
+                             % path)
+        # Points that failed are run again
+        rows = {int(row[0]): row for row in old_rows if (row[-1] == "")}
+    
+    pending = [(i, point) for i, point in enumerate(points) if i not in rows]
+    total = len(points)
+    
+    writer = None
+    f = None
+    if (path is not None):
+        # Rewrite the complete rows to drop a truncated last line and the
+        # failed points, replacing the file only once the rows are written
+        temp = path + '.tmp'
+        with open(temp, 'w', newline = '') as f:
+            csv.writer(f).writerows([header] + list(rows.values()))
+        os.replace(temp, path)
+        f = open(path, 'a', newline = '')
+        writer = csv.writer(f)
+    
+    report = _progress_reporter(progress, total)
+    report(len(rows))
+    
+    def collect(results):
+        for index, summary, error in results:
+            if (summary is None):
+                summary = [np.nan] * n_summary
+            row = ([index] + [points[index][name] for name in parameters] +
+                   summary + [error])
+            rows[index] = row
+            if (writer is not None):
+                writer.writerow(row)
+        if (f is not None):
+            f.flush()
+        report(len(rows))
+    
+    try:
+        if (max_workers is None):
+            max_workers = os.cpu_count()
+        if (chunksize is None):
+            chunksize = max(1, len(pending) // (8 * max_workers))
+        chunks = [pending[k:k+chunksize]
+                  for k in range(0, len(pending), chunksize)]
+        
+        if (max_workers == 1):
+            for chunk in chunks:
+                collect(_run_points(model, chunk, i_app, trange, options))
+        else:
+            with ProcessPoolExecutor(max_workers) as executor:
+                futures = [executor.submit(_run_points, model, chunk, i_app,
+                                           trange, options)
+                           for chunk in chunks]
+                for future in as_completed(futures):
+                    collect(future.result())
+    finally:
+        if (f is not None):
+            f.close()
+    
+    ordered = [rows[index] for index in sorted(rows)]
+    return SweepResult(_columns(header, ordered))
+
+def _progress_reporter(progress, total):
+    if callable(progress):
+        return lambda done: progress(done, total)
+    if not progress:
+        return lambda done: None
+    
+    start = time.time()
+    first = []
+    def report(done):
+        # Estimate the remaining time from the points run in this call
+        if (len(first) == 0):
+            first.append(done)
+        elapsed = time.time() - start
+        new = done - first[0]
+        if (new > 0):
+            eta = "%.0f s" % (elapsed / new * (total - done))
+        else:
+            eta = "-"
+        sys.stderr.write("\r%d/%d points, %.0f s elapsed, %s remaining"
+                         % (done, total, elapsed, eta))
+        if (done == total):
+            sys.stderr.write("\n")
+        sys.stderr.flush()
+    return report
@@ -0,0 +1,21 @@
+"""
+Tests of the equilibrium continuation, run with pytest
+
+@author: Luka
+"""
+
+import numpy as np
+
+from continuation import continuation
+from test_simulate import bursting_neuron
+
+def test_neuron_equilibrium_from_state():
+    # Neuron.equilibrium takes a state vector as System.equilibrium
+    neuron = bursting_neuron()
+    y0 = neuron.get_init_conditions()
+    assert np.isclose(neuron.equilibrium(-2, y0).v,
+                      neuron.equilibrium_v(-2, y0[0]).v)
+    
+    branch = continuation(neuron, (-3, 1))
+    warm = continuation(neuron, (-3, 1), y_guess = y0)
+    assert np.allclose(branch.p, warm.p)
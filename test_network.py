@@ -0,0 +1,47 @@
+"""
+Tests of the network state vector update, run with pytest
+
+@author: Luka
+"""
+
+import numpy as np
+
+from network_model import CurrentSynapse, ResistorInterconnection, Network
+from test_simulate import bursting_neuron
+
+def random_network(neurons, seed = 0):
+    rng = np.random.default_rng(seed)
+    N = len(neurons)
+    g_syn = rng.random((N, N)) * 0.2
+    g_res = rng.random((N, N)) * 0.1
+    return Network(neurons, (CurrentSynapse(-1, -1, 50), g_syn),
+                   (CurrentSynapse(+1, -1, 50), np.zeros((N, N))),
+                   (ResistorInterconnection(), g_res + g_res.T))
+
+def test_compiled_matches_pairwise():
+    for N in (2, 3, 8):
+        network = random_network([bursting_neuron() for _ in range(N)])
+        y = np.asarray(network.get_init_conditions(), dtype = float) + 0.1
+        i_app = np.linspace(-2.5, -1.5, N)
+        dy = network.sys(i_app, y)
+        assert (network._stacked_arrays() is not None) == (
+            N >= network.stack_size)
+
+        # Modified neurons are stacked again
+        network.neurons[1].elements[1].update_a(-1.5)
+        dy_modified = network.sys(i_app, y)
+        assert not np.allclose(dy, dy_modified)
+
+        network.compiled = False
+        assert np.allclose(dy_modified, network.sys(i_app, y))
+
+def test_compiled_different_structure():
+    neurons = [bursting_neuron() for _ in range(5)]
+    neurons[2].add_current(0.5, -1, 50)
+    network = random_network(neurons)
+    y = np.asarray(network.get_init_conditions(), dtype = float) + 0.1
+    dy = network.sys(np.full(5, -2.0), y)
+    assert network._stacked_arrays() is None
+
+    network.compiled = False
+    assert np.allclose(dy, network.sys(np.full(5, -2.0), y))
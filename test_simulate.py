@@ -0,0 +1,73 @@
+"""
+Tests of the simulation output of System.simulate, run with pytest
+
+@author: Luka
+"""
+
+import numpy as np
+
+from neuron_model import Neuron
+
+def bursting_neuron():
+    neuron = Neuron()
+    neuron.add_conductance(1)
+    neuron.add_current(-2, 0, 0) # fast negative conductance
+    neuron.add_current(2, 0, 50) # slow positive conductance
+    neuron.add_current(-1.5, -1.5, 50) # slow negative conductance
+    neuron.add_current(1.5, -1.5, 2500) # ultraslow positive conductance
+    return neuron
+
+def i_app(t):
+    return -2
+
+def test_dt_out_not_multiple_of_dt():
+    # dt_out = 1 is not a multiple of dt = 0.3: the fixed-step output is
+    # interpolated onto the same grid as the output of the adaptive methods
+    neuron = bursting_neuron()
+    reference = neuron.simulate((0, 30), i_app, "Default", dt_out = 1)
+    assert np.allclose(reference.t, np.arange(31))
+
+    for backend in ("numpy", "numba"):
+        neuron.backend = backend
+        for method in ("Euler", "RK4"):
+            sol = neuron.simulate((0, 30), i_app, method, dt = 0.3,
+                                  dt_out = 1)
+            assert np.allclose(sol.t, reference.t)
+            assert np.max(np.abs(sol.y - reference.y)) < 0.05
+
+            # Same output when produced in chunks
+            chunks = list(neuron.iterate((0, 30), i_app, method, 0.3,
+                                         dt_out = 1, chunk_size = 4))
+            assert np.array_equal(np.concatenate([t for t, _ in chunks]),
+                                  sol.t)
+            assert np.array_equal(np.concatenate([y for _, y in chunks],
+                                                 axis = 1), sol.y)
+
+def test_dt_out_multiple_of_dt():
+    neuron = bursting_neuron()
+    sol = neuron.simulate((0, 30), i_app, "RK4", dt = 0.25, dt_out = 1)
+    steps = neuron.simulate((0, 30), i_app, "RK4", dt = 0.25)
+    assert np.allclose(sol.t, np.arange(31))
+    assert np.array_equal(sol.y, steps.y[:, ::4])
+
+def test_dt_out_includes_end():
+    neuron = bursting_neuron()
+    for method in ("Default", "BDF", "Multirate", "RK4"):
+        sol = neuron.simulate((0, 0.3), i_app, method, dt = 0.1,
+                              dt_out = 0.1)
+        assert np.allclose(sol.t, [0, 0.1, 0.2, 0.3])
+
+def test_resume_at_end(tmp_path):
+    # Resuming at the end of trange gives an empty solution
+    from checkpoint import Checkpoint, Checkpointer
+    neuron = bursting_neuron()
+    path = str(tmp_path / "checkpoint.npz")
+    neuron.simulate((0, 50), i_app, "RK4", dt = 0.5,
+                    checkpoint = Checkpointer(path, interval = 1))
+    checkpoint = Checkpoint.load(path)
+    checkpoint.t, checkpoint.step = 50.0, 100
+    for callback in (None, lambda t, y: None):
+        sol = neuron.simulate((0, 50), i_app, "RK4", dt = 0.5, record = [0],
+                              callback = callback, resume = checkpoint)
+        assert sol.t.shape == (0,)
+        assert sol.y.shape == (1, 0)
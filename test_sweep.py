@@ -0,0 +1,39 @@
+"""
+Tests of the parameter sweeps, run with pytest
+
+@author: Luka
+"""
+
+import numpy as np
+import pytest
+
+from sweep import sweep, override_spec
+from test_simulate import bursting_neuron
+
+def build(a):
+    neuron = bursting_neuron()
+    neuron.elements[4].update_a(a)
+    return neuron
+
+def test_sweep_spec():
+    # A spec with the parameter overrides of every point gives the same
+    # results as the builder function
+    grid = {'a': [1, 1.5], 'i_app': [-2, -1]}
+    built = sweep(build, grid, (0, 2000), max_workers = 1, progress = False)
+
+    spec = bursting_neuron().to_spec()
+    grid = {'elements.4.a': [1, 1.5], 'i_app': [-2, -1]}
+    result = sweep(spec, grid, (0, 2000), max_workers = 1, progress = False)
+    assert result.names[1:3] == ['elements.4.a', 'i_app']
+    assert np.array_equal(result['spikes_0'], built['spikes_0'])
+    assert np.all(result['error'] == "")
+    assert spec == bursting_neuron().to_spec() # left unmodified
+
+def test_override_spec():
+    spec = bursting_neuron().to_spec()
+    assert override_spec(spec, {'C': 2, 'elements.1.voff': 0.5}) == dict(
+        spec, C = 2, elements = spec['elements'][:1] + [
+            dict(spec['elements'][1], voff = 0.5)] + spec['elements'][2:])
+    for name in ('elements.9.a', 'elements.x.a', 'g_max', 'C.a'):
+        with pytest.raises(ValueError):
+            override_spec(spec, {name: 1})
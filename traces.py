@@ -0,0 +1,292 @@
+"""
+On-disk storage of simulation output: the chunks produced by simulate are
+appended to fixed-size .npy chunk files with one dataset per neuron, and read
+back lazily as memory-mapped slices by time window and neuron.
+
+@author: Luka
+"""
+
+import json
+import os
+
+import numpy as np
+
+def trace_datasets(system, record):
+    """
+    Groups the recorded state indices by neuron, using the first state index
+    of every neuron (membrane_index, i.e. Network.neuron_index)
+    
+    Returns {name: (columns of record, state indices within the neuron)}
+    with the names neuron_<m>
+    """
+    starts = np.asarray(system.membrane_index())
+    owner = np.searchsorted(starts, record, side = 'right') - 1
+    if np.any(owner < 0):
+        raise ValueError("Recorded states do not belong to a neuron")
+    
+    datasets = {}
+    for m in np.unique(owner):
+        columns = np.nonzero(owner == m)[0]
+        datasets["neuron_%d" % m] = (columns, record[columns] - starts[m])
+    return datasets
+
+def _chunk_file(path, name, c):
+    return os.path.join(path, name, "%06d.npy" % c)
+
+class TraceWriter():
+    """
+    Writes the output of a simulation to a directory of .npy chunk files, to
+    be used as the callback of simulate:
+    
+        writer = TraceWriter(path, network)
+        network.simulate(trange, i_app, record = writer.record,
+                         callback = writer)
+        writer.close()
+    
+    args:
+        path: trace directory
+        system: simulated Neuron, Network or Population
+    
+    kwargs:
+        record: recorded state indices (all states by default), to be passed
+        to simulate as writer.record
+        chunk_size: number of samples per chunk file
+        samples: if given, the trace in path is reopened and truncated to its
+        first samples samples before appending, e.g. the samples of the
+        checkpoint a simulation is resumed from (see checkpoint.resume)
+    
+    methods:
+        flush: write the index and flush the chunk files to disk
+        close: flush and release the chunk files
+    
+    Layout: path/index.json, path/t/000000.npy, path/neuron_<m>/000000.npy,
+    ... Every chunk file has room for chunk_size samples, and the index lists
+    the number of valid samples and the time range of every chunk. The
+    index is rewritten after every output chunk of the simulation, so that
+    the trace can be read during the simulation and after an interruption.
+    """
+    
+    def __init__(self, path, system, record = None, chunk_size = 100000,
+                 samples = None):
+        self.path = path
+        self.index_file = os.path.join(path, "index.json")
+        
+        if (samples is not None):
+            with open(self.index_file) as f:
+                self.index = json.load(f)
+            self.record = np.array(self.index['record'], dtype = int)
+            self.chunk_size = self.index['chunk_size']
+            self.datasets = {name: (np.array(d['columns'], dtype = int),
+                                    np.array(d['states'], dtype = int))
+                             for name, d in self.index['datasets'].items()}
+            self._truncate(samples)
+        else:
+            if (record is None):
+                record = np.arange(len(system.get_init_conditions()))
+            self.record = np.asarray(record, dtype = int)
+            self.chunk_size = chunk_size
+            self.datasets = trace_datasets(system, self.record)
+            self.index = {'chunk_size': chunk_size,
+                          'record': self.record,
+                          'datasets': {name: {'columns': columns,
+                                              'states': states}
+                                       for name, (columns, states)
+                                       in self.datasets.items()},
+                          'chunks': [], 'samples': 0}
+            for name in ['t'] + list(self.datasets):
+                os.makedirs(os.path.join(path, name), exist_ok = True)
+            self.files = None
+        self.flush()
+    
+    def _truncate(self, samples):
+        """
+        Drops the samples after the first samples samples
+        """
+        chunks = self.index['chunks']
+        total = 0
+        for c, chunk in enumerate(chunks):
+            if (total + chunk['n'] >= samples):
+                break
+            total += chunk['n']
+        else:
+            c = len(chunks)
+        del chunks[c+1:]
+        
+        self.files = None
+        if (c < len(chunks)):
+            n = samples - total
+            chunks[c]['n'] = n
+            if (n == 0):
+                del chunks[c]
+            else:
+                self._open_chunk(c, 'r+')
+                chunks[c]['t1'] = float(self.files['t'][n-1])
+        self.index['samples'] = min(samples, self.index['samples'])
+    
+    def _open_chunk(self, c, mode):
+        shapes = {'t': (self.chunk_size,)}
+        shapes.update({name: (self.chunk_size, states.size)
+                       for name, (_, states) in self.datasets.items()})
+        self.files = {}
+        for name, shape in shapes.items():
+            filename = _chunk_file(self.path, name, c)
+            if (mode == 'w+'):
+                self.files[name] = np.lib.format.open_memmap(
+                    filename, mode, dtype = float, shape = shape)
+            else:
+                self.files[name] = np.load(filename, mmap_mode = mode)
+    
+    def __call__(self, t, y):
+        """
+        Appends an output chunk of simulate: times t (k,) and the recorded
+        states y (len(record), k)
+        """
+        chunks = self.index['chunks']
+        pos = 0
+        while (pos < t.size):
+            if (self.files is None) or (chunks[-1]['n'] == self.chunk_size):
+                chunks.append({'n': 0, 't0': float(t[pos]), 't1': None})
+                self._open_chunk(len(chunks) - 1, 'w+')
+            chunk = chunks[-1]
+            k = chunk['n']
+            m = min(self.chunk_size - k, t.size - pos)
+            
+            self.files['t'][k:k+m] = t[pos:pos+m]
+            for name, (columns, _) in self.datasets.items():
+                self.files[name][k:k+m] = y[columns, pos:pos+m].T
+            chunk['n'] = k + m
+            chunk['t1'] = float(t[pos+m-1])
+            pos += m
+        self.index['samples'] += t.size
+        self.flush()
+    
+    def flush(self):
+        if (self.files is not None):
+            for f in self.files.values():
+                f.flush()
+        temp = self.index_file + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump(_index_plain(self.index), f)
+        os.replace(temp, self.index_file)
+    
+    def close(self):
+        self.flush()
+        self.files = None
+
+def _index_plain(index):
+    index = dict(index)
+    index['record'] = np.asarray(index['record']).tolist()
+    index['datasets'] = {name: {key: np.asarray(value).tolist()
+                                for key, value in d.items()}
+                         for name, d in index['datasets'].items()}
+    return index
+
+class TraceReader():
+    """
+    Lazy reader of a trace written by TraceWriter, the chunk files are memory
+    mapped and only the requested slices are read from disk
+    
+    args:
+        path: trace directory
+    
+    attributes:
+        names: dataset names, neuron_<m> for neuron m
+        states: {name: state indices of the neuron stored in the dataset}
+        t_range: (first, last) sample time
+    
+    methods:
+        time: sample times within a time window
+        read: states of a neuron within a time window
+        window: states of several neurons within a time window
+    
+    Windows are closed intervals [t_start, t_stop], None meaning the start or
+    the end of the trace. The states are returned as (states, samples)
+    arrays, as sol.y of simulate; a window within a single chunk is a view of
+    the memory-mapped file, otherwise the window is copied from the chunks.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "index.json")) as f:
+            self.index = json.load(f)
+        self.chunks = self.index['chunks']
+        self.names = list(self.index['datasets'])
+        self.states = {name: np.array(d['states'], dtype = int)
+                       for name, d in self.index['datasets'].items()}
+        self._maps = {}
+    
+    def __len__(self):
+        return sum(chunk['n'] for chunk in self.chunks)
+    
+    @property
+    def t_range(self):
+        if (len(self.chunks) == 0):
+            return None
+        return self.chunks[0]['t0'], self.chunks[-1]['t1']
+    
+    def _map(self, name, c):
+        # Only the time maps are kept open, they are searched by every read
+        if (name == 't') and (c in self._maps):
+            return self._maps[c]
+        data = np.load(_chunk_file(self.path, name, c), mmap_mode = 'r')
+        data = data[:self.chunks[c]['n']]
+        if (name == 't'):
+            self._maps[c] = data
+        return data
+    
+    def _slices(self, t_start, t_stop):
+        """
+        Returns the (chunk, first, stop) sample ranges of a time window
+        """
+        slices = []
+        for c, chunk in enumerate(self.chunks):
+            if (t_start is not None) and (chunk['t1'] < t_start):
+                continue
+            if (t_stop is not None) and (chunk['t0'] > t_stop):
+                break
+            t = self._map('t', c)
+            i0 = 0 if (t_start is None) else np.searchsorted(t, t_start)
+            i1 = t.size if (t_stop is None) else np.searchsorted(t, t_stop,
+                                                                 'right')
+            if (i1 > i0):
+                slices.append((c, i0, i1))
+        return slices
+    
+    def _dataset(self, neuron):
+        name = neuron if isinstance(neuron, str) else "neuron_%d" % neuron
+        if (name not in self.states):
+            raise ValueError("No dataset %s in the trace" % name)
+        return name
+    
+    def _gather(self, name, slices):
+        parts = [self._map(name, c)[i0:i1] for c, i0, i1 in slices]
+        if (len(parts) == 1):
+            return parts[0]
+        if (len(parts) == 0):
+            shape = self._map(name, 0).shape[1:] if self.chunks else ()
+            return np.empty((0,) + shape)
+        return np.concatenate(parts)
+    
+    def time(self, t_start = None, t_stop = None):
+        return self._gather('t', self._slices(t_start, t_stop))
+    
+    def read(self, neuron, t_start = None, t_stop = None):
+        """
+        Returns the times (k,) and the recorded states (states, k) of a
+        neuron (index or dataset name) within the time window
+        """
+        name = self._dataset(neuron)
+        slices = self._slices(t_start, t_stop)
+        return self._gather('t', slices), self._gather(name, slices).T
+    
+    def window(self, t_start = None, t_stop = None, neurons = None):
+        """
+        Returns the times (k,) and {name: states (states, k)} of the neurons
+        (indices or dataset names, all by default) within the time window
+        """
+        if (neurons is None):
+            neurons = self.names
+        slices = self._slices(t_start, t_stop)
+        return self._gather('t', slices), {
+            self._dataset(n): self._gather(self._dataset(n), slices).T
+            for n in neurons}